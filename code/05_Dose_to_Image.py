@@ -18,135 +18,287 @@ from glob import glob
 from dicomMethods import *
 
 
-if __name__ == "__main__":
-
-    wd_dose = 'H:/HN_TransferLearning/0_data/dose/'   
-    wd_ct = 'H:/HN_TransferLearning/0_data/ct/'
-    
-    output_dose = 'H:/HN_TransferLearning/2_output/05_dose_to_image/dose/'
-    output_ct = 'H:/HN_TransferLearning/2_output/05_dose_to_image/ct/'
-    
-    reg_shift = pd.read_excel('H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx')
-    patient_list = list(np.unique(reg_shift.Patient))
-    
-    baseline = np.array([-300, -236, -583]) # Taken from first slice of HN_002.
-    
-    for id, hn_id in enumerate(patient_list): 
-        print(f'Processing patient {hn_id}...')
-        start = time.time()
-        
-        dose_file = f'dose_image_{hn_id}.npy'
-        ct_file = f'ct_image_{hn_id}.npy'
-        
-        # Check to see if the output file exists.
-        if (os.path.exists(output_ct + ct_file)):
-            print(f"{hn_id} has already been processed.")
-            continue
-
-        # Define the deformation shifts.
-        deformation = np.array((reg_shift[reg_shift.Patient == hn_id].X.values[0],
-                                reg_shift[reg_shift.Patient == hn_id].Y.values[0],
-                                reg_shift[reg_shift.Patient == hn_id].Z.values[0]))
-
-        #-------------------------------------------------------------------------
-        # Import and apply operations to files!
-        #   1) Import ct + dose.
-        #   2) Resample to 1 mm^3 voxel size.
-        #   3) Resize image to [512,512,512] by cropping or padding end or array.
-        #   4) Apply registration .ImagePositionPatient shifts.
-        #-------------------------------------------------------------------------
-        
-        # Load ct and dose file.
-        print(f'...importing files.')
-        ct = load_scan(wd_ct + f'{hn_id}/') # This is [Z, Y, X]
-        dose_arr, dose = load_dose(wd_dose + f'{hn_id}/') # This is [Z,Y,X]
-    
-        print(f'...imported {len(dose)} dose file(s) and {len(ct)} CT slices.')    
-        
-        # Pull out voxel information from dose and ct files.
-        dose_ps = dose[0].PixelSpacing
-        dose_thick = dose[0].GridFrameOffsetVector[1] - dose[0].GridFrameOffsetVector[0] 
-        
-        ct_ps = ct[0].PixelSpacing
-        ct_thick = ct[0].SliceThickness
-        
-        # Pull out array from scans and dose file. 
-        # Need to swap from [Z,Y,X] to [X,Y,Z].
-        ct_img = np.swapaxes(get_pixels_hu(ct),0,-1)
-        dose_arr = np.swapaxes(dose_arr, 0, -1)
+wd_dose = 'H:/HN_TransferLearning/0_data/dose/'
+wd_ct = 'H:/HN_TransferLearning/0_data/ct/'
+
+# Optional DicomCatalogue of the data tree. When set, the ct and dose files
+# are resolved from the patient's plan (plan -> dose, plan -> structure set
+# -> CT series, see DicomCatalogue.case) instead of the wd_ct/wd_dose
+# patient folders.
+catalogue_file = None
+
+# RTPlanLabel of the plan to use, for patients with more than one plan in
+# the catalogue.
+plan_names = {}
+
+output_store = 'H:/HN_TransferLearning/2_output/05_dose_to_image/store/'
+
+reg_shift_file = 'H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx'
+
+baseline = np.array([-300, -236, -583]) # Taken from first slice of HN_002.
+
+# Single pass resamples, shifts and crops in one interpolation, writing
+# the cropped + windowed images from 06_Crop_Images.py directly.
+single_pass = True
+output_crop_store = 'H:/HN_TransferLearning/2_output/06_crop_images/store/'
+crop_size = [(150,450),(135,435),(212,512)]
+
+shape = [512, 512, 512]
+
+# With single_pass, transform in slabs of at most memory_gb of working
+# memory and stream them into the store (see transform_slabs). None to
+# transform whole volumes.
+memory_gb = 0.5
+
+# Storage of the output volumes, see pipeline_codecs and VolumeCodec.
+codecs = pipeline_codecs
+
+# Outputs are cached by the content of the ct and dose files, the patient's
+# registration row and the parameters above (see patient_key), so a rerun
+# only recomputes patients whose inputs or parameters changed. Bump
+# pipeline_version when the processing itself changes.
+cache_dir = 'H:/HN_TransferLearning/2_output/05_dose_to_image/cache/'
+cache_max_gb = 50
+pipeline_version = 1
+
+# JSON-lines log of time, memory and I/O per patient and function (see
+# profile_report.py). None to turn profiling off.
+profile_log = 'H:/HN_TransferLearning/2_output/profile.jsonl'
+
+
+def create_store(patient_list, single_pass = single_pass):
+    # ct and dose volumes for every patient, see VolumeStore.
+    if single_pass:
+        crop_shape = [c[1] - c[0] for c in crop_size]
+        return VolumeStore.create(output_crop_store, patient_list, crop_shape, codecs = codecs)
+    else:
+        return VolumeStore.create(output_store, patient_list, shape, codecs = codecs)
+
+
+def open_store(single_pass = single_pass):
+    if single_pass:
+        return VolumeStore(output_crop_store)
+    else:
+        return VolumeStore(output_store)
+
+
+def source_files(hn_id):
+    '''
+    ct and dose files of a patient, from the catalogue or patient folders.
+    '''
+    if catalogue_file:
+        catalogue = DicomCatalogue(catalogue_file)
+        case = catalogue.case(hn_id, plan_names.get(hn_id))
+        catalogue.close()
         
+        ct_files, dose_files = case['ct'], case['dose']
+        if not ct_files or not dose_files:
+            raise ValueError(f'{hn_id}: plan {case["plan"]} has {len(dose_files)} dose '
+                             f'file(s) and {len(ct_files)} linked CT slice(s).')
+    else:
+        ct_files = [os.path.join(wd_ct, hn_id, f) for f in os.listdir(wd_ct + f'{hn_id}/')]
+        dose_files = [os.path.join(wd_dose, hn_id, f) for f in os.listdir(wd_dose + f'{hn_id}/')
+                      if f.startswith('RD.')]
+
+    return ct_files, dose_files
+
+
+def patient_key(hn_id, reg_shift, ct_files, dose_files, single_pass = single_pass):
+    '''
+    Cache key of a patient's output: hashes of the input files, the
+    registration row and every parameter the output depends on.
+    '''
+    row = reg_shift[reg_shift.Patient == hn_id].to_dict('records')
+    params = {'baseline': baseline, 'shape': shape, 'single_pass': single_pass,
+              'codecs': {m: c.to_dict() for m, c in codecs.items()},
+              'version': pipeline_version}
+    if single_pass:
+        params['crop_size'] = crop_size
+
+    return cache_key(ct = source_digest(ct_files), dose = source_digest(dose_files),
+                     registration = row, params = params)
+
+
+def dose_to_image(hn_id, reg_shift, single_pass = single_pass, files = None, key = None):
+    '''
+    Run this stage for one patient and write the ct and dose images
+    to the volume store (create_store must have been called first).
+    Taken from the cache if the inputs and parameters are unchanged.
+
+    Parameters
+    ----------
+    hn_id : string
+        Patient ID.
+    reg_shift : pandas.DataFrame
+        Table read from RegistrationShifts.xlsx.
+    single_pass : bool, optional
+        Resample, shift and crop in one step with transform_image.
+    files : tuple, optional
+        (ct_files, dose_files) if already found with source_files.
+    key : string, optional
+        patient_key if already computed.
+
+    Returns
+    -------
+    ct_img : numpy.ndarray
+        Processed ct image, [X,Y,Z].
+    dose_img : numpy.ndarray
+        Processed dose image, [X,Y,Z].
+
+    '''
+    ct_files, dose_files = files if files is not None else source_files(hn_id)
+
+    cache = VolumeCache(cache_dir, cache_max_gb, codecs)
+    if key is None:
+        key = patient_key(hn_id, reg_shift, ct_files, dose_files, single_pass)
+    cached = cache.get(key)
+
+    store = open_store(single_pass)
+    streamed = False
+
+    if cached is not None:
+        print(f'...found in cache.')
+        ct_img, dose_img = cached['ct'], cached['dose']
+    else:
+        ct_img, dose_img = process_patient(hn_id, reg_shift, ct_files, dose_files,
+                                           single_pass, store)
+        if ct_img is None:
+            # Streamed into the store, read back for the cache.
+            streamed = True
+            ct_img, dose_img = store.read('ct', hn_id), store.read('dose', hn_id)
+        cache.put(key, ct = ct_img, dose = dose_img)
+
+    # Save output files.
+    if not streamed:
+        store.write('dose', hn_id, dose_img)
+        store.write('ct', hn_id, ct_img)
+    store.close()
+
+    return ct_img, dose_img
+
+
+@profiled
+def transform_to_store(store, modality, hn_id, *args):
+    # transform_image + window_image slab by slab, straight into the store.
+    writer = store.writer(modality, hn_id)
+    for start, slab in transform_slabs(*args, crop = crop_size, shape = shape,
+                                       memory_gb = memory_gb):
+        writer.write(window_image(slab))
+    writer.close()
+
+
+def process_patient(hn_id, reg_shift, ct_files, dose_files, single_pass = single_pass,
+                    store = None):
+    # Load and process one patient, without the cache. With single_pass,
+    # memory_gb and a store the images are streamed into the store and
+    # (None, None) is returned.
+    # Define the deformation shifts.
+    deformation = registration_offsets(reg_shift, hn_id)
+
+    #-------------------------------------------------------------------------
+    # Import and apply operations to files!
+    #   1) Import ct + dose.
+    #   2) Resample to 1 mm^3 voxel size.
+    #   3) Resize image to [512,512,512] by cropping or padding end or array.
+    #   4) Apply registration .ImagePositionPatient shifts.
+    # With single_pass, 2-4 and the crop from 06 are done by transform_image.
+    #-------------------------------------------------------------------------
+
+    # Load ct and dose file.
+    print(f'...importing files.')
+    ct_img, ct = load_ct(ct_files) # This is [Z, Y, X]
+    dose_arr, dose = load_dose(dose_files) # This is [Z,Y,X]
+
+    print(f'...imported {len(dose)} dose file(s) and {len(ct)} CT slices.')
+
+    # Pull out voxel information from dose and ct files.
+    dose_ps = dose[0].PixelSpacing
+    dose_thick = dose[0].GridFrameOffsetVector[1] - dose[0].GridFrameOffsetVector[0]
+
+    ct_ps = ct[0].PixelSpacing
+    ct_thick = ct[0].SliceThickness
+
+    # Pull out array from scans and dose file.
+    # Need to swap from [Z,Y,X] to [X,Y,Z].
+    ct_img = np.swapaxes(ct_img,0,-1)
+    dose_arr = np.swapaxes(dose_arr, 0, -1)
+
+    ct_shift, dose_shift = alignment_shifts(ct, dose, baseline)
+
+    if single_pass and memory_gb and store is not None:
+        print(f'...resampling, shifting and cropping image in slabs.')
+        transform_to_store(store, 'dose', hn_id, dose_arr, dose_thick, dose_ps,
+                           dose_shift, deformation)
+        del dose_arr
+        transform_to_store(store, 'ct', hn_id, ct_img, ct_thick, ct_ps,
+                           ct_shift, deformation)
+        return None, None
+
+    elif single_pass:
+        print(f'...resampling, shifting and cropping image.')
+        dose_img = transform_image(dose_arr, dose_thick, dose_ps, dose_shift,
+                                   deformation, crop = crop_size, shape = shape)
+        ct_img = transform_image(ct_img, ct_thick, ct_ps, ct_shift,
+                                 deformation, crop = crop_size, shape = shape)
+
+        print(f'...windowing images.')
+        ct_img = window_image(ct_img)
+        dose_img = window_image(dose_img)
+
+    else:
         # Re-sample the images to a 1 mm^3 voxel size.
         print(f'...resampling image.')
         dose_img = resample(dose_arr, dose_thick, dose_ps)
         ct_img = resample(ct_img, ct_thick, ct_ps)
-        
+
         # Resize the images so they are a common size!
         print(f'...resizing image.')
-        shape = [512, 512, 512]
         dose_img = resize_image(dose_img, crop = shape)
         ct_img = resize_image(ct_img, crop = shape)
-        
+
         # Resize the images so they are a common size!
         print(f'...shifting image.')
-        ct_pos = np.array(ct[0].ImagePositionPatient)
-        dose_pos = np.array(dose[0].ImagePositionPatient)
-        
-        dose_to_ct = dose_pos - ct_pos
-        align_shift = ct_pos - baseline
-        
-        dose_img = registration_shift(dose_img, dose_to_ct + align_shift, deformation)
-        ct_img = registration_shift(ct_img, align_shift, deformation)
-        
-
-        #-------------------------------------------------------------------------
-        # Print out the appropriate plots and save the files.
-        #-------------------------------------------------------------------------
-        
-        # Save output files.
-        np.save(output_dose + dose_file, dose_img)
-        np.save(output_ct + ct_file, ct_img)
-        
-        end = time.time()
-        print(f'Finished processing {hn_id} in {(end - start) / 60:.1f} minutes.')
-        
-        # Optional plotting of slices.
-
-        plt.figure(1)   
-        a3 = plt.subplot(2, 5, (id % 10) + 1)
-        plt.imshow(ct_img[256,:,:],cmap='gray')
-        plt.imshow(dose_img[256,:,:],cmap='jet', alpha = 0.5)
-        
-        plt.figure(2)   
-        a3 = plt.subplot(2, 5, (id % 10) + 1)
-        plt.imshow(ct_img[:, 256,:],cmap='gray')
-        plt.imshow(dose_img[:, 256,:],cmap='jet', alpha = 0.5)
-        
-        plt.figure(3)   
-        a3 = plt.subplot(2, 5, (id % 10) + 1)
-        plt.imshow(ct_img[:, :, 256],cmap='gray')
-        plt.imshow(dose_img[:, :, 256],cmap='jet', alpha = 0.5)
-
-        
-
-
-
-
-
-
-
-
-
-
-
-
+        dose_img = registration_shift(dose_img, dose_shift, deformation)
+        ct_img = registration_shift(ct_img, ct_shift, deformation)
 
+    return ct_img, dose_img
 
 
+if __name__ == "__main__":
 
+    reg_shift = pd.read_excel(reg_shift_file)
+    patient_list = list(np.unique(reg_shift.Patient))
+    store = create_store(patient_list)
+    if profile_log:
+        start_profiling(profile_log)
 
+    for id, hn_id in enumerate(patient_list):
+        print(f'Processing patient {hn_id}...')
+        start = time.time()
 
+        # Every patient is checked, unchanged ones come from the cache.
+        with profile('patient', patient = hn_id, stage = '05_dose_to_image'):
+            ct_img, dose_img = dose_to_image(hn_id, reg_shift)
 
+        end = time.time()
+        print(f'Finished processing {hn_id} in {(end - start) / 60:.1f} minutes.')
 
+        #-------------------------------------------------------------------------
+        # Optional plotting of slices.
+        #-------------------------------------------------------------------------
+        mid = np.array(ct_img.shape) // 2
 
+        plt.figure(1)
+        a3 = plt.subplot(2, 5, (id % 10) + 1)
+        plt.imshow(ct_img[mid[0],:,:],cmap='gray')
+        plt.imshow(dose_img[mid[0],:,:],cmap='jet', alpha = 0.5)
 
+        plt.figure(2)
+        a3 = plt.subplot(2, 5, (id % 10) + 1)
+        plt.imshow(ct_img[:, mid[1],:],cmap='gray')
+        plt.imshow(dose_img[:, mid[1],:],cmap='jet', alpha = 0.5)
 
+        plt.figure(3)
+        a3 = plt.subplot(2, 5, (id % 10) + 1)
+        plt.imshow(ct_img[:, :, mid[2]],cmap='gray')
+        plt.imshow(dose_img[:, :, mid[2]],cmap='jet', alpha = 0.5)
@@ -7,6 +7,9 @@ Created on Wed Mar  2 12:40:17 2022
 Goal of this piece of code is to trim all of the images to appropriate size.
 This trimming is done based on HN_002 image.
 
+Not needed when 05_Dose_to_Image.py is run with single_pass = True, which
+writes the cropped and windowed images here directly.
+
 """
 
 import numpy as np
@@ -22,46 +25,55 @@ from glob import glob
 from dicomMethods import *
 
 
+wd_store = 'H:/HN_TransferLearning/2_output/05_dose_to_image/store/'
+
+output_store = 'H:/HN_TransferLearning/2_output/06_crop_images/store/'
+
+reg_shift_file = 'H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx'
+
+crop_size = [(150,450),(135,435),(212,512)]
+
+# Storage of the output volumes, see pipeline_codecs and VolumeCodec.
+codecs = pipeline_codecs
+
+
+def create_store(patient_list):
+    crop_shape = [c[1] - c[0] for c in crop_size]
+    return VolumeStore.create(output_store, patient_list, crop_shape, codecs = codecs)
+
+
+def crop_images(hn_id):
+
+    # Load the output from 05_Dose_to_Image.py, only reading the
+    # cropped region from the volume store.
+    print(f'...importing cropped images.')
+    store = VolumeStore(wd_store)
+    ct_img = store.read('ct', hn_id, box = crop_size)
+    dose_img = store.read('dose', hn_id, box = crop_size)
+
+    # Window the images.
+    print(f'...windowing images.')
+    ct_img = window_image(ct_img)
+    dose_img = window_image(dose_img)
+
+    # Save output files.
+    store = VolumeStore(output_store)
+    store.write('dose', hn_id, dose_img)
+    store.write('ct', hn_id, ct_img)
+    store.close()
+
+
 if __name__ == "__main__":
-    wd = 'H:/HN_TransferLearning/2_output/05_dose_to_image/'
-    wd_dose = 'H:/HN_TransferLearning/2_output/05_dose_to_image/dose/' 
-    wd_ct = 'H:/HN_TransferLearning/2_output/05_dose_to_image/ct/'
-    
-    output = 'H:/HN_TransferLearning/2_output/06_crop_images/'
-    output_ct = 'H:/HN_TransferLearning/2_output/06_crop_images/ct/'
-    output_dose = 'H:/HN_TransferLearning/2_output/06_crop_images/dose/'
-
-    reg_shift = pd.read_excel('H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx')
+
+    reg_shift = pd.read_excel(reg_shift_file)
     patient_list = list(np.unique(reg_shift.Patient))
-    
+    store = create_store(patient_list)
+
     for id, hn_id in enumerate(patient_list):
         print(f'Processing patient {hn_id}...')
-        
-        dose_file = f'dose_img_{hn_id}.npy'
-        ct_file = f'ct_img_{hn_id}.npy'
-        
-        if (os.path.exists(output_ct + ct_file)):
+
+        if store.written('ct', hn_id):
             print(f"{hn_id} has already been processed.")
-            continue        
-        
-        # Load the output from 05_Dose_to_Image.py.
-        print(f'...importing images.')
-        ct_img, dose_img = load_images(hn_id, wd, plot = False)
-        
-        # Crop the image to the appropriate size.
-        print(f'...cropping images.')
-        crop_size = [(150,450),(135,435),(212,512)]
-        ct_img = crop_image(ct_img, crop_size)
-        dose_img = crop_image(dose_img, crop_size)
-        
-        # Window the images. 
-        print(f'...windowing images.')
-        ct_img = window_image(ct_img)
-        dose_img = window_image(dose_img)
-        
-        # Save output files.
-        np.save(output_dose + dose_file, dose_img)
-        np.save(output_ct + ct_file, ct_img)
-        
-        
-        
\ No newline at end of file
+            continue
+
+        crop_images(hn_id)
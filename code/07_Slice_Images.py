@@ -4,7 +4,7 @@ Created on Wed Mar  2 10:53:09 2022
 
 @author: owenpaetkau
 
-Goal of this piece of code is to import the 3D array images from 05_Dose_to_image.py,
+Goal of this piece of code is to import the 3D array images from 06_Crop_Images.py,
 and compile arrays of single slices of interest in both the dose and ct scans.
 
 Additionally, I want to be able to scale both of those outputs to be between 0 and 255
@@ -19,6 +19,7 @@ import time
 
 import pydicom
 import os
+import json
 from glob import glob
 
 from PIL import Image
@@ -28,71 +29,117 @@ from dicomMethods import *
 from PIL import Image
 
 
-if __name__ == "__main__":
+wd_store = 'H:/HN_TransferLearning/2_output/06_crop_images/store/'
+output = 'H:/HN_TransferLearning/2_output/07_slice_images/'
+
+reg_shift_file = 'H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx'
+
+sag_slices = np.arange(145, 156, 1)
+cor_slices = np.arange(115, 126, 1)
+axial_slices = np.arange(115, 146, 3)
+
+
+# Orientation name, axis and slice indices.
+orientations = [('sagittal', 0, sag_slices),
+                ('coronal', 1, cor_slices),
+                ('axial', 2, axial_slices)]
+
+
+def load_progress(patient_list, layout):
+    '''
+    Finished flag per patient from {output}/progress.json, or all zeros if
+    there is none or it was written for other patients or another store
+    layout or slices (layout key). Also returns whether it can be resumed.
+    '''
+    progress_file = f'{output}/progress.json'
+    if os.path.exists(progress_file):
+        with open(progress_file) as f:
+            saved = json.load(f)
+        if saved.get('patients') == patient_list and saved.get('layout') == layout:
+            return np.array(saved['done'], dtype = np.uint8), True
     
-    wd = 'H:/HN_TransferLearning/2_output/06_crop_images/'    
-    output = 'H:/HN_TransferLearning/2_output/07_slice_images/'
+    return np.zeros(len(patient_list), dtype = np.uint8), False
 
-    reg_shift = pd.read_excel('H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx')
-    patient_list = list(np.unique(reg_shift.Patient))
+
+def save_progress(patient_list, layout, progress):
+    # Write then rename, so the progress file is never half written.
+    progress_file = f'{output}/progress.json'
+    with open(progress_file + '.tmp', 'w') as f:
+        json.dump({'patients': patient_list, 'layout': layout,
+                   'done': [int(p) for p in progress]}, f)
+    os.replace(progress_file + '.tmp', progress_file)
+
+
+def slice_images(patient_list, redo = None):
+    '''
+    Read each patient once and write every requested slice into the
+    per-slice cohort arrays ({output}/ct/ct_sagittal_150.npy etc.).
+    
+    The cohort arrays are preallocated and filled one patient at a time,
+    so an interrupted run continues from the last finished patient
+    (tracked in {output}/progress.json with the patient list and a key of
+    the store layout and slices; if either changed it starts over).
+    Patients in redo (e.g. whose volumes changed) are written again.
+    '''
+    store = VolumeStore(wd_store)
+    patient_list = [str(p) for p in patient_list]
+    n_patients = len(patient_list)
+    
+    layout = cache_key(store = store.index, 
+                       orientations = [(name, axis, list(indices)) 
+                                       for name, axis, indices in orientations])
+    progress, resume = load_progress(patient_list, layout)
+    if redo:
+        for hn_id in redo:
+            progress[patient_list.index(str(hn_id))] = 0
+        save_progress(patient_list, layout, progress)
     
-    sag_slices = np.arange(145, 156, 1)
-    cor_slices = np.arange(115, 126, 1)
-    axial_slices = np.arange(115, 146, 3)
+    if progress.all():
+        print(f"Slices have been processed.")
+        return
     
-    for sag, cor, axial in zip(sag_slices, cor_slices, axial_slices):
-        print(f'Processing slices {sag} {cor} {axial}...')       
+    # Open (or create) one cohort array per modality, orientation and slice.
+    stacks = {}
+    for modality in ('ct', 'dose'):
+        for name, axis, indices in orientations:
+            slice_shape = tuple(n for ii, n in enumerate(store.shape) if ii != axis)
+            for index in indices:
+                path = f'{output}/{modality}/{modality}_{name}_{index}.npy'
+                if resume:
+                    stacks[(modality, name, index)] = np.load(path, mmap_mode = 'r+')
+                else:
+                    stacks[(modality, name, index)] = np.lib.format.open_memmap(
+                        path, mode = 'w+', dtype = store.dtype, 
+                        shape = (n_patients,) + slice_shape)
     
-        if (os.path.exists(f'{output}/dose/dose_axial_{axial}.npy')):
-            print(f"Slices {sag} {cor} {axial} have been processed.")
-            continue   
+    for ii, hn_id in enumerate(patient_list):
+        if progress[ii]:
+            continue
         
         start = time.time()
+        print(f'...loading slices for {hn_id}.')
         
-        sag_dose, cor_dose, axial_dose = [], [], []
-        sag_ct, cor_ct, axial_ct = [], [], []
-        
-        for id, hn_id in enumerate(patient_list):
-            
-            # Load dose and ct. 
-            print(f'...loading images for {hn_id}.')
-            ct_img = np.load(wd + f'ct/ct_img_{hn_id}.npy')
-            dose_img = np.load(wd + f'dose/dose_img_{hn_id}.npy')
-            
-            # For each array, slice along specific axis and save file.
-            # Sagittal array:
-            sag_ct.append(ct_img.take(indices = sag, axis = 0))
-            sag_dose.append(dose_img.take(indices = sag, axis = 0))
-            
-            # Coronal array:
-            cor_ct.append(ct_img.take(indices = cor, axis = 1))
-            cor_dose.append(dose_img.take(indices = cor, axis = 1))
+        with profile('patient', patient = hn_id, stage = '07_slice_images'):
+            for modality in ('ct', 'dose'):
+                # All slices along an axis come out of the memory map in one read.
+                vol = store.volume(modality, hn_id)
+                for name, axis, indices in orientations:
+                    slices = np.take(vol, indices, axis = axis)
+                    for jj, index in enumerate(indices):
+                        stacks[(modality, name, index)][ii] = slices.take(jj, axis = axis)
             
-            # Axial array:
-            axial_ct.append(ct_img.take(indices = axial, axis = 2))
-            axial_dose.append(dose_img.take(indices = axial, axis = 2))
-                       
-            
-        np.save(f'{output}/ct/ct_sagittal_{sag}.npy', sag_ct)
-        np.save(f'{output}/dose/dose_sagittal_{sag}.npy', sag_dose)
-        
-        np.save(f'{output}/ct/ct_coronal_{cor}.npy', cor_ct)
-        np.save(f'{output}/dose/dose_coronal_{cor}.npy', cor_dose)
-        
-        np.save(f'{output}/ct/ct_axial_{axial}.npy', axial_ct)
-        np.save(f'{output}/dose/dose_axial_{axial}.npy', axial_dose)
+            for stack in stacks.values():
+                stack.flush()
+        progress[ii] = 1
+        save_progress(patient_list, layout, progress)
         
         end = time.time()
-        
-        print(f'Finished process slices {sag} {cor} {axial} in {(end - start) / 60:.1f} minutes.')
-            
+        print(f'Finished slices for {hn_id} in {end - start:.1f} seconds.')
 
-            
 
-            
-            
-            
-            
-        
-        
-        
\ No newline at end of file
+if __name__ == "__main__":
+    
+    reg_shift = pd.read_excel(reg_shift_file)
+    patient_list = list(np.unique(reg_shift.Patient))
+    
+    slice_images(patient_list)
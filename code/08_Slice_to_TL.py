@@ -1,84 +1,138 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Thu Mar  3 15:57:36 2022
-
-@author: owenpaetkau
-
-Made a mistake, data wasn't ready to be pushed through. Need to place them
-into the correct array shape so images have 3 channels.
-
-"""
-
-import numpy as np
-import matplotlib.pyplot as plt
-
-import pandas as pd
-import time
-
-import pydicom
-import os
-from glob import glob
-
-from PIL import Image
-
-from dicomMethods import *
-
-from PIL import Image
-
-
-def combine_channels(wd, slice_type, slice_num):
-    ct = np.load(f'{wd}ct/ct_{slice_type}_{slice_num}.npy')
-    dose = np.load(f'{wd}dose/dose_{slice_type}_{slice_num}.npy')
-    
-    full_list = []
-    
-    for ii in range(ct.shape[0]):
-        lst = []
-        
-        lst.append(scale_image(ct[ii])) #CT
-        lst.append(scale_image(dose[ii])) #Dose
-        lst.append(scale_image(dose[ii] + ct[ii])) #CT+Dose
-        
-        lst_trans = np.array(lst).transpose()
-        full_list.append(lst_trans)
-
-    full_array = np.array(full_list)
-    
-    return full_array        
-    
-
-if __name__ == "__main__":
-    
-    wd = 'H:/HN_TransferLearning/2_output/07_slice_images/'  
-    output = 'H:/HN_TransferLearning/2_output/08_images_to_TL/'
-
-    sag_slices = np.arange(145, 156, 1)
-    cor_slices = np.arange(115, 126, 1)
-    axial_slices = np.arange(115, 146, 3)
-    
-    for sag, cor, axial in zip(sag_slices, cor_slices, axial_slices):
-        print(f'Processing slices {sag} {cor} {axial}...') 
-        
-        # Combine CT, dose and ct+dose as channels.
-        sag_array = combine_channels(wd, 'sagittal', sag)
-        cor_array = combine_channels(wd, 'coronal', cor)
-        axial_array = combine_channels(wd, 'axial', axial)
-           
-        np.save(output + f"sagittal_set_{sag}.npy", sag_array)
-        np.save(output + f"coronal_set_{cor}.npy", cor_array)
-        np.save(output + f"axial_set_{axial}.npy", axial_array)
-
-
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Mar  3 15:57:36 2022
+
+@author: owenpaetkau
+
+Made a mistake, data wasn't ready to be pushed through. Need to place them
+into the correct array shape so images have 3 channels.
+
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import pandas as pd
+import time
+
+import pydicom
+import os
+import shutil
+from glob import glob
+
+from PIL import Image
+
+from dicomMethods import *
+
+from PIL import Image
+
+
+def load_channels(wd, slice_type, slice_num, dtype = None):
+    ct = np.load(f'{wd}ct/ct_{slice_type}_{slice_num}.npy', mmap_mode = 'r')
+    dose = np.load(f'{wd}dose/dose_{slice_type}_{slice_num}.npy', mmap_mode = 'r')
+    
+    return combine_channels(ct, dose, dtype = dtype)
+    
+
+wd = 'H:/HN_TransferLearning/2_output/07_slice_images/'  
+output = 'H:/HN_TransferLearning/2_output/08_images_to_TL/'
+
+# Slice stacks are read straight from the 06 store, 07 is not needed.
+wd_store = 'H:/HN_TransferLearning/2_output/06_crop_images/store/'
+output_stacks = output + 'stacks/'
+
+reg_shift_file = 'H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx'
+
+sag_slices = np.arange(145, 156, 1)
+cor_slices = np.arange(115, 126, 1)
+axial_slices = np.arange(115, 146, 3)
+
+# Channels are 0-255, so uint8 loses at most half a grey level and is 4x
+# smaller than float32. Use None to keep the float32 output.
+out_dtype = np.uint8
+
+# Outputs: the per-slice sets (sagittal_set_150.npy etc., from 07) used by
+# the notebooks, and/or one [patients, slices, W, H, 3] stack per
+# orientation over all the slices above (see SliceStacks).
+write_sets = True
+write_stacks = True
+
+# Orientation name, axis and slice indices, as in 07_Slice_Images.py.
+orientations = [('sagittal', 0, sag_slices),
+                ('coronal', 1, cor_slices),
+                ('axial', 2, axial_slices)]
+
+
+def slices_to_tl():
+    
+    for sag, cor, axial in zip(sag_slices, cor_slices, axial_slices):
+        print(f'Processing slices {sag} {cor} {axial}...') 
+        
+        # Combine CT, dose and ct+dose as channels.
+        sag_array = load_channels(wd, 'sagittal', sag, out_dtype)
+        cor_array = load_channels(wd, 'coronal', cor, out_dtype)
+        axial_array = load_channels(wd, 'axial', axial, out_dtype)
+           
+        np.save(output + f"sagittal_set_{sag}.npy", sag_array)
+        np.save(output + f"coronal_set_{cor}.npy", cor_array)
+        np.save(output + f"axial_set_{axial}.npy", axial_array)
+
+
+def slices_to_stacks(patient_list, redo = None):
+    '''
+    Same images as slices_to_tl, but every slice of an orientation goes
+    into one stack, read from each patient's volumes in one pass.
+    Patients already written are skipped, so an interrupted run continues,
+    except those in redo (e.g. whose volumes changed). Stacks made for
+    another cohort or slices are replaced.
+    '''
+    store = VolumeStore(wd_store)
+    
+    # combine_channels transposes each [H, W] slice to [W, H, 3].
+    layout = {}
+    for name, axis, indices in orientations:
+        h, w = [n for ii, n in enumerate(store.shape) if ii != axis]
+        layout[name] = (indices, (w, h, 3))
+    try:
+        stacks = SliceStacks.create(output_stacks, patient_list, layout, 
+                                    out_dtype or store.dtype)
+    except ValueError:
+        print(f'...cohort or slices changed, recreating the stacks.')
+        shutil.rmtree(output_stacks)
+        stacks = SliceStacks.create(output_stacks, patient_list, layout, 
+                                    out_dtype or store.dtype)
+    if redo:
+        stacks.reset(redo)
+    
+    for hn_id in patient_list:
+        if stacks.written(hn_id):
+            continue
+        
+        start = time.time()
+        with profile('patient', patient = hn_id, stage = '08_slice_stacks'):
+            ct = store.volume('ct', hn_id)
+            dose = store.volume('dose', hn_id)
+            
+            images = {}
+            for name, axis, indices in orientations:
+                # [slices, H, W] with the slices as samples.
+                ct_slices = np.moveaxis(np.take(ct, indices, axis = axis), axis, 0)
+                dose_slices = np.moveaxis(np.take(dose, indices, axis = axis), axis, 0)
+                images[name] = combine_channels(ct_slices, dose_slices, out_dtype)
+            
+            stacks.write(hn_id, images)
+        print(f'Finished stacks for {hn_id} in {time.time() - start:.1f} seconds.')
+    
+    stacks.close()
+
+
+if __name__ == "__main__":
+    
+    if write_sets:
+        slices_to_tl()
+    
+    if write_stacks:
+        reg_shift = pd.read_excel(reg_shift_file)
+        patient_list = list(np.unique(reg_shift.Patient))
+        
+        slices_to_stacks(patient_list)
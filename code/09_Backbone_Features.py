@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Run each frozen EfficientNet backbone once over the slice sets from
+08_Slice_to_TL.py, and train the classification head on the cached
+embeddings instead of the images.
+
+During initial training the backbones are frozen (trainable = False), so
+their outputs never change; the notebooks still recompute them every epoch.
+Here the pooled embeddings are stored in a VolumeCache keyed by backbone,
+set file content and feature_version, so a learning rate sweep of the head
+only trains a single dense layer. Fine-tuning the backbones still needs the
+images (see SliceDataset).
+
+The head sees pooled embeddings, not the flattened feature maps of the
+notebooks, so it is a different (smaller) model (see feature_head).
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import os
+import time
+
+from dicomMethods import *
+
+
+wd = 'H:/HN_TransferLearning/2_output/08_images_to_TL/'
+output = 'H:/HN_TransferLearning/2_output/09_backbone_features/'
+
+cache_dir = output + 'cache/'
+cache_max_gb = 5
+
+# Bump when backbone_features changes in a way the key does not show.
+feature_version = 1
+
+label_file = 'H:/HN_TransferLearning/0_data/mdadi_labels_binary_oh.npy'
+pretreatment_files = ['H:/HN_TransferLearning/0_data/cancer_site.npy',
+                      'H:/HN_TransferLearning/0_data/alcohol_intake.npy',
+                      'H:/HN_TransferLearning/0_data/smoking_history.npy',
+                      'H:/HN_TransferLearning/0_data/n_stage.npy',
+                      'H:/HN_TransferLearning/0_data/t_stage.npy']
+
+# View, slice and backbone, as in Transfer_Learning_OP.ipynb.
+views = [('sagittal', 150, 'EfficientNetB0'),
+         ('coronal', 120, 'EfficientNetB1'),
+         ('axial', 130, 'EfficientNetB2')]
+
+# Head training.
+learning_rates = [1e-2, 3e-3, 1e-3, 3e-4, 1e-4]
+epochs = 200
+batch_size = 64
+split_seed = 0
+
+
+def encode_pretreatment(files):
+    '''
+    One-hot encoded pre-treatment factors, one block of columns per file
+    (same as the OneHotEncoder in the notebooks).
+    '''
+    blocks = [pd.get_dummies(np.load(f, allow_pickle = True).ravel()).values
+              for f in files]
+
+    return np.concatenate(blocks, axis = 1).astype(np.float32)
+
+
+def view_features():
+    '''
+    Embeddings of every view, computed only if not cached.
+    '''
+    cache = VolumeCache(cache_dir, cache_max_gb)
+
+    features = []
+    for name, index, backbone in views:
+        start = time.time()
+        features.append(cached_backbone_features(
+            cache, f'{wd}{name}_set_{index}.npy', backbone,
+            preprocessing = {'version': feature_version}))
+        print(f'...{name} {index} {backbone}: {features[-1].shape} '
+              f'in {time.time() - start:.1f} s.')
+
+    return features
+
+
+def train_head(data, train, val, learning_rate):
+    import tensorflow as tf
+
+    num_class = int(len(np.unique(data.labels)))
+    pretreatment_dim = None if data.pretreatment is None else data.pretreatment.shape[1]
+    model = feature_head([view.shape[1] for view in data.views], num_class, pretreatment_dim)
+
+    model.compile(optimizer = tf.keras.optimizers.Adam(learning_rate = learning_rate),
+                  loss = 'sparse_categorical_crossentropy',
+                  metrics = ['accuracy'])
+    early_stop = tf.keras.callbacks.EarlyStopping(monitor = 'val_loss', patience = 20,
+                                                  restore_best_weights = True)
+    model.fit(*data.batch(train), batch_size = batch_size, epochs = epochs, verbose = 0,
+              callbacks = [early_stop], validation_data = data.batch(val))
+
+    return model
+
+
+if __name__ == "__main__":
+
+    os.makedirs(output, exist_ok = True)
+
+    print('Backbone features...')
+    features = view_features()
+
+    data = SliceDataset(features, np.load(label_file),
+                        encode_pretreatment(pretreatment_files), dtype = None)
+    train, val, test = data.split(seed = split_seed)
+
+    print('Training heads...')
+    results, best = [], None
+    for learning_rate in learning_rates:
+        start = time.time()
+        model = train_head(data, train, val, learning_rate)
+        val_loss, val_acc = model.evaluate(*data.batch(val), verbose = 0)
+        results.append({'learning rate': learning_rate, 'val loss': val_loss,
+                        'val accuracy': val_acc, 'seconds': time.time() - start})
+        print(f'...learning rate {learning_rate}: val loss {val_loss:.3f}, '
+              f'val accuracy {val_acc:.3f}.')
+
+        if best is None or val_loss < best[0]:
+            best = (val_loss, learning_rate, model)
+
+    val_loss, learning_rate, model = best
+    test_loss, test_acc = model.evaluate(*data.batch(test), verbose = 0)
+    print(f'Best learning rate {learning_rate}: test loss {test_loss:.3f}, '
+          f'test accuracy {test_acc:.3f}.')
+
+    model.save(output + 'feature_head.h5')
+    pd.DataFrame(results).to_csv(output + 'head_sweep.csv', index = False)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the array-based registration_shift against the original deque
+implementation on a 512 x 512 x 512 volume.
+
+The old implementation is kept here (legacy_registration_shift) so the
+comparison can be rerun, and to check the results are bit-identical.
+The legacy version takes several minutes at full size.
+
+"""
+
+import numpy as np
+import time
+from collections import deque
+
+from dicomMethods import *
+
+
+def legacy_registration_shift(img, extra_shift, deformation):
+    # Original implementation from dicomMethods, before vectorization.
+    X_shift =  int(np.round(deformation[0] + extra_shift[0]))
+    Y_shift =  int(np.round(deformation[1] + extra_shift[1]))
+    Z_shift =  int(np.round(deformation[2] + extra_shift[2]))
+
+    l3 = []
+    for k in range(len(img)):
+        l1 = []
+        for i in range(img[0].shape[0]):
+            items = deque(img[k][i])
+            items.rotate(Z_shift)
+            l1.append(items)
+
+        temp = np.array(l1, dtype = np.float32)
+        l2 = []
+        for j in range(img[0].shape[1]):
+            test = np.transpose(temp)
+            items = deque(test[j])
+            items.rotate(Y_shift)
+            l2.append(items)
+
+        temp2 = np.array(l2, dtype = np.float32)
+        l3.append(np.transpose(temp2))
+
+    items = deque(l3)
+    items.rotate(X_shift)
+    return np.array(items, dtype = np.float32)
+
+
+def time_call(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    shape = (512, 512, 512)
+    run_legacy = True
+
+    extra_shift = np.array([12.4, -37.6, 101.2])
+    deformation = np.array([-3.0, 5.0, 0.0])
+
+    rng = np.random.default_rng(0)
+    img = rng.normal(size = shape).astype(np.float32)
+
+    print(f'Benchmarking registration_shift on {shape} volume.')
+
+    new, t_new = time_call(registration_shift, img, extra_shift, deformation)
+    print(f'...vectorized (new array):  {t_new:.2f} s')
+
+    out = np.empty(shape, dtype = np.float32)
+    _, t_out = time_call(registration_shift, img, extra_shift, deformation, out = out)
+    print(f'...vectorized (out=):       {t_out:.2f} s')
+
+    inplace = img.copy()
+    _, t_inplace = time_call(registration_shift, inplace, extra_shift, deformation, out = inplace)
+    print(f'...vectorized (in place):   {t_inplace:.2f} s')
+
+    _, t_zero = time_call(registration_shift, img, extra_shift, deformation, mode = 'constant', out = out)
+    print(f'...vectorized (zero-fill):  {t_zero:.2f} s')
+
+    _, t_sub = time_call(registration_shift, img, extra_shift, deformation, out = out, subvoxel = True)
+    print(f'...sub-voxel (linear):      {t_sub:.2f} s')
+
+    assert np.array_equal(new, inplace), 'In-place shift does not match.'
+
+    if run_legacy:
+        old, t_old = time_call(legacy_registration_shift, img, extra_shift, deformation)
+        print(f'...legacy deque:            {t_old:.2f} s')
+        print(f'Bit-identical: {np.array_equal(old, new)}')
+        print(f'Speed-up: {t_old / t_new:.0f}x')
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the dicomMethods hot paths on synthetic DICOM data.
+
+A synthetic CT series, RTDOSE arcs, RTSTRUCT (a set of ellipsoids) and
+RTPLAN of the chosen size are written with pydicom into data_dir, once per
+size, so no patient data or network access is needed. Each benchmark is
+timed over `repeats` runs (best and median) and run once more under
+tracemalloc for its peak memory (numpy and Python allocations).
+
+Results are appended to results_file as JSON lines tagged with the git
+commit, so runs on different commits can be compared (see compare, or set
+compare_with). Benchmarks that fail are recorded with their error, and ones
+the commit under test has no function or input for are recorded as missing.
+
+benchmark_registration_shift.py compares registration_shift against the
+original deque implementation.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pydicom
+import scipy
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import dicomMethods
+
+
+# 'small' for a quick check, 'full' for a realistic head and neck case.
+size = 'full'
+repeats = 3
+
+data_dir = os.path.join(tempfile.gettempdir(), 'dicomMethods_benchmark')
+results_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'benchmark_results.jsonl')
+
+only = None # List of benchmark names to run, None for all.
+compare_with = None # Commit to compare this run against.
+
+# Grids are [Z, Y, X] with spacing in mm. new_dim, shape, crop and shift
+# are the resize_image / registration_shift / transform_image settings,
+# 'full' as in 05_Dose_to_Image.py and 'small' scaled down with the CT.
+sizes = {'small': {'ct': (50, 128, 128), 'ct_spacing': (2.5, 0.98, 0.98),
+                   'dose': (40, 50, 50), 'dose_spacing': (2.5, 2.5, 2.5),
+                   'arcs': 2, 'structures': 10,
+                   'new_dim': [188] * 3, 'shape': [128] * 3,
+                   'crop': [(37,112),(34,109),(53,128)], 'shift': [3.1, -9.4, 25.3]},
+         'full': {'ct': (200, 512, 512), 'ct_spacing': (2.5, 0.98, 0.98),
+                  'dose': (90, 110, 120), 'dose_spacing': (2.5, 2.5, 2.5),
+                  'arcs': 2, 'structures': 30,
+                  'new_dim': [750] * 3, 'shape': [512] * 3,
+                  'crop': [(150,450),(135,435),(212,512)], 'shift': [12.4, -37.6, 101.2]}}
+
+targets = ['PTV70', 'PTV63', 'PTV56', 'CTV70', 'CTV63', 'CTV56']
+oars = ['BRAINSTEM', 'SPINALCORD', 'PAROTID_L', 'PAROTID_R', 'MANDIBLE',
+        'LARYNX', 'ORALCAVITY', 'ESOPHAGUS', 'PHARYNX']
+
+rx = 70.0
+
+
+#-----------------------------------------------------------------------------
+# Synthetic DICOM.
+#-----------------------------------------------------------------------------
+
+def _save(ds, path, sop_class):
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = sop_class
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.SOPClassUID = sop_class
+    ds = FileDataset(path, ds, file_meta = ds.file_meta, preamble = b'\0' * 128)
+    if int(pydicom.__version__.split('.')[0]) < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+    ds.save_as(path)
+
+
+def _header(modality, patient):
+    ds = Dataset()
+    ds.Modality = modality
+    ds.PatientID = patient['id']
+    ds.PatientName = 'BENCHMARK'
+    ds.StudyInstanceUID = patient['study']
+    ds.FrameOfReferenceUID = patient['frame']
+    ds.SOPInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    return ds
+
+
+def ct_origin(config):
+    # CT centred on the patient origin, first slice at the bottom.
+    nz, ny, nx = config['ct']
+    dz, dy, dx = config['ct_spacing']
+    return np.array([-nx * dx / 2, -ny * dy / 2, -nz * dz / 2])
+
+
+def make_ct(path, config, patient, seed = 0):
+    '''
+    CT series: an elliptical body of soft tissue with a bony spine, air
+    around it and the -2000 padding value outside the scan circle.
+    '''
+    os.makedirs(path, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    nz, ny, nx = config['ct']
+    dz, dy, dx = config['ct_spacing']
+    origin = ct_origin(config)
+    series = generate_uid()
+
+    y, x = np.mgrid[:ny, :nx]
+    x = origin[0] + x * dx
+    y = origin[1] + y * dy
+    body = (x / 180) ** 2 + (y / 130) ** 2 < 1
+    spine = (x ** 2 + (y - 60) ** 2) < 15 ** 2
+    outside = x ** 2 + y ** 2 > (min(nx * dx, ny * dy) / 2) ** 2
+
+    for k in range(nz):
+        hu = np.full((ny, nx), -1000.0)
+        hu[body] = 40
+        hu[spine] = 700
+        hu += rng.normal(0, 20, (ny, nx))
+        pixels = np.round(hu + 1024).astype(np.int16)
+        pixels[outside] = -2000
+
+        ds = _header('CT', patient)
+        ds.SeriesInstanceUID = series
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [float(origin[0]), float(origin[1]), float(origin[2] + k * dz)]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [dy, dx]
+        ds.SliceThickness = dz
+        ds.SliceLocation = float(origin[2] + k * dz)
+        ds.Rows, ds.Columns = ny, nx
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.RescaleIntercept = -1024
+        ds.RescaleSlope = 1
+        ds.PixelData = pixels.tobytes()
+        _save(ds, os.path.join(path, f'CT.{k:04d}.dcm'), '1.2.840.10008.5.1.4.1.1.2')
+
+    return series
+
+
+def make_dose(path, config, patient, plan_uid, seed = 0):
+    '''
+    RTDOSE arcs: a smooth high dose region around the origin on a low dose
+    bath, split evenly over config['arcs'] files.
+    '''
+    os.makedirs(path, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    nz, ny, nx = config['dose']
+    dz, dy, dx = config['dose_spacing']
+    origin = -np.array([nx * dx, ny * dy, nz * dz]) / 2
+
+    z, y, x = np.mgrid[:nz, :ny, :nx].astype(np.float32)
+    r2 = (((x * dx + origin[0]) / 40) ** 2 + ((y * dy + origin[1]) / 35) ** 2 +
+          ((z * dz + origin[2]) / 50) ** 2)
+    dose = rx * 1.05 * np.exp(-r2 ** 2) + 10 * np.exp(-r2 / 8)
+    dose *= 1 + 0.01 * rng.normal(size = dose.shape).astype(np.float32)
+    dose = np.clip(dose, 0, None) / config['arcs']
+
+    scaling = 1e-5
+    files = []
+    for arc in range(config['arcs']):
+        ds = _header('RTDOSE', patient)
+        ds.ImagePositionPatient = [float(v) for v in origin]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [dy, dx]
+        ds.GridFrameOffsetVector = [k * dz for k in range(nz)]
+        ds.NumberOfFrames = nz
+        ds.FrameIncrementPointer = 0x3004000C
+        ds.Rows, ds.Columns = ny, nx
+        ds.BitsAllocated = 32
+        ds.BitsStored = 32
+        ds.HighBit = 31
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.DoseGridScaling = scaling
+        ds.DoseUnits = 'GY'
+        ds.DoseType = 'PHYSICAL'
+        ds.DoseSummationType = 'BEAM'
+        ref = Dataset()
+        ref.ReferencedSOPInstanceUID = plan_uid
+        ds.ReferencedRTPlanSequence = Sequence([ref])
+        ds.PixelData = np.round(dose / scaling).astype(np.uint32).tobytes()
+
+        f = os.path.join(path, f'RD.BENCH.PLAN.{arc}.dcm')
+        _save(ds, f, '1.2.840.10008.5.1.4.1.1.481.2')
+        files.append(f)
+
+    return files
+
+
+def make_struct(path, config, patient, series, seed = 0, points = 64):
+    '''
+    RTSTRUCT of config['structures'] ellipsoids inside the dose grid, with
+    a contour on every CT slice they cross. Named after targets and oars,
+    then STRUCT_n.
+    '''
+    rng = np.random.default_rng(seed)
+    nz = config['ct'][0]
+    dz = config['ct_spacing'][0]
+    z_ct = ct_origin(config)[2] + dz * np.arange(nz)
+    extent = np.array(config['dose'][::-1]) * np.array(config['dose_spacing'][::-1]) / 2
+
+    names = targets + oars
+    names = (names + [f'STRUCT_{n}' for n in range(config['structures'])])[:config['structures']]
+    t = np.linspace(0, 2 * np.pi, points, endpoint = False)
+
+    ds = _header('RTSTRUCT', patient)
+    ds.StructureSetLabel = 'BENCH'
+    rois, roi_contours = [], []
+    for n, name in enumerate(names):
+        radius = rng.uniform(5, 40, 3)
+        centre = rng.uniform(-1, 1, 3) * np.maximum(extent - radius - 5, 0)
+
+        contours = []
+        for z in z_ct[np.abs(z_ct - centre[2]) < radius[2]]:
+            scale = np.sqrt(1 - ((z - centre[2]) / radius[2]) ** 2)
+            contour = Dataset()
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = points
+            xyz = np.stack([centre[0] + scale * radius[0] * np.cos(t),
+                            centre[1] + scale * radius[1] * np.sin(t),
+                            np.full(points, z)], axis = 1)
+            contour.ContourData = [float(v) for v in xyz.ravel()]
+            contours.append(contour)
+
+        roi = Dataset()
+        roi.ROINumber = n + 1
+        roi.ROIName = name
+        rois.append(roi)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = n + 1
+        roi_contour.ROIDisplayColor = [int(c) for c in rng.integers(0, 255, 3)]
+        roi_contour.ContourSequence = Sequence(contours)
+        roi_contours.append(roi_contour)
+
+    ds.StructureSetROISequence = Sequence(rois)
+    ds.ROIContourSequence = Sequence(roi_contours)
+
+    ref_series = Dataset()
+    ref_series.SeriesInstanceUID = series
+    study = Dataset()
+    study.RTReferencedSeriesSequence = Sequence([ref_series])
+    frame = Dataset()
+    frame.FrameOfReferenceUID = patient['frame']
+    frame.RTReferencedStudySequence = Sequence([study])
+    ds.ReferencedFrameOfReferenceSequence = Sequence([frame])
+
+    _save(ds, path, '1.2.840.10008.5.1.4.1.1.481.3')
+    return ds
+
+
+def make_plan(path, patient, struct_uid):
+    ds = _header('RTPLAN', patient)
+    ds.RTPlanLabel = 'PLAN'
+    fraction_group = Dataset()
+    fraction_group.NumberOfBeams = 2
+    ds.FractionGroupSequence = Sequence([fraction_group])
+    dose_ref = Dataset()
+    dose_ref.DeliveryMaximumDose = rx
+    ds.DoseReferenceSequence = Sequence([dose_ref])
+    ref = Dataset()
+    ref.ReferencedSOPInstanceUID = struct_uid
+    ds.ReferencedStructureSetSequence = Sequence([ref])
+
+    _save(ds, path, '1.2.840.10008.5.1.4.1.1.481.5')
+    return ds
+
+
+def make_case(path, config, seed = 0):
+    '''
+    Write a complete synthetic case to path (skipped if already there).
+    '''
+    done = os.path.join(path, 'done')
+    if os.path.exists(done):
+        return
+    print(f'Writing synthetic case to {path}...')
+
+    patient = {'id': 'BENCH', 'study': generate_uid(), 'frame': generate_uid()}
+    series = make_ct(os.path.join(path, 'ct'), config, patient, seed)
+    struct = make_struct(os.path.join(path, 'RS.BENCH.BENCH.dcm'), config, patient, series, seed)
+    plan = make_plan(os.path.join(path, 'RP.BENCH.PLAN.dcm'), patient, struct.SOPInstanceUID)
+    make_dose(os.path.join(path, 'dose'), config, patient, plan.SOPInstanceUID, seed)
+
+    with open(done, 'w') as f:
+        json.dump(config, f)
+
+
+#-----------------------------------------------------------------------------
+# Benchmarks.
+#-----------------------------------------------------------------------------
+
+def quiet(func, *args, **kwargs):
+    # Several dicomMethods functions print per structure.
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def read_ct(ct_dir):
+    '''
+    HU volume [X,Y,Z] of the synthetic series, read with pydicom only so
+    the inputs do not depend on the commit under test. Same slice order
+    and padding as load_scan + get_pixels_hu.
+    '''
+    slices = [pydicom.dcmread(os.path.join(ct_dir, f)) for f in os.listdir(ct_dir)]
+    slices.sort(key = lambda s: int(s.InstanceNumber), reverse = True)
+
+    image = np.stack([s.pixel_array for s in slices]).astype(np.int16)
+    image[image == -2000] = 0
+    image += np.int16(slices[0].RescaleIntercept)
+
+    return np.swapaxes(image, 0, -1), slices[0].PixelSpacing, slices[0].SliceThickness
+
+
+def benchmarks(path, config):
+    '''
+    Benchmark name -> function of no arguments. Inputs are prepared here,
+    so only the call itself is measured.
+
+    Functions are looked up on dicomMethods, so the suite runs against
+    older commits too: a benchmark whose functions or inputs are not
+    available there is a string saying what is missing instead.
+    '''
+    names = ['load_scan', 'get_pixels_hu', 'load_ct', 'load_dose', 'resample',
+             'resize_image', 'registration_shift', 'transform_image', 'grid_points',
+             'organ_voxels', 'total_rad_calc', 'DVH', 'read_structure',
+             'close_dose_context']
+    fn = {name: getattr(dicomMethods, name, None) for name in names}
+
+    ct_dir = os.path.join(path, 'ct')
+    dose_dir = os.path.join(path, 'dose', '')
+    dose_files = sorted(glob.glob(dose_dir + 'RD.*'))
+    struct = pydicom.dcmread(os.path.join(path, 'RS.BENCH.BENCH.dcm'))
+    plan = pydicom.dcmread(os.path.join(path, 'RP.BENCH.PLAN.dcm'))
+    dose_list = [pydicom.dcmread(f) for f in dose_files]
+    ct_img, ct_ps, ct_thick = read_ct(ct_dir)
+    shift = np.array(config['shift'])
+    deformation = np.array([-3.0, 5.0, 0.0])
+
+    # Inputs made with dicomMethods, and why any could not be made.
+    inputs, missing = {}, {}
+    def prepare(name, needs, make):
+        absent = [n for n in needs if fn.get(n) is None and n not in inputs]
+        if absent:
+            missing[name] = f'missing {", ".join(absent)}'
+            return
+        try:
+            inputs[name] = make()
+        except Exception as e:
+            missing[name] = f'{type(e).__name__}: {e}'
+
+    prepare('resampled', ['resample'], lambda: fn['resample'](ct_img, ct_thick, ct_ps))
+    prepare('resized', ['resize_image', 'resampled'],
+            lambda: fn['resize_image'](inputs['resampled'], config['new_dim'], config['shape']))
+    prepare('organs', ['read_structure'], lambda: list(quiet(
+        fn['read_structure'], struct, dose_list, plan, targets, oars).values()))
+    prepare('points', ['grid_points'], lambda: fn['grid_points'](dose_list))
+
+    def read_structures():
+        if fn['close_dose_context'] is not None:
+            fn['close_dose_context']()
+        quiet(fn['read_structure'], struct, dose_list, plan, targets, oars)
+
+    # (benchmark, dicomMethods functions and inputs it needs, function)
+    specs = [
+        ('load_scan', ['load_scan', 'get_pixels_hu'],
+         lambda: fn['get_pixels_hu'](fn['load_scan'](ct_dir))),
+        ('load_ct', ['load_ct'], lambda: fn['load_ct'](ct_dir)),
+        ('load_dose', ['load_dose'], lambda: fn['load_dose'](dose_dir)),
+        ('resample', ['resample'], lambda: fn['resample'](ct_img, ct_thick, ct_ps)),
+        ('resize_image', ['resize_image', 'resampled'],
+         lambda: fn['resize_image'](inputs['resampled'], config['new_dim'], config['shape'])),
+        ('registration_shift', ['registration_shift', 'resized'],
+         lambda: fn['registration_shift'](inputs['resized'], shift, deformation)),
+        ('transform_image', ['transform_image'],
+         lambda: fn['transform_image'](ct_img, ct_thick, ct_ps, shift, deformation,
+                                       crop = config['crop'], shape = config['shape'])),
+        ('organ_voxels', ['organ_voxels', 'organs', 'points'],
+         lambda: [fn['organ_voxels'](organ, inputs['points']) for organ in inputs['organs']]),
+        ('total_rad_calc', ['total_rad_calc', 'organs'],
+         lambda: [fn['total_rad_calc'](dose_list, organ['voxels']) for organ in inputs['organs']]),
+        ('DVH', ['DVH', 'organs'], lambda: [fn['DVH'](organ) for organ in inputs['organs']]),
+        ('read_structure', ['read_structure'], read_structures),
+    ]
+
+    cases = {}
+    for name, needs, func in specs:
+        absent = [n for n in needs if n in fn and fn[n] is None]
+        failed = [f'{n} ({missing[n]})' for n in needs if n in missing]
+        if absent:
+            cases[name] = f'missing {", ".join(absent)}'
+        elif failed:
+            cases[name] = f'missing input {", ".join(failed)}'
+        else:
+            cases[name] = func
+
+    if not hasattr(pydicom, 'read_file'):
+        cases['load_scan'] = 'skipped: load_scan uses pydicom.read_file, removed in pydicom 3'
+
+    return cases
+
+
+def measure(func, repeats = repeats):
+    '''
+    Wall times of `repeats` calls, and the peak traced memory of one more.
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return times, peak
+
+
+def git_commit():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = here,
+                                capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd = here,
+                               capture_output = True, text = True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(size = size, repeats = repeats, only = only):
+    '''
+    Run the benchmarks for one size and append the results to results_file.
+    '''
+    config = sizes[size]
+    path = os.path.join(data_dir, size)
+    make_case(path, config)
+
+    print(f'Preparing {size} inputs...')
+    cases = benchmarks(path, config)
+    if only is not None:
+        cases = {name: cases[name] for name in only}
+
+    run = {'commit': git_commit(), 'size': size, 'config': config, 'repeats': repeats,
+           'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': platform.node(),
+           'processor': platform.processor(), 'cpus': os.cpu_count(),
+           'python': platform.python_version(), 'numpy': np.__version__,
+           'scipy': scipy.__version__, 'pydicom': pydicom.__version__}
+
+    records = []
+    for name, func in cases.items():
+        record = dict(run, benchmark = name)
+        if isinstance(func, str):
+            record['missing'] = func
+            print(f'...{name:20s} {func}')
+            records.append(record)
+            continue
+        try:
+            times, peak = measure(func, repeats)
+            record.update(best = min(times), median = float(np.median(times)),
+                          peak_mb = peak / 2**20)
+            print(f'...{name:20s} {min(times):8.3f} s  {peak / 2**20:8.1f} MB')
+        except Exception as e:
+            record['error'] = f'{type(e).__name__}: {e}'
+            print(f'...{name:20s} failed: {record["error"]}')
+        records.append(record)
+
+    with open(results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, default = str) + '\n')
+
+    return records
+
+
+def compare(base, head = None, size = size, results_file = results_file):
+    '''
+    Table of the latest results of two commits (head defaults to the most
+    recent run) with the head / base ratio of time and peak memory.
+    '''
+    results = pd.read_json(results_file, lines = True, convert_dates = False)
+    results = results[results['size'] == size]
+    if head is None:
+        head = results['commit'].iloc[-1]
+
+    latest = results.groupby(['commit', 'benchmark']).last()
+    table = pd.DataFrame({'base s': latest.loc[base, 'best'],
+                          'head s': latest.loc[head, 'best'],
+                          'base MB': latest.loc[base, 'peak_mb'],
+                          'head MB': latest.loc[head, 'peak_mb']})
+    table['time ratio'] = table['head s'] / table['base s']
+    table['memory ratio'] = table['head MB'] / table['base MB']
+
+    return table
+
+
+if __name__ == "__main__":
+
+    run_benchmarks()
+
+    if compare_with is not None:
+        print(f'\nCompared with {compare_with}:')
+        print(compare(compare_with))
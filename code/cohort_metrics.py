@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Batch DVH metrics for a whole cohort, without any console interaction.
+
+Each case is a (patient, structure set, plan name) tuple, the same as the
+arguments of load_dcm. Cases run in a process pool. Each finished case is
+written to its own CSV in output_dir, so a rerun only processes the cases
+that are missing. All cases are then combined into one table with a row
+per patient and structure (cohort_metrics.csv).
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dicomMethods import *
+
+
+data_dir = 'H:/HN_TransferLearning/0_data/rt/'
+output_dir = 'H:/HN_TransferLearning/2_output/cohort_metrics/'
+
+# DicomCatalogue of data_dir, so load_dcm does not rely on ARIA filenames.
+# None to find the files by filename.
+catalogue_file = 'H:/HN_TransferLearning/0_data/dicom_catalogue.sqlite'
+
+# List of (patient, structure set, plan name), as used by load_dcm.
+cases_file = 'H:/HN_TransferLearning/0_data/cases.csv'
+
+targets = ['PTV70', 'PTV63', 'PTV56', 'CTV70', 'CTV63', 'CTV56']
+oars = ['BRAINSTEM', 'SPINALCORD', 'PAROTID_L', 'PAROTID_R', 'MANDIBLE',
+        'LARYNX', 'ORALCAVITY', 'ESOPHAGUS', 'PHARYNX']
+
+vxx = (95, 100, 105)
+
+max_workers = None # None to use every core.
+
+
+def case_file(case):
+    pt, strctSet, plan_name = case
+    return os.path.join(output_dir, f'metrics_{pt}_{strctSet}_{plan_name}.csv')
+
+
+def case_metrics(case):
+    '''
+    Worker: metrics table for one (patient, structure set, plan) case.
+    '''
+    pt, strctSet, plan_name = case
+    catalogue = DicomCatalogue(catalogue_file) if catalogue_file else None
+    struct, dose, plan = load_dcm(pt, strctSet, plan_name, data_dir, catalogue)
+    if catalogue is not None:
+        catalogue.close()
+
+    rows = structure_metrics(struct, dose, plan, targets, oars, vxx = vxx)
+    close_dose_context()
+
+    table = pd.DataFrame(rows)
+    table.insert(0, 'plan', plan_name)
+    table.insert(0, 'structure set', strctSet)
+    table.insert(0, 'patient', pt)
+
+    return table
+
+
+def cohort_metrics(cases, max_workers = max_workers):
+    '''
+    Run case_metrics over every case that has no output yet, then
+    combine all case tables into cohort_metrics.csv.
+    '''
+    todo = [case for case in cases if not os.path.exists(case_file(case))]
+    print(f'{len(cases) - len(todo)} case(s) already done, {len(todo)} to run.')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers = max_workers) as pool:
+        futures = {pool.submit(case_metrics, case): case for case in todo}
+
+        for future in as_completed(futures):
+            case = futures[future]
+            try:
+                table = future.result()
+            except Exception:
+                print(f'...{case} failed:\n{traceback.format_exc()}')
+                failed.append(case)
+                continue
+
+            # Write then rename, so a partial file is never taken as done.
+            tmp = case_file(case) + '.tmp'
+            table.to_csv(tmp, index = False)
+            os.replace(tmp, case_file(case))
+            print(f'...{case} finished ({len(table)} structures).')
+
+    tables = [pd.read_csv(case_file(case)) for case in cases
+              if os.path.exists(case_file(case))]
+    if tables:
+        pd.concat(tables, ignore_index = True).to_csv(
+            os.path.join(output_dir, 'cohort_metrics.csv'), index = False)
+
+    return failed
+
+
+if __name__ == "__main__":
+
+    os.makedirs(output_dir, exist_ok = True)
+    if catalogue_file:
+        catalogue = DicomCatalogue(catalogue_file)
+        added, removed = catalogue.update(data_dir)
+        catalogue.close()
+        print(f'Catalogue updated: {added} file(s) indexed, {removed} removed.')
+    cases = [tuple(str(v) for v in row) for row in
+             pd.read_csv(cases_file)[['patient', 'structure set', 'plan']].values]
+
+    start = time.time()
+    failed = cohort_metrics(cases)
+    print(f'Finished {len(cases)} case(s) in {(time.time() - start) / 60:.1f} minutes.')
+
+    if failed:
+        print(f'{len(failed)} case(s) failed, rerun to retry:')
+        print(failed)
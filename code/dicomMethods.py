@@ -13,13 +13,28 @@
 ###############################################################################
 
 #SYSTEM IMPORTS
+import collections
+import contextlib
 import copy
 import csv
+import functools
 import os
 import glob
+import hashlib
+import itertools
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 #DICOM PROCESSING IMPORTS
 import pydicom
+import pydicom.misc
 #from dicompylercore import dvh, dvhcalc, dicomparser
 
 #DATA PROCESSING IMPORTS
@@ -28,15 +43,158 @@ import pandas as pd
 import scipy as sp
 import scipy.stats as spstat
 import scipy.spatial.distance as spdist
+from scipy.spatial import cKDTree
 import scipy.interpolate as interp
+from scipy import ndimage
 from scipy.ndimage import label, morphology, interpolation
-from collections import deque
 
 #PLOTTING IMPORTS
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 
+###############################################################################
+############################### INSTRUMENTATION ###############################
+###############################################################################
+
+# Off unless start_profiling is called. Also read from the environment, so
+# worker processes started with spawn (Windows) log as well.
+_profile_log = os.environ.get('DICOM_PROFILE_LOG')
+_profile_state = threading.local()
+_profile_ids = itertools.count()
+
+def start_profiling(log_file):
+    '''
+    Append a JSON line per profiled call and profile block to log_file,
+    from this process and any worker processes started after this.
+    '''
+    global _profile_log
+    _profile_log = log_file
+    os.environ['DICOM_PROFILE_LOG'] = log_file
+
+def stop_profiling():
+    global _profile_log
+    _profile_log = None
+    os.environ.pop('DICOM_PROFILE_LOG', None)
+
+@contextlib.contextmanager
+def profile(name, **tags):
+    '''
+    Record the wall time, CPU time, peak RSS and bytes read/written of a
+    block as one JSON line in the profiling log, e.g.
+    
+        with profile('patient', patient = hn_id, stage = '05_dose_to_image'):
+            ...
+    
+    Tags are added to the record and inherited by everything profiled
+    inside the block. Does nothing unless profiling is on.
+    
+    peak_rss is the peak resident memory while the block ran (the process
+    peak so far where it cannot be reset, i.e. outside Linux). read and
+    written count bytes through read/write calls, so memory-mapped access
+    is not included. CPU time is for the whole process (all threads).
+    '''
+    if _profile_log is None:
+        yield
+        return
+    
+    stack = getattr(_profile_state, 'stack', None)
+    if stack is None:
+        stack = _profile_state.stack = []
+    parent = stack[-1] if stack else None
+    if parent is not None:
+        tags = dict(parent['tags'], **tags)
+        # The peak is reset for this block, keep the one so far for the parent.
+        parent['peak'] = max(parent['peak'], _peak_rss())
+    
+    frame = {'id': f'{os.getpid()}-{next(_profile_ids)}', 'tags': tags, 'peak': 0}
+    stack.append(frame)
+    _reset_peak_rss()
+    
+    failed = False
+    io = _io_counters()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        io_end = _io_counters()
+        
+        stack.pop()
+        peak = max(frame['peak'], _peak_rss())
+        if parent is not None:
+            parent['peak'] = max(parent['peak'], peak)
+        
+        record = {'name': name, 'id': frame['id'], 
+                  'parent': parent['id'] if parent is not None else None,
+                  'wall': wall, 'cpu': cpu, 'peak_rss': peak,
+                  'read': io_end[0] - io[0], 'written': io_end[1] - io[1],
+                  'failed': failed, 'pid': os.getpid(), 'time': time.time()}
+        record.update(tags)
+        with open(_profile_log, 'a') as f:
+            f.write(json.dumps(record, default = str) + '\n')
+
+def profiled(func):
+    '''
+    Decorator: profile every call of func under its name (see profile).
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profile_log is None:
+            return func(*args, **kwargs)
+        with profile(func.__qualname__):
+            return func(*args, **kwargs)
+    
+    return wrapper
+
+def profile_summary(log_file):
+    '''
+    Summarise a profiling log: hot spots per function and totals per patient.
+
+    Parameters
+    ----------
+    log_file : string
+        JSON-lines log written by profile.
+
+    Returns
+    -------
+    functions : pandas.DataFrame
+        One row per profiled name, ranked by self time (wall time minus
+        the time of profiled calls inside it) summed over the cohort.
+    patients : pandas.DataFrame
+        One row per patient (and stage) from the 'patient' blocks.
+
+    '''
+    log = pd.read_json(log_file, lines = True, convert_dates = False)
+    
+    children = log.groupby('parent')['wall'].sum()
+    log['self_time'] = log['wall'] - log['id'].map(children).fillna(0)
+    
+    functions = log.groupby('name').agg(
+        calls = ('wall', 'size'), wall = ('wall', 'sum'), self_time = ('self_time', 'sum'),
+        cpu = ('cpu', 'sum'), mean_wall = ('wall', 'mean'), 
+        peak_rss_gb = ('peak_rss', lambda x: x.max() / 2**30),
+        read_gb = ('read', lambda x: x.sum() / 2**30),
+        written_gb = ('written', lambda x: x.sum() / 2**30))
+    functions['share'] = functions['self_time'] / functions['self_time'].sum()
+    functions = functions.sort_values('self_time', ascending = False)
+    
+    blocks = log[log['name'] == 'patient']
+    keys = [k for k in ('patient', 'stage') if k in blocks]
+    patients = blocks.groupby(keys).agg(
+        wall = ('wall', 'sum'), cpu = ('cpu', 'sum'), 
+        peak_rss_gb = ('peak_rss', lambda x: x.max() / 2**30),
+        read_gb = ('read', lambda x: x.sum() / 2**30),
+        written_gb = ('written', lambda x: x.sum() / 2**30),
+        failed = ('failed', 'any'))
+    
+    return functions, patients
+
 ###############################################################################
 #################### 3D Scroller Overlay Class & Method #######################
 ###############################################################################
@@ -104,8 +262,13 @@ def plot3d(image1, image2, axis = 2):
     return tracker
 
 def load_images(patient_id, path = 'H:/HN_TransferLearning/2_output/05_dose_to_image/', plot = True):
-    ct_img = np.load(path + f'ct/ct_image_{patient_id}.npy')
-    dose_img = np.load(path + f'dose/dose_image_{patient_id}.npy')    
+    if os.path.exists(os.path.join(path, 'store', 'index.json')):
+        store = VolumeStore(os.path.join(path, 'store'))
+        ct_img = store.read('ct', patient_id)
+        dose_img = store.read('dose', patient_id)
+    else:
+        ct_img = np.load(path + f'ct/ct_image_{patient_id}.npy')
+        dose_img = np.load(path + f'dose/dose_image_{patient_id}.npy')    
     
     if plot == True :
         track = plot3d(ct_img, dose_img)
@@ -119,6 +282,7 @@ def load_images(patient_id, path = 'H:/HN_TransferLearning/2_output/05_dose_to_i
 
 ''' All of the following have been adjusted by Owen! '''
 
+@profiled
 def load_scan(path):
     '''
     Load the CT slices from a directory. The directory must contain only
@@ -149,36 +313,40 @@ def load_scan(path):
         
     return slices
 
+@profiled
 def load_dose(path):
     '''
     Load all of the dose files in a single path, and sum the dose arrays together.
     Biggest use is when a patient has VMAT arcs in their dose distribution.
+    
+    The files are streamed through sum_dose, so only one decoded dose grid
+    is held in memory at a time.
 
     Parameters
     ----------
-    path : string
-        Path to the dose files.
+    path : string or list
+        Path to the dose files, or a list of dose files
+        (e.g. from DicomCatalogue.case).
 
     Returns
     -------
     dose_sum : numpy.ndarray
-        Summed dose array after importing all of the dose files.
+        Summed dose array (float32) after importing all of the dose files.
     dose_files : list
-        List of the pydicom dose files imported.
+        List of the pydicom dose files imported (headers only).
 
     '''
-    file_paths = glob.glob(path + 'RD.*')
+    if isinstance(path, (list, tuple)):
+        file_paths = list(path)
+    else:
+        file_paths = glob.glob(path + 'RD.*')
     
-    dose_sum = 0
-    dose_files = []
-    for file in file_paths:
-        dose = pydicom.read_file(file)
-        dose_files.append(dose)
-        dose_sum += dose.pixel_array * dose.DoseGridScaling
+    dose_sum, dose_files = sum_dose(file_paths)
         
     return dose_sum, dose_files
 
 
+@profiled
 def get_pixels_hu(scans):
     '''
     Take in the list of scans from load_scan method and scale them using
@@ -209,176 +377,1912 @@ def get_pixels_hu(scans):
     intercept = scans[0].RescaleIntercept
     slope = scans[0].RescaleSlope
     
-    if slope != 1:
-        image = slope * image.astype(np.float32)
-        image = image.astype(np.int16)
+    if slope != 1:
+        image = slope * image.astype(np.float32)
+        image = image.astype(np.int16)
+        
+    image += np.int16(intercept)
+    
+    return np.array(image, dtype=np.int16)
+
+@profiled
+def load_ct(path, workers = None):
+    '''
+    Load a CT series straight into an int16 HU volume. Equivalent to 
+    get_pixels_hu(load_scan(path)), but only the headers are read to sort
+    and check the slices, and pixel data is then decoded in a thread pool
+    directly into a preallocated volume.
+
+    Parameters
+    ----------
+    path : string or list
+        Directory leading to the CT files (CT slices only), or a list
+        of CT files (e.g. from DicomCatalogue.case).
+    workers : int, optional
+        Number of decoding threads. The default is None (ThreadPoolExecutor
+        default).
+
+    Returns
+    -------
+    image : numpy.ndarray
+        HU volume as int16, shape [Z,Y,X], sorted as in load_scan.
+    slices : list
+        Pydicom headers (no pixel data), with SliceThickness set to the
+        spacing between ImagePositionPatient.
+
+    '''
+    if isinstance(path, (list, tuple)):
+        files = list(path)
+    else:
+        files = [os.path.join(path, s) for s in os.listdir(path)]
+    slices = [pydicom.dcmread(f, stop_before_pixels = True) for f in files]
+    
+    # Inverted the sorting to match the dose file.
+    order = sorted(range(len(slices)), reverse = True, 
+                   key = lambda ii: int(slices[ii].InstanceNumber))
+    files = [files[ii] for ii in order]
+    slices = [slices[ii] for ii in order]
+    
+    # Every slice has to share the same grid.
+    for attr in ['Rows', 'Columns', 'PixelSpacing', 'ImageOrientationPatient']:
+        values = set(str(getattr(s, attr, None)) for s in slices)
+        if len(values) > 1:
+            raise ValueError(f'CT slices in {path} have different {attr}: {values}')
+    
+    slice_thickness = slice_spacing(slices)
+    for s in slices:
+        s.SliceThickness = slice_thickness
+    
+    intercept = slices[0].RescaleIntercept
+    slope = slices[0].RescaleSlope
+    
+    image = np.empty((len(slices), slices[0].Rows, slices[0].Columns), dtype = np.int16)
+    
+    def decode(ii):
+        # Same HU conversion as get_pixels_hu, one slice at a time.
+        pixels = pydicom.dcmread(files[ii]).pixel_array.astype(np.int16)
+        pixels[pixels == -2000] = 0
+        if slope != 1:
+            pixels = (slope * pixels.astype(np.float32)).astype(np.int16)
+        pixels += np.int16(intercept)
+        image[ii] = pixels
+    
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        list(pool.map(decode, range(len(slices))))
+    
+    return image, slices
+
+def slice_spacing(slices):
+    '''
+    Spacing between CT slices along the slice normal, from 
+    .ImagePositionPatient (falls back to SliceLocation).
+
+    Parameters
+    ----------
+    slices : list
+        Pydicom CT slices, sorted.
+
+    Returns
+    -------
+    spacing : float
+        Slice spacing in mm.
+
+    '''
+    try:
+        orientation = np.array(slices[0].ImageOrientationPatient, dtype = float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        positions = np.array([s.ImagePositionPatient for s in slices], dtype = float) @ normal
+    except AttributeError:
+        positions = np.array([s.SliceLocation for s in slices], dtype = float)
+    
+    if len(positions) < 2:
+        return float(getattr(slices[0], 'SliceThickness', 0))
+    
+    diffs = np.abs(np.diff(positions))
+    if not np.allclose(diffs, diffs[0], atol = 1e-3):
+        raise ValueError('Non-uniform CT slice spacing detected.')
+    
+    return float(diffs[0])
+
+@profiled
+def resample(image, image_thickness, pixel_spacing): 
+    '''
+    Resampled 3D dose or ct image according to pixel spacing and slice
+    thickness to project it into a 1 mm x 1 mm x 1 mm grid.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Dose file from pixel.array or imported ct scan after get_pixels_hu.
+    image_thickness : pydicom.valuerep.DSfloat
+        Slice thicknes of CT scans.
+    pixel_spacing : pydicom.multival.MultiValue
+        Spacing of pixels in [x,y] directions.
+
+    Returns
+    -------
+    resampled_image : numpy.ndarray
+        Resampled array in 1 mm x 1 mm x 1 mm grid.
+
+    '''
+    # Remade by Owen Feb 24th, 2022.
+    x_pixel = float(pixel_spacing[0])
+    y_pixel = float(pixel_spacing[1])
+    
+    size = np.array([x_pixel, y_pixel, float(image_thickness)])
+
+    # Changed this from 2d interpolation to 3d interpolation.
+    resampled_image = interpolation.zoom(image,size)
+    
+    return resampled_image
+
+@profiled
+def resize_image(image, new_dim = [750,750,750], crop = [512,512,512]):
+    '''
+    Resize the dose or ct file to a common size, after resampling and 
+    before applying registration shifts. Pads at end of the array
+    so the top left pixel remains aligned so shifts are applied correctly.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Input 3D array, typically a dose or ct file.
+    new_dim : TYPE, optional
+        Temporary image pad size. The default is [750,750,750].
+    crop : TYPE, optional
+        Final image cropped size. The default is [512,512,512].
+
+    Returns
+    -------
+    final_image : numpy.ndarray
+        Resized dose or ct file.
+
+    '''
+    # Remade by Owen Feb 24th, 2022.   
+    dim_dif = new_dim - np.array(image.shape)
+    
+    # Pad step to get to new_dim size.
+    pad = ((0,dim_dif[0]),(0,dim_dif[1]),(0,dim_dif[2]))
+    temp_image = np.pad(image,pad_width = pad, mode = 'constant', constant_values = 0)
+
+    # Crop image down to cropped size.
+    final_image = temp_image[:crop[0],:crop[1],:crop[2]]
+    
+    return final_image
+
+@profiled
+def registration_shift(img, extra_shift, deformation, mode = 'wrap', out = None,
+                       subvoxel = False, order = 1):
+    '''     
+    Apply the translational shifts for all three axis. 
+    
+    This will wrap around if the shift exceeds the size of the array.
+    No need to consider pixel_info as they have been resampled into 
+    1mm x 1mm x 1mm grids using resample method.   
+    
+    Need the resize_image applied first. If not, shifts may wrap around.
+    
+    Other change was to swap Z_shift and X_shift operations. I think this
+    works because I swapped the axis before registration, while
+    Fletcher did this operation afterwards.
+    
+    Rewritten to use shift_image, which gives the same result as the old
+    deque rotation for integer shifts without the per-row Python loops.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        Dose or CT file after being processed by resize_image.
+    extra_shift : numpy.ndarray
+        Shift from the alignment of dose and ct files, and aligning
+        the .ImagePositionPatient to reference.
+    deformation : numpy.ndarray
+        Apply the shifts from image registration.
+    mode : string, optional
+        'wrap' to wrap voxels around the border, 'constant' to zero-fill.
+        The default is 'wrap'.
+    out : numpy.ndarray, optional
+        Float32 array to write the result into. Passing img itself
+        shifts in place. The default is None (new array).
+    subvoxel : bool, optional
+        Keep the fractional part of the shifts and interpolate instead of
+        rounding to whole voxels. The default is False.
+    order : int, optional
+        Spline order used for sub-voxel shifts. The default is 1.
+
+    Returns
+    -------
+    numpy.ndarray
+        CT or dose file with the appropriate shifts applied.
+
+    '''
+    shift = np.asarray(deformation, dtype = float) + np.asarray(extra_shift, dtype = float)
+    
+    if not subvoxel:
+        shift = np.round(shift).astype(int)
+    #print (f'Shifted by {shift}.')
+    
+    if out is None:
+        out = np.empty(img.shape, dtype = np.float32)
+    
+    return shift_image(img, shift, mode = mode, out = out, order = order)
+
+def shift_image(img, shift, mode = 'wrap', out = None, order = 1):
+    '''
+    Translate a 3D array by a number of voxels along each axis.
+    
+    Integer shifts are done with block copies, so the result is identical
+    to np.roll (mode = 'wrap') and no intermediate volume is allocated.
+    Fractional shifts are interpolated with scipy.ndimage.shift.
+
+    Parameters
+    ----------
+    img : numpy.ndarray
+        Input array, typically a dose or ct file.
+    shift : array_like
+        Shift in voxels for each axis. Positive values move voxels
+        towards the end of the axis.
+    mode : string, optional
+        'wrap' to wrap voxels around the border, 'constant' to zero-fill.
+        The default is 'wrap'.
+    out : numpy.ndarray, optional
+        Array to write the result into. May be img itself (or a view of
+        exactly the same elements) for an in-place shift; if it only
+        partly overlaps img, img is copied first. The default is None
+        (new array of the same dtype as img).
+    order : int, optional
+        Spline order used for fractional shifts. The default is 1.
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Shifted array.
+
+    '''
+    if mode not in ('wrap', 'constant'):
+        raise ValueError(f"mode must be 'wrap' or 'constant', not {mode!r}.")
+    
+    shift = np.asarray(shift, dtype = float)
+    if out is None:
+        out = np.empty_like(img)
+    
+    # out is img, or views the same elements the same way.
+    inplace = out is img or (out.shape == img.shape and out.strides == img.strides and
+                             out.__array_interface__['data'][0] ==
+                             img.__array_interface__['data'][0])
+    overlap = not inplace and np.shares_memory(out, img)
+    
+    # Fractional shifts need interpolation.
+    if not np.all(shift == np.round(shift)):
+        ndi_mode = 'grid-wrap' if mode == 'wrap' else 'constant'
+        if inplace or overlap:
+            out[...] = ndimage.shift(img, shift, order = order, mode = ndi_mode)
+        else:
+            ndimage.shift(img, shift, output = out, order = order, mode = ndi_mode)
+        return out
+    
+    shift = shift.astype(int)
+    
+    if overlap:
+        img = img.copy()
+    elif inplace:
+        # In place, one axis at a time.
+        for axis, s in enumerate(shift):
+            _shift_axis_inplace(out, s, axis, mode)
+        return out
+    
+    # Each axis splits into (source, destination) block pairs, the
+    # combinations of which cover the whole output.
+    blocks = [_shift_blocks(n, s, mode) for n, s in zip(img.shape, shift)]
+    for axes_blocks in itertools.product(*blocks):
+        src = tuple(b[0] for b in axes_blocks)
+        dst = tuple(b[1] for b in axes_blocks)
+        if any(b is None for b in src):
+            out[dst] = 0
+        else:
+            out[dst] = img[src]
+    
+    return out
+
+@profiled
+def crop_image(image, crop = [(150,450),(135,435),(212,512)]):
+    
+    for ii in range(len(crop)):
+        # print(f'Cropping {ii} axis.')
+        image = image.take(indices = range(*crop[ii]), axis = ii)
+        # The * is the splat operator, unravels the tuple.
+        
+    return image 
+    
+
+def registration_offsets(reg_shift, patient_id):
+    '''
+    Pull the registration shifts for one patient out of the table
+    read from RegistrationShifts.xlsx.
+
+    Parameters
+    ----------
+    reg_shift : pandas.DataFrame
+        Registration table with Patient, X, Y and Z columns.
+    patient_id : string
+        Patient to look up.
+
+    Returns
+    -------
+    deformation : numpy.ndarray
+        [X, Y, Z] registration shifts.
+
+    '''
+    row = reg_shift[reg_shift.Patient == patient_id]
+    
+    return np.array((row.X.values[0], row.Y.values[0], row.Z.values[0]))
+
+def alignment_shifts(ct, dose, baseline):
+    '''
+    Shifts aligning the ct and dose .ImagePositionPatient to the
+    reference position, as used by registration_shift.
+
+    Parameters
+    ----------
+    ct : list
+        CT slices from load_scan.
+    dose : list
+        Dose files from load_dose.
+    baseline : numpy.ndarray
+        Reference .ImagePositionPatient, usually the first slice of HN_002.
+
+    Returns
+    -------
+    ct_shift : numpy.ndarray
+        Extra shift for the ct image.
+    dose_shift : numpy.ndarray
+        Extra shift for the dose image.
+
+    '''
+    ct_pos = np.array(ct[0].ImagePositionPatient)
+    dose_pos = np.array(dose[0].ImagePositionPatient)
+    
+    ct_shift = ct_pos - baseline
+    dose_shift = dose_pos - ct_pos + ct_shift
+    
+    return ct_shift, dose_shift
+
+@profiled
+def transform_image(image, image_thickness, pixel_spacing, extra_shift, deformation,
+                    crop = [(150,450),(135,435),(212,512)], shape = [512,512,512],
+                    order = 3, mode = 'wrap', out = None):
+    '''
+    Single-pass equivalent of resample, resize_image, registration_shift
+    and crop_image. Only the voxels inside the crop box are interpolated,
+    straight from the original image, so no intermediate 750^3 or 512^3
+    volume is ever allocated.
+    
+    Each axis is independent, so the output splits into a handful of boxes
+    (at most 3 per axis: before the wrap, after the wrap and zero padding),
+    each of which is a plain zoom + offset of the input.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Dose file from pixel.array or imported ct scan after get_pixels_hu,
+        swapped to [X,Y,Z].
+    image_thickness : pydicom.valuerep.DSfloat
+        Slice thicknes of the image.
+    pixel_spacing : pydicom.multival.MultiValue
+        Spacing of pixels in [x,y] directions.
+    extra_shift : numpy.ndarray
+        Shift from the alignment of dose and ct files, and aligning
+        the .ImagePositionPatient to reference.
+    deformation : numpy.ndarray
+        Apply the shifts from image registration (RegistrationShifts.xlsx).
+    crop : list, optional
+        Crop box as (start, stop) for each axis, in the resized grid.
+        The default is [(150,450),(135,435),(212,512)]. Use None for 
+        the full resized grid.
+    shape : list, optional
+        Resized grid the shifts are applied in. The default is [512,512,512].
+    order : int, optional
+        Spline order, same as interpolation.zoom. The default is 3.
+    mode : string, optional
+        'wrap' or 'constant' borders, see registration_shift. 
+        The default is 'wrap'.
+    out : numpy.ndarray, optional
+        Float32 array of the crop box size to write into.
+        The default is None (new array).
+
+    Returns
+    -------
+    out : numpy.ndarray
+        Resampled, shifted and cropped image as float32.
+
+    '''
+    step, segments, out_shape = _transform_plan(image.shape, image_thickness, pixel_spacing,
+                                                extra_shift, deformation, crop, shape, mode)
+    
+    if out is None:
+        out = np.zeros(out_shape, dtype = np.float32)
+    else:
+        out[...] = 0
+    
+    if any(len(seg) == 0 for seg in segments):
+        return out
+    
+    # Spline filter the input once instead of once per box.
+    if order > 1:
+        filtered = ndimage.spline_filter(image, order = order, output = np.float64)
+    else:
+        filtered = image
+    
+    # interpolation.zoom keeps integer images (CT) as rounded integers,
+    # so interpolate into the same dtype to round identically.
+    if np.issubdtype(image.dtype, np.integer):
+        target = np.zeros(out.shape, dtype = image.dtype)
+    else:
+        target = out
+    
+    for boxes in itertools.product(*segments):
+        dst = tuple(slice(b[0], b[0] + b[2]) for b in boxes)
+        ndimage.affine_transform(filtered, step, 
+                                 offset = [b[1] * z for b, z in zip(boxes, step)],
+                                 output_shape = tuple(b[2] for b in boxes), 
+                                 output = target[dst], order = order, 
+                                 mode = 'constant', prefilter = False)
+    
+    if target is not out:
+        out[...] = target
+    
+    return out
+
+def transform_slabs(image, image_thickness, pixel_spacing, extra_shift, deformation,
+                    crop = [(150,450),(135,435),(212,512)], shape = [512,512,512],
+                    order = 3, mode = 'wrap', memory_gb = 1.0, halo = None):
+    '''
+    transform_image in slabs along the first axis, for a bounded peak
+    memory. Each output slab is interpolated from the input planes it
+    maps onto, plus a halo on each side for the spline prefilter, which
+    is global in transform_image. The prefilter's influence decays by
+    the spline pole per voxel (0.27 for order 3), so the default halo
+    matches transform_image to float precision.
+
+    Parameters
+    ----------
+    image, image_thickness, pixel_spacing, extra_shift, deformation,
+    crop, shape, order, mode
+        Same as transform_image.
+    memory_gb : float, optional
+        Budget for the working arrays of one slab (input copy, spline
+        coefficients and output). The default is 1.0.
+    halo : int, optional
+        Extra input planes on each side of a slab. The default is None
+        (enough for the prefilter to decay below 1e-12).
+
+    Yields
+    ------
+    start : int
+        First plane of the slab along the first axis of the output.
+    slab : numpy.ndarray
+        Output planes [start, start + len(slab)) as float32.
+
+    '''
+    step, segments, out_shape = _transform_plan(image.shape, image_thickness, pixel_spacing,
+                                                extra_shift, deformation, crop, shape, mode)
+    
+    if halo is None:
+        halo = int(np.ceil(np.log(1e-12) / np.log(_spline_poles[order]))) if order > 1 else 0
+    pad = halo + order + 1
+    
+    integer = np.issubdtype(image.dtype, np.integer)
+    
+    # Bytes per output plane: the float32 output (and integer target) and,
+    # for the input planes it maps onto, the input and float64 coefficients.
+    in_plane = np.prod(image.shape[1:]) * (image.itemsize + 8)
+    out_plane = np.prod(out_shape[1:]) * (4 + image.itemsize * integer)
+    budget = memory_gb * 2**30 - 2 * pad * in_plane
+    planes = int(max(1, budget // (out_plane + step[0] * in_plane)))
+    
+    for start in range(0, out_shape[0], planes):
+        stop = min(start + planes, out_shape[0])
+        slab = np.zeros((stop - start,) + tuple(out_shape[1:]), dtype = np.float32)
+        
+        # Parts of the first axis segments inside this slab.
+        segment0 = []
+        for dst, src, n in segments[0]:
+            lo, hi = max(dst, start), min(dst + n, stop)
+            if lo < hi:
+                segment0.append((lo - start, src + lo - dst, hi - lo))
+        
+        if not segment0 or any(len(seg) == 0 for seg in segments[1:]):
+            yield start, slab
+            continue
+        
+        target = np.zeros(slab.shape, dtype = image.dtype) if integer else slab
+        
+        for b0 in segment0:
+            # Input planes this part maps onto, plus the halo.
+            lo = max(int(np.floor(b0[1] * step[0])) - pad, 0)
+            hi = min(int(np.ceil((b0[1] + b0[2] - 1) * step[0])) + pad + 1, image.shape[0])
+            if order > 1:
+                filtered = ndimage.spline_filter(image[lo:hi], order = order, output = np.float64)
+            else:
+                filtered = image[lo:hi]
+            
+            for boxes in itertools.product([b0], *segments[1:]):
+                dst = tuple(slice(b[0], b[0] + b[2]) for b in boxes)
+                offset = [b[1] * z for b, z in zip(boxes, step)]
+                offset[0] -= lo
+                ndimage.affine_transform(filtered, step, offset = offset,
+                                         output_shape = tuple(b[2] for b in boxes),
+                                         output = target[dst], order = order,
+                                         mode = 'constant', prefilter = False)
+            del filtered
+        
+        if target is not slab:
+            slab[...] = target
+        
+        yield start, slab
+
+def scale_image(image, scale_type = 'min_max'):
+    
+    if scale_type == 'min_max':
+        img_min = image.min()
+        img_max = image.max()
+        
+        scaled_img = 255 * (image - img_min) / (img_max - img_min)
+        
+    return scaled_img
+
+@profiled
+def scale_images(images, dtype = None):
+    '''
+    Batched scale_image: min-max scale every sample of a [N, ...] array to
+    0-255 on its own min and max, in one vectorized pass.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        Stack of images, first axis is the sample.
+    dtype : numpy.dtype, optional
+        Output dtype. np.uint8 rounds to the nearest integer. 
+        The default is None (same as scale_image).
+
+    Returns
+    -------
+    scaled_img : numpy.ndarray
+        Scaled images. Constant images come out as 0 instead of nan.
+
+    '''
+    # Integer input (e.g. int16 CT) is scaled in float64:
+    # in its own dtype the range could overflow and /= would raise.
+    if not np.issubdtype(images.dtype, np.floating):
+        images = images.astype(np.float64)
+    
+    axes = tuple(range(1, images.ndim))
+    img_min = images.min(axis = axes, keepdims = True)
+    img_range = images.max(axis = axes, keepdims = True) - img_min
+    img_range[img_range == 0] = 1
+    
+    scaled_img = images - img_min
+    scaled_img *= 255
+    scaled_img /= img_range
+    
+    if dtype is None:
+        return scaled_img
+    if np.issubdtype(dtype, np.integer):
+        np.rint(scaled_img, out = scaled_img)
+    
+    return scaled_img.astype(dtype, copy = False)
+
+@profiled
+def combine_channels(ct, dose, dtype = None):
+    '''
+    Stack CT, dose and CT+dose slices as the three channels of an image,
+    each min-max scaled to 0-255 per sample.
+    
+    Same layout as the original per-patient loop in 08_Slice_to_TL.py,
+    which transposed each [3, H, W] sample, so the output is [N, W, H, 3].
+
+    Parameters
+    ----------
+    ct : numpy.ndarray
+        [N, H, W] ct slices.
+    dose : numpy.ndarray
+        [N, H, W] dose slices.
+    dtype : numpy.dtype, optional
+        Output dtype, e.g. np.uint8 or np.float16 for smaller files.
+        The default is None (dtype of the inputs).
+
+    Returns
+    -------
+    full_array : numpy.ndarray
+        [N, W, H, 3] array of CT, dose and CT+dose channels.
+
+    '''
+    ct = np.asarray(ct)
+    dose = np.asarray(dose)
+    
+    if dtype is None:
+        dtype = np.result_type(ct, dose)
+    
+    full_array = np.empty((ct.shape[0], ct.shape[2], ct.shape[1], 3), dtype = dtype)
+    for ii, channel in enumerate([ct, dose, dose + ct]):
+        full_array[..., ii] = scale_images(channel, dtype).transpose(0, 2, 1)
+    
+    return full_array
+
+@profiled
+def window_image(image, win_min = -400, win_max = 800):
+    low_mask = image < win_min
+    high_mask = image > win_max
+    
+    image[low_mask] = win_min
+    image[high_mask] = win_max
+    
+    return image    
+
+###############################################################################
+############################### VOLUME STORE ##################################
+###############################################################################
+
+class VolumeCodec(object):
+    '''
+    How a volume is stored on disk: the stored dtype, an optional linear
+    scale, and optional chunked lossless compression.
+
+    Without a scale the stored dtype has to hold the values exactly (e.g.
+    int16 for CT in HU, which stays integer through transform_image and
+    window_image), otherwise encode raises ValueError. With a scale,
+    values are stored as round((value - offset) / scale), so they come
+    back within scale / 2, and values outside the stored range are clipped
+    to it (e.g. uint16 dose with scale = 0.002 Gy and offset = -5 Gy
+    covers about -5 to 126 Gy to 1 mGy). float16 keeps ~3 significant 
+    digits.
+
+    compression is None, 'zlib' (standard library), 'zstd' (zstandard
+    package) or 'blosc' (blosc package). Volumes are compressed in chunks
+    of `chunk` planes along the first axis, so a box or slice along that
+    axis only decompresses the chunks it touches. zlib and zstd chunks are
+    byte-shuffled first, which is what makes them compress well.
+    '''
+    
+    def __init__(self, dtype = 'float32', scale = None, offset = 0.0, 
+                 compression = None, level = 3, chunk = 16):
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.offset = offset
+        self.compression = compression
+        self.level = level
+        self.chunk = chunk
+    
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+    
+    def to_dict(self):
+        return {'dtype': self.dtype.str, 'scale': self.scale, 'offset': self.offset,
+                'compression': self.compression, 'level': self.level, 'chunk': self.chunk}
+    
+    def __eq__(self, other):
+        return isinstance(other, VolumeCodec) and self.to_dict() == other.to_dict()
+    
+    def exact(self, dtype):
+        # Volumes of dtype are stored as they are.
+        return self.scale is None and self.dtype == np.dtype(dtype)
+    
+    def encode(self, volume):
+        '''
+        Volume as stored, raises ValueError if it does not fit the codec
+        (scaled volumes are clipped to the stored range instead).
+        '''
+        volume = np.asarray(volume)
+        if self.scale is not None:
+            volume = np.rint((volume - self.offset) / self.scale)
+            if self.dtype.kind in 'iu':
+                # e.g. spline undershoot below the offset.
+                info = np.iinfo(self.dtype)
+                np.clip(volume, info.min, info.max, out = volume)
+        elif self.dtype.kind in 'iu' and volume.dtype.kind == 'f':
+            if not np.array_equal(np.rint(volume), volume):
+                raise ValueError(f'Volume is not integer valued, cannot store as {self.dtype}.')
+        
+        if self.dtype.kind in 'iu':
+            info = np.iinfo(self.dtype)
+            if volume.size and (volume.min() < info.min or volume.max() > info.max):
+                raise ValueError(f'Volume range [{volume.min()}, {volume.max()}] does not fit '
+                                 f'{self.dtype} with scale {self.scale}.')
+        
+        encoded = volume.astype(self.dtype)
+        if self.dtype.kind == 'f' and not np.isfinite(encoded[np.isfinite(volume)]).all():
+            raise ValueError(f'Volume overflows {self.dtype}.')
+        
+        return encoded
+    
+    def decode(self, stored, dtype = np.float32):
+        '''
+        Stored values back as dtype.
+        '''
+        volume = np.asarray(stored).astype(dtype)
+        if self.scale is not None:
+            volume *= np.dtype(dtype).type(self.scale)
+            volume += np.dtype(dtype).type(self.offset)
+        
+        return volume
+    
+    def compress(self, chunk):
+        data = np.ascontiguousarray(chunk)
+        if self.compression in ('zlib', 'zstd'):
+            # Byte shuffle: all first bytes, then all second bytes...
+            data = data.view(np.uint8).reshape(-1, data.itemsize).T
+        data = np.ascontiguousarray(data).tobytes()
+        
+        if self.compression is None:
+            return data
+        elif self.compression == 'zlib':
+            return zlib.compress(data, self.level)
+        elif self.compression == 'zstd':
+            return _zstd().ZstdCompressor(level = self.level).compress(data)
+        elif self.compression == 'blosc':
+            blosc = _blosc()
+            return blosc.compress(data, typesize = self.dtype.itemsize, 
+                                  clevel = self.level, shuffle = blosc.SHUFFLE)
+        raise ValueError(f'Unknown compression {self.compression}.')
+    
+    def decompress(self, data, shape):
+        if self.compression == 'zlib':
+            data = zlib.decompress(data)
+        elif self.compression == 'zstd':
+            data = _zstd().ZstdDecompressor().decompress(data)
+        elif self.compression == 'blosc':
+            data = _blosc().decompress(data)
+        
+        if self.compression in ('zlib', 'zstd'):
+            data = np.frombuffer(data, np.uint8).reshape(self.dtype.itemsize, -1).T
+            return np.ascontiguousarray(data).view(self.dtype).reshape(shape)
+        return np.frombuffer(data, self.dtype).reshape(shape)
+
+# Storage of the pipeline volumes (05, 06 and score_patients.py). CT is 
+# integer HU, so int16 is exact. Dose is kept in 2 mGy steps from -5 Gy to
+# 126 Gy, well below the 8-bit resolution of the 08 images; spline 
+# undershoot below -5 Gy is clipped.
+pipeline_codecs = {'ct': VolumeCodec('int16', compression = 'zlib'),
+                   'dose': VolumeCodec('uint16', scale = 0.002, offset = -5.0, 
+                                       compression = 'zlib')}
+
+@profiled
+def write_volume(path, volume, codec):
+    '''
+    Save a volume with a VolumeCodec. The file is a JSON header (shape,
+    dtype, codec and chunk offsets) followed by the compressed chunks.
+    Written to a temporary file first, so path is complete or absent.
+    '''
+    volume = np.asarray(volume)
+    writer = VolumeWriter(path, volume.shape, volume.dtype, codec)
+    writer.write(volume)
+    writer.close()
+
+class VolumeWriter(object):
+    '''
+    Write a write_volume file slab by slab along the first axis, so the
+    whole volume is never in memory. At most one codec chunk is held;
+    compressed chunks go to a side file and are copied behind the header
+    by close.
+    '''
+    
+    def __init__(self, path, shape, dtype, codec):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        
+        self._step = codec.chunk or self.shape[0]
+        self._pending = []
+        self._planes = 0
+        self._sizes = []
+        self._data = open(path + '.chunks', 'wb')
+    
+    def write(self, slab):
+        '''
+        Append the next planes of the volume.
+        '''
+        slab = self.codec.encode(np.asarray(slab, dtype = self.dtype))
+        self._planes += len(slab)
+        if self._planes > self.shape[0]:
+            raise ValueError(f'Writing more than {self.shape[0]} planes to {self.path}.')
+        
+        self._pending.append(slab)
+        while self._pending:
+            # Compress full chunks, and the last partial one at the end.
+            pending = sum(len(p) for p in self._pending)
+            if pending < self._step and self._planes < self.shape[0]:
+                break
+            data = np.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+            chunk = self.codec.compress(data[:self._step])
+            self._data.write(chunk)
+            self._sizes.append(len(chunk))
+            self._pending = [data[self._step:]] if len(data) > self._step else []
+    
+    def close(self):
+        self._data.close()
+        if self._planes != self.shape[0]:
+            os.remove(self.path + '.chunks')
+            raise ValueError(f'Only {self._planes} of {self.shape[0]} planes written to {self.path}.')
+        
+        header = {'shape': list(self.shape), 'dtype': self.dtype.str, 
+                  'codec': self.codec.to_dict(),
+                  'offsets': [int(n) for n in np.cumsum([0] + self._sizes)]}
+        header = json.dumps(header).encode()
+        
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f, open(self.path + '.chunks', 'rb') as data:
+            f.write(_volume_magic + len(header).to_bytes(8, 'little') + header)
+            shutil.copyfileobj(data, f, _copy_size)
+        os.replace(tmp, self.path)
+        os.remove(self.path + '.chunks')
+
+@profiled
+def read_volume(path, box = None):
+    '''
+    Load a volume saved by write_volume, or only the sub-box given as
+    (start, stop) per axis. Only the chunks the box touches along the
+    first axis are read and decompressed.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(_volume_magic)) != _volume_magic:
+            raise ValueError(f'{path} is not a volume file.')
+        n = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(n))
+        data_start = f.tell()
+        
+        shape = tuple(header['shape'])
+        codec = VolumeCodec.from_dict(header['codec'])
+        box = [tuple(b) for b in box] if box is not None else [(0, s) for s in shape]
+        step = codec.chunk or shape[0]
+        offsets = header['offsets']
+        
+        first, last = box[0][0] // step, (box[0][1] - 1) // step
+        parts = []
+        for k in range(first, last + 1):
+            f.seek(data_start + offsets[k])
+            planes = min(step, shape[0] - k * step)
+            chunk = codec.decompress(f.read(offsets[k + 1] - offsets[k]), 
+                                     (planes,) + shape[1:])
+            lo = max(box[0][0] - k * step, 0)
+            hi = min(box[0][1] - k * step, planes)
+            parts.append(chunk[(slice(lo, hi),) + tuple(slice(*b) for b in box[1:])])
+    
+    stored = np.concatenate(parts) if len(parts) > 1 else parts[0]
+    
+    return codec.decode(stored, np.dtype(header['dtype']))
+
+class VolumeStore(object):
+    '''
+    On-disk store of same-sized patient volumes, one memory-mapped array
+    per modality. Volumes are opened lazily, so a slice or sub-box can be
+    read without loading the whole volume, and any number of processes can
+    read at once. Each patient slot can be written by a different process.
+
+    Each modality can have a VolumeCodec (e.g. int16 CT, scaled uint16
+    dose); read, slice and volume always give back dtype. Compressed
+    modalities are kept as one write_volume file per patient instead of
+    the memory map.
+
+    Layout of the store directory:
+        index.json           patients, volume shape, dtype, modalities and codecs.
+        {modality}.npy       [patients, X, Y, Z] array (np.load compatible).
+        {modality}/{patient}.vol  compressed volumes (see write_volume).
+        {modality}_written.npy  uint8 flag per patient, set once written.
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        
+        self.patients = list(self.index['patients'])
+        self.shape = tuple(self.index['shape'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.modalities = list(self.index['modalities'])
+        self.codecs = {m: VolumeCodec.from_dict(self.index['codecs'][m]) 
+                       if m in self.index.get('codecs', {}) else VolumeCodec(self.dtype)
+                       for m in self.modalities}
+        
+        self._lookup = {p: i for i, p in enumerate(self.patients)}
+        self._arrays = {}
+    
+    @classmethod
+    def create(cls, path, patients, shape, modalities = ('ct', 'dose'), dtype = np.float32,
+               codecs = None):
+        '''
+        Create an empty store, or open it if it already exists with the
+        same patients, shape, dtype and codecs.
+
+        Parameters
+        ----------
+        path : string
+            Store directory.
+        patients : list
+            Patient IDs, in the order they are stored.
+        shape : list
+            Shape of every volume.
+        modalities : tuple, optional
+            Arrays to create. The default is ('ct', 'dose').
+        dtype : numpy.dtype, optional
+            Volume dtype. The default is np.float32.
+        codecs : dict, optional
+            VolumeCodec per modality. The default stores dtype as is.
+
+        Returns
+        -------
+        VolumeStore
+            The opened store.
+
+        '''
+        codecs = codecs or {}
+        codecs = {m: codecs.get(m, VolumeCodec(dtype)) for m in modalities}
+        index = {'patients': [str(p) for p in patients],
+                 'shape': [int(n) for n in shape],
+                 'dtype': np.dtype(dtype).str,
+                 'modalities': list(modalities),
+                 'codecs': {m: c.to_dict() for m, c in codecs.items()}}
+        
+        if os.path.exists(os.path.join(path, 'index.json')):
+            store = cls(path)
+            if (store.patients != index['patients'] or 
+                    list(store.shape) != index['shape'] or 
+                    store.dtype != np.dtype(dtype) or
+                    store.codecs != codecs):
+                raise ValueError(f'Volume store at {path} exists with a different layout.')
+            return store
+        
+        os.makedirs(path, exist_ok = True)
+        for modality, codec in codecs.items():
+            if codec.compression:
+                os.makedirs(os.path.join(path, modality), exist_ok = True)
+            else:
+                arr = np.lib.format.open_memmap(os.path.join(path, f'{modality}.npy'), mode = 'w+',
+                                                dtype = codec.dtype, 
+                                                shape = (len(patients),) + tuple(shape))
+                del arr
+            np.save(os.path.join(path, f'{modality}_written.npy'), 
+                    np.zeros(len(patients), dtype = np.uint8))
+        
+        # Index last, so a half-created store is never opened.
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(index, f, indent = 1)
+        
+        return cls(path)
+    
+    def _array(self, name, mode = 'r'):
+        if (name, mode) not in self._arrays:
+            self._arrays[(name, mode)] = np.load(os.path.join(self.path, f'{name}.npy'), 
+                                                 mmap_mode = mode)
+        return self._arrays[(name, mode)]
+    
+    def _file(self, modality, patient_id):
+        return os.path.join(self.path, modality, f'{patient_id}.vol')
+    
+    def volume(self, modality, patient_id):
+        '''
+        Memory-mapped volume of one patient, nothing is read until indexed.
+        Modalities stored with a codec are read and decoded in full.
+        '''
+        if not self.codecs[modality].exact(self.dtype) or self.codecs[modality].compression:
+            return self.read(modality, patient_id)
+        
+        return self._array(modality)[self._lookup[str(patient_id)]]
+    
+    @profiled
+    def read(self, modality, patient_id, box = None):
+        '''
+        Read a volume, or only the sub-box given as (start, stop) per axis
+        (same format as crop_image), into memory.
+        '''
+        codec = self.codecs[modality]
+        if codec.compression:
+            return read_volume(self._file(modality, patient_id), box)
+        
+        vol = self._array(modality)[self._lookup[str(patient_id)]]
+        if box is not None:
+            vol = vol[tuple(slice(*b) for b in box)]
+        
+        return codec.decode(vol, self.dtype)
+    
+    def slice(self, modality, patient_id, index, axis):
+        '''
+        Read a single slice, same as volume.take(indices = index, axis = axis).
+        '''
+        box = [(0, n) for n in self.shape]
+        box[axis] = (index, index + 1)
+        
+        return self.read(modality, patient_id, box).take(0, axis = axis)
+    
+    @profiled
+    def write(self, modality, patient_id, volume):
+        '''
+        Write a patient volume and flag it as written.
+        '''
+        ii = self._lookup[str(patient_id)]
+        
+        codec = self.codecs[modality]
+        if codec.compression:
+            write_volume(self._file(modality, patient_id), 
+                         np.asarray(volume, dtype = self.dtype), codec)
+        else:
+            arr = self._array(modality, 'r+')
+            arr[ii] = codec.encode(volume)
+            arr.flush()
+        
+        self._flag(modality, patient_id)
+    
+    def writer(self, modality, patient_id):
+        '''
+        Stream a patient volume in slabs along the first axis: call
+        write(slab) for consecutive slabs, then close() to flag it as
+        written. Only one slab (and codec chunk) is held at a time.
+        '''
+        return _StoreWriter(self, modality, patient_id)
+    
+    def _flag(self, modality, patient_id):
+        flags = self._array(f'{modality}_written', 'r+')
+        flags[self._lookup[str(patient_id)]] = 1
+        flags.flush()
+    
+    def written(self, modality, patient_id):
+        # Not cached, other processes may be writing.
+        flags = np.load(os.path.join(self.path, f'{modality}_written.npy'))
+        
+        return bool(flags[self._lookup[str(patient_id)]])
+    
+    def close(self):
+        for arr in self._arrays.values():
+            if arr.mode == 'r+':
+                arr.flush()
+        self._arrays = {}
+
+
+@profiled
+def source_digest(files):
+    '''
+    SHA-256 of the content of a set of files (e.g. a CT series), in sorted
+    order of their content hashes so file names and order do not matter.
+    '''
+    digests = []
+    for f in files:
+        h = hashlib.sha256()
+        with open(f, 'rb') as fp:
+            for block in iter(lambda: fp.read(2**20), b''):
+                h.update(block)
+        digests.append(h.hexdigest())
+    
+    return hashlib.sha256(''.join(sorted(digests)).encode()).hexdigest()
+
+def cache_key(**parts):
+    '''
+    Key for VolumeCache from named parts (digests, parameters, arrays).
+    Arrays and numpy scalars are hashed by value.
+    '''
+    def plain(v):
+        if isinstance(v, (np.ndarray, np.generic)):
+            return v.tolist()
+        return str(v)
+    
+    text = json.dumps(parts, sort_keys = True, default = plain)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class VolumeCache(object):
+    '''
+    Content-addressed on-disk cache of pipeline outputs. Each entry is a
+    directory named by its key (see cache_key) holding one .npy file per
+    array. Entries are written to a temporary directory and renamed, so a
+    reader only ever sees complete entries, and several processes can
+    share a cache. The modification time of an entry is its last use;
+    once the cache is over max_gb the least recently used are removed.
+    Arrays with a VolumeCodec in codecs are saved with write_volume.
+    '''
+    
+    def __init__(self, path, max_gb = 50, codecs = None):
+        self.path = path
+        self.max_bytes = max_gb * 2**30
+        self.codecs = codecs or {}
+        os.makedirs(path, exist_ok = True)
+    
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+    
+    def get(self, key, mmap_mode = None):
+        '''
+        Arrays stored under key as a dict, or None if not cached.
+        '''
+        entry = self._entry(key)
+        try:
+            arrays = {}
+            for f in os.listdir(entry):
+                if f.endswith('.npy'):
+                    arrays[f[:-4]] = np.load(os.path.join(entry, f), mmap_mode = mmap_mode)
+                elif f.endswith('.vol'):
+                    arrays[f[:-4]] = read_volume(os.path.join(entry, f))
+        except FileNotFoundError:
+            # Not cached, or evicted by another process.
+            return None
+        
+        os.utime(entry)
+        return arrays
+    
+    def put(self, key, **arrays):
+        '''
+        Store arrays under key, then evict down to max_gb.
+        '''
+        tmp = tempfile.mkdtemp(dir = self.path, prefix = '.tmp-')
+        for name, arr in arrays.items():
+            if name in self.codecs:
+                write_volume(os.path.join(tmp, f'{name}.vol'), arr, self.codecs[name])
+            else:
+                np.save(os.path.join(tmp, f'{name}.npy'), arr)
+        
+        try:
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # Written by another process in the meantime.
+            shutil.rmtree(tmp, ignore_errors = True)
+        
+        self.evict()
+    
+    def entries(self):
+        '''
+        (last used, bytes, key) of every entry, least recently used first.
+        '''
+        entries = []
+        for key in os.listdir(self.path):
+            entry = self._entry(key)
+            if key.startswith('.tmp-') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, key))
+            except FileNotFoundError:
+                continue
+        
+        return sorted(entries)
+    
+    def evict(self, max_bytes = None):
+        '''
+        Remove least recently used entries until the cache fits in max_bytes
+        (default max_gb). Returns the removed keys.
+        '''
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        
+        removed = []
+        for used, size, key in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(self._entry(key), ignore_errors = True)
+            total -= size
+            removed.append(key)
+        
+        return removed
+
+###############################################################################
+############################## DICOM CATALOGUE ################################
+###############################################################################
+
+class DicomCatalogue(object):
+    '''
+    SQLite index of every DICOM file under a data tree, built from headers
+    only. Files are indexed by PatientID, Modality, SOP/Series UIDs and the
+    UIDs they reference, so the plan -> dose -> structure -> CT links of a
+    case are found with indexed queries instead of globbing filenames.
+
+    Tables:
+        files   one row per file: path, mtime, size, patient_id, modality,
+                sop_uid, series_uid, study_uid, frame_uid, label.
+        refs    (path, kind, uid) for referenced UIDs: RTDOSE -> 'plan',
+                RTPLAN -> 'structure', RTSTRUCT -> 'series'.
+
+    label is RTPlanLabel, StructureSetLabel or SeriesDescription.
+    '''
+    
+    _schema = [
+        '''CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+            patient_id TEXT, modality TEXT, sop_uid TEXT, series_uid TEXT,
+            study_uid TEXT, frame_uid TEXT, label TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS refs (
+            path TEXT, kind TEXT, uid TEXT)''',
+        'CREATE INDEX IF NOT EXISTS files_patient ON files (patient_id, modality)',
+        'CREATE INDEX IF NOT EXISTS files_sop ON files (sop_uid)',
+        'CREATE INDEX IF NOT EXISTS files_series ON files (series_uid)',
+        'CREATE INDEX IF NOT EXISTS refs_uid ON refs (uid, kind)',
+        'CREATE INDEX IF NOT EXISTS refs_path ON refs (path)',
+    ]
+    
+    def __init__(self, path = 'dicom_catalogue.sqlite'):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        with self.db:
+            for statement in self._schema:
+                self.db.execute(statement)
+    
+    @profiled
+    def update(self, data_dir, workers = None):
+        '''
+        Index new or changed files under data_dir and drop files that no
+        longer exist. Unchanged files (same mtime and size) are not read,
+        so rerunning after new files land only reads the new headers.
+        DICOM files are recognised by their header (the DICM prefix), not
+        by extension, so extensionless CT slices are indexed too.
+
+        Parameters
+        ----------
+        data_dir : string
+            Root of the DICOM tree.
+        workers : int, optional
+            Number of header reading threads. The default is None
+            (ThreadPoolExecutor default).
+
+        Returns
+        -------
+        added : int
+            Number of files (re)indexed.
+        removed : int
+            Number of files dropped from the index.
+
+        '''
+        root = os.path.abspath(data_dir)
+        known = {row[0]: (row[1], row[2]) for row in self.db.execute(
+                     'SELECT path, mtime, size FROM files') 
+                 if row[0].startswith(os.path.join(root, ''))}
+        
+        found = {}
+        for folder, dirs, files in os.walk(root):
+            for name in files:
+                f = os.path.join(folder, name)
+                stat = os.stat(f)
+                stat = (stat.st_mtime, stat.st_size)
+                # Only new or changed files need their header checked.
+                if known.get(f) == stat or pydicom.misc.is_dicom(f):
+                    found[f] = stat
+        
+        changed = [f for f, stat in found.items() if known.get(f) != stat]
+        removed = [f for f in known if f not in found]
+        
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            records = list(pool.map(self._read_header, changed))
+        
+        with self.db:
+            stale = [(f,) for f in changed + removed]
+            self.db.executemany('DELETE FROM files WHERE path = ?', stale)
+            self.db.executemany('DELETE FROM refs WHERE path = ?', stale)
+            for f, (row, refs) in zip(changed, records):
+                if row is None:
+                    continue
+                self.db.execute('INSERT INTO files VALUES (?,?,?,?,?,?,?,?,?,?)',
+                                (f,) + found[f] + row)
+                self.db.executemany('INSERT INTO refs VALUES (?,?,?)',
+                                    [(f, kind, uid) for kind, uid in refs])
+        
+        return len(changed), len(removed)
+    
+    @staticmethod
+    def _read_header(f):
+        # Row values and referenced UIDs of one file, (None, []) if it is
+        # not a readable DICOM file.
+        try:
+            ds = pydicom.dcmread(f, stop_before_pixels = True)
+        except Exception:
+            return None, []
+        
+        modality = ds.get('Modality')
+        if modality == 'RTPLAN':
+            label = ds.get('RTPlanLabel')
+        elif modality == 'RTSTRUCT':
+            label = ds.get('StructureSetLabel')
+        else:
+            label = ds.get('SeriesDescription')
+        
+        refs = []
+        for item in ds.get('ReferencedRTPlanSequence', []):
+            refs.append(('plan', item.ReferencedSOPInstanceUID))
+        for item in ds.get('ReferencedStructureSetSequence', []):
+            refs.append(('structure', item.ReferencedSOPInstanceUID))
+        for frame in ds.get('ReferencedFrameOfReferenceSequence', []):
+            for study in frame.get('RTReferencedStudySequence', []):
+                for series in study.get('RTReferencedSeriesSequence', []):
+                    refs.append(('series', series.SeriesInstanceUID))
+        
+        row = tuple(None if v is None else str(v) for v in
+                    (ds.get('PatientID'), modality, ds.get('SOPInstanceUID'),
+                     ds.get('SeriesInstanceUID'), ds.get('StudyInstanceUID'),
+                     ds.get('FrameOfReferenceUID'), label))
+        
+        return row, refs
+    
+    def files(self, patient_id = None, modality = None, series_uid = None, label = None):
+        '''
+        Paths of the indexed files matching every given field, sorted.
+        '''
+        fields = {'patient_id': patient_id, 'modality': modality,
+                  'series_uid': series_uid, 'label': label}
+        fields = {k: str(v) for k, v in fields.items() if v is not None}
+        where = ' AND '.join(f'{k} = ?' for k in fields) or '1'
+        
+        return [row[0] for row in self.db.execute(
+            f'SELECT path FROM files WHERE {where} ORDER BY path', tuple(fields.values()))]
+    
+    def referencing(self, uid, kind, modality = None):
+        '''
+        Paths of the files that reference uid as kind ('plan', 'structure'
+        or 'series'), optionally only of one modality, e.g. 
+        referencing(plan_uid, 'plan', 'RTDOSE') gives the doses.
+        '''
+        if modality is None:
+            return [row[0] for row in self.db.execute(
+                'SELECT path FROM refs WHERE uid = ? AND kind = ? ORDER BY path', (uid, kind))]
+        
+        return [row[0] for row in self.db.execute(
+            'SELECT refs.path FROM refs JOIN files ON files.path = refs.path '
+            'WHERE uid = ? AND kind = ? AND modality = ? ORDER BY refs.path', 
+            (uid, kind, modality))]
+    
+    def referenced(self, path, kind):
+        '''
+        UIDs referenced by one file as kind.
+        '''
+        return [row[0] for row in self.db.execute(
+            'SELECT uid FROM refs WHERE path = ? AND kind = ?', (path, kind))]
+    
+    def case(self, patient_id, plan_name = None, strctSet = None):
+        '''
+        Resolve the files of one plan: the plan, its dose files, the
+        structure set it references and the CT series that one references.
+
+        Parameters
+        ----------
+        patient_id : string
+            PatientID of the files.
+        plan_name : string, optional
+            RTPlanLabel of the plan. The default is None, only allowed if
+            the patient has a single plan.
+        strctSet : string, optional
+            StructureSetLabel, only used if the plan does not reference
+            a structure set.
+
+        Returns
+        -------
+        case : dict
+            'plan' and 'structure' paths, 'dose' and 'ct' lists of paths.
+
+        '''
+        plans = self.files(patient_id, 'RTPLAN', label = plan_name)
+        if len(plans) != 1:
+            raise ValueError(f'Found {len(plans)} RTPLAN files for {patient_id} '
+                             f'{plan_name or "(no plan name given)"}.')
+        plan = plans[0]
+        plan_uid = self._sop_uid(plan)
+        
+        # Other RT objects (e.g. treatment records) reference the plan too.
+        dose = self.referencing(plan_uid, 'plan', 'RTDOSE')
+        
+        structs = [p for uid in self.referenced(plan, 'structure')
+                   for p in self._by_sop_uid(uid)]
+        if not structs and strctSet is not None:
+            structs = self.files(patient_id, 'RTSTRUCT', label = strctSet)
+        struct = structs[0] if structs else None
+        
+        ct = []
+        if struct is not None:
+            for uid in self.referenced(struct, 'series'):
+                ct += self.files(modality = 'CT', series_uid = uid)
+        
+        return {'plan': plan, 'dose': dose, 'structure': struct, 'ct': ct}
+    
+    def _sop_uid(self, path):
+        return self.db.execute('SELECT sop_uid FROM files WHERE path = ?', (path,)).fetchone()[0]
+    
+    def _by_sop_uid(self, uid):
+        return [row[0] for row in self.db.execute(
+            'SELECT path FROM files WHERE sop_uid = ?', (uid,))]
+    
+    def close(self):
+        self.db.close()
+
+###############################################################################
+############################## TRAINING DATASET ###############################
+###############################################################################
+
+class SliceStacks(object):
+    '''
+    On-disk store of 2.5D slice stacks: one memory-mapped array per
+    orientation of shape [patients, slices, H, W, C], holding a window of
+    neighbouring slices of every patient. Written once (see 
+    08_Slice_to_TL.py), then a slice, a slice range or a random slice per
+    patient is read without loading the rest, instead of keeping one
+    cohort file per slice index.
+
+    Layout of the store directory:
+        index.json           patients, dtype and the slice indices and
+                             image shape of every orientation.
+        {orientation}.npy    [patients, slices, H, W, C] array (np.load compatible).
+        written.npy          uint8 flag per patient, set once written.
+    '''
+    
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        
+        self.patients = list(self.index['patients'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.orientations = list(self.index['orientations'])
+        self.slices = {name: np.array(o['slices']) for name, o in 
+                       self.index['orientations'].items()}
+        
+        self._lookup = {p: i for i, p in enumerate(self.patients)}
+        self._arrays = {}
+    
+    @classmethod
+    def create(cls, path, patients, orientations, dtype = np.uint8):
+        '''
+        Create an empty store, or open it if it already exists with the
+        same layout.
+
+        Parameters
+        ----------
+        path : string
+            Store directory.
+        patients : list
+            Patient IDs, in the order they are stored.
+        orientations : dict
+            Orientation name -> (slice indices, image shape), e.g.
+            {'sagittal': (range(145, 156), (300, 300, 3))}.
+        dtype : numpy.dtype, optional
+            Image dtype. The default is np.uint8.
+
+        Returns
+        -------
+        SliceStacks
+            The opened store.
+
+        '''
+        index = {'patients': [str(p) for p in patients],
+                 'dtype': np.dtype(dtype).str,
+                 'orientations': {name: {'slices': [int(s) for s in slices],
+                                         'shape': [int(n) for n in shape]}
+                                  for name, (slices, shape) in orientations.items()}}
+        
+        if os.path.exists(os.path.join(path, 'index.json')):
+            stacks = cls(path)
+            if stacks.index != index:
+                raise ValueError(f'Slice stacks at {path} exist with a different layout.')
+            return stacks
+        
+        os.makedirs(path, exist_ok = True)
+        for name, o in index['orientations'].items():
+            arr = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode = 'w+',
+                                            dtype = dtype, 
+                                            shape = (len(patients), len(o['slices'])) + tuple(o['shape']))
+            del arr
+        np.save(os.path.join(path, 'written.npy'), np.zeros(len(patients), dtype = np.uint8))
+        
+        # Index last, so a half-created store is never opened.
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(index, f, indent = 1)
+        
+        return cls(path)
+    
+    def _array(self, name, mode = 'r'):
+        if (name, mode) not in self._arrays:
+            self._arrays[(name, mode)] = np.load(os.path.join(self.path, f'{name}.npy'), 
+                                                 mmap_mode = mode)
+        return self._arrays[(name, mode)]
+    
+    def stack(self, orientation):
+        '''
+        Memory-mapped [patients, slices, H, W, C] array, nothing is read
+        until indexed.
+        '''
+        return self._array(orientation)
+    
+    def positions(self, orientation, start = None, stop = None):
+        '''
+        Positions in the stack of the slice indices in [start, stop).
+        '''
+        slices = self.slices[orientation]
+        keep = np.ones(len(slices), dtype = bool)
+        if start is not None:
+            keep &= slices >= start
+        if stop is not None:
+            keep &= slices < stop
+        
+        return np.flatnonzero(keep)
+    
+    def slice(self, orientation, index):
+        '''
+        Memory-mapped [patients, H, W, C] images of one slice index, the
+        same as the per-slice sets (e.g. sagittal_set_150.npy), so it can
+        be a view of SliceDataset.
+        '''
+        position = np.flatnonzero(self.slices[orientation] == index)
+        if not len(position):
+            raise KeyError(f'Slice {index} is not in the {orientation} stack.')
+        
+        return self.stack(orientation)[:, position[0]]
+    
+    @profiled
+    def read(self, orientation, start = None, stop = None, patients = None):
+        '''
+        Read the slices with index in [start, stop) of the given patients
+        (default all) into memory, as [patients, slices, H, W, C].
+        '''
+        positions = self.positions(orientation, start, stop)
+        stack = self.stack(orientation)
+        if not len(positions):
+            return stack[:0, :0]
+        
+        # Slice indices are sorted, so the range is contiguous.
+        window = slice(positions[0], positions[-1] + 1)
+        if patients is None:
+            return np.array(stack[:, window])
+        
+        rows = [self._lookup[str(p)] for p in patients]
+        return stack[rows, window]
+    
+    def random_slices(self, orientation, start = None, stop = None, seed = None):
+        '''
+        View of one orientation that gives a random slice in [start, stop)
+        of each patient every time it is indexed (e.g. augmentation in
+        SliceDataset), reading only those images.
+        '''
+        return _RandomSlices(self.stack(orientation), 
+                             self.positions(orientation, start, stop), seed)
+    
+    def write(self, patient_id, images):
+        '''
+        Write a patient's [slices, H, W, C] images of every orientation
+        (a dict by orientation) and flag it as written.
+        '''
+        ii = self._lookup[str(patient_id)]
+        for name in self.orientations:
+            arr = self._array(name, 'r+')
+            arr[ii] = images[name]
+            arr.flush()
+        
+        flags = self._array('written', 'r+')
+        flags[ii] = 1
+        flags.flush()
+    
+    def reset(self, patient_ids):
+        '''
+        Clear the written flag of patients whose images have to be redone.
+        '''
+        flags = self._array('written', 'r+')
+        for patient_id in patient_ids:
+            flags[self._lookup[str(patient_id)]] = 0
+        flags.flush()
+    
+    def written(self, patient_id):
+        # Not cached, other processes may be writing.
+        flags = np.load(os.path.join(self.path, 'written.npy'))
         
-    image += np.int16(intercept)
+        return bool(flags[self._lookup[str(patient_id)]])
     
-    return np.array(image, dtype=np.int16)
+    def close(self):
+        for arr in self._arrays.values():
+            if arr.mode == 'r+':
+                arr.flush()
+        self._arrays = {}
+
+class _RandomSlices(object):
+    # Indexed like a [patients, H, W, C] array, drawing a random slice
+    # position per row. The lock keeps the draws safe for the prefetch
+    # threads of SliceDataset.batches.
+    
+    def __init__(self, stack, positions, seed = None):
+        self.stack = stack
+        self.positions = positions
+        self.shape = (stack.shape[0],) + stack.shape[2:]
+        self.dtype = stack.dtype
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, rows):
+        rows = np.atleast_1d(np.arange(len(self))[rows])
+        with self._lock:
+            positions = self._rng.choice(self.positions, size = len(rows))
+        
+        return self.stack[rows, positions]
 
-def resample(image, image_thickness, pixel_spacing): 
+class SliceDataset(object):
     '''
-    Resampled 3D dose or ct image according to pixel spacing and slice
-    thickness to project it into a 1 mm x 1 mm x 1 mm grid.
-
+    Batches of the stage 08 slice sets (sagittal_set_150.npy etc.) read
+    straight from disk for model.fit. Every view is memory mapped, so only
+    the rows of the current batch are ever read, and train/val/test splits
+    are index arrays instead of copies of the data. Batches are gathered by
+    background threads ahead of the trainer (see batches).
+    
+    The inputs of a batch are (view, ..., pretreatment) in the order given,
+    matching the multi-input models of the transfer learning notebooks.
+    
     Parameters
     ----------
-    image : numpy.ndarray
-        Dose file from pixel.array or imported ct scan after get_pixels_hu.
-    image_thickness : pydicom.valuerep.DSfloat
-        Slice thicknes of CT scans.
-    pixel_spacing : pydicom.multival.MultiValue
-        Spacing of pixels in [x,y] directions.
-
-    Returns
-    -------
-    resampled_image : numpy.ndarray
-        Resampled array in 1 mm x 1 mm x 1 mm grid.
-
+    views : list
+        .npy files (memory mapped) or arrays, one row per patient, 
+        e.g. [sagittal, coronal, axial]. SliceStacks.slice and 
+        SliceStacks.random_slices views work too.
+    labels : numpy.ndarray or str
+        Label per patient, or the .npy file holding them.
+    pretreatment : numpy.ndarray, optional
+        Encoded pre-treatment features, one row per patient. 
+        The default is None (not an input).
+    dtype : string, optional
+        Batches of the views are cast to dtype, so the uint8 sets of stage
+        08 are only converted a batch at a time. None keeps the stored
+        dtype. The default is 'float32'.
     '''
-    # Remade by Owen Feb 24th, 2022.
-    x_pixel = float(pixel_spacing[0])
-    y_pixel = float(pixel_spacing[1])
     
-    size = np.array([x_pixel, y_pixel, float(image_thickness)])
-
-    # Changed this from 2d interpolation to 3d interpolation.
-    resampled_image = interpolation.zoom(image,size)
+    def __init__(self, views, labels, pretreatment = None, dtype = 'float32'):
+        self.views = [np.load(v, mmap_mode = 'r') if isinstance(v, str) else v for v in views]
+        self.labels = np.load(labels) if isinstance(labels, str) else np.asarray(labels)
+        self.pretreatment = None if pretreatment is None else np.asarray(pretreatment)
+        self.dtype = dtype
+        
+        inputs = self.views + ([] if self.pretreatment is None else [self.pretreatment])
+        lengths = {len(x) for x in inputs + [self.labels]}
+        if len(lengths) != 1:
+            raise ValueError(f'Views, labels and pretreatment have different lengths: {lengths}')
     
-    return resampled_image
+    @classmethod
+    def from_sets(cls, path, labels, pretreatment = None, sagittal = 150,
+                  coronal = 120, axial = 130, **kwargs):
+        '''
+        Dataset of the sagittal, coronal and axial sets saved by 
+        08_Slice_to_TL.py in path.
+        '''
+        views = [os.path.join(path, f'{name}_set_{n}.npy') for name, n in
+                 (('sagittal', sagittal), ('coronal', coronal), ('axial', axial))]
+        
+        return cls(views, labels, pretreatment, **kwargs)
+    
+    def __len__(self):
+        return len(self.labels)
+    
+    def split(self, fractions = (0.7, 0.15, 0.15), seed = None):
+        '''
+        Shuffled patient indices split by fractions, e.g. train, val and
+        test. Same cut points as split_features_and_shuffle in the 
+        notebooks, but no data is copied.
+        '''
+        indices = np.random.default_rng(seed).permutation(len(self))
+        cuts = (np.cumsum(fractions)[:-1] * len(self)).astype(int)
+        
+        return np.split(indices, cuts)
+    
+    def batch(self, indices):
+        '''
+        (inputs, labels) of the patients in indices. Rows are read in
+        sorted order, which is sequential on disk, so the batch is returned
+        in that order.
+        '''
+        indices = np.sort(indices)
+        inputs = [view[indices] for view in self.views]
+        if self.dtype is not None:
+            inputs = [x.astype(self.dtype, copy = False) for x in inputs]
+        if self.pretreatment is not None:
+            inputs.append(self.pretreatment[indices])
+        
+        return tuple(inputs), self.labels[indices]
+    
+    def steps(self, indices, batch_size = 64, drop_last = False):
+        '''
+        Batches per epoch, for steps_per_epoch / validation_steps.
+        '''
+        if drop_last:
+            return len(indices) // batch_size
+        return -(-len(indices) // batch_size)
+    
+    def batches(self, indices, batch_size = 64, shuffle = True, epochs = 1,
+                seed = None, drop_last = False, prefetch = 4, workers = 2):
+        '''
+        Generator of (inputs, labels) batches over indices for model.fit.
+        
+        Up to prefetch batches are read ahead by a pool of workers threads
+        (numpy releases the GIL while copying, so reads overlap with 
+        training). Each epoch is reshuffled when shuffle is True.
+        
+        Parameters
+        ----------
+        indices : numpy.ndarray
+            Patients to draw from, e.g. one of split.
+        batch_size : int, optional
+            The default is 64.
+        shuffle : bool, optional
+            The default is True.
+        epochs : int, optional
+            Passes over indices, None for endless (then pass steps to
+            model.fit). The default is 1.
+        seed : int, optional
+            Seed of the shuffle. The default is None.
+        drop_last : bool, optional
+            Skip the last, smaller batch. The default is False.
+        prefetch : int, optional
+            Batches read ahead. The default is 4.
+        workers : int, optional
+            Reading threads. The default is 2.
+        '''
+        rng = np.random.default_rng(seed)
+        indices = np.asarray(indices)
+        n = self.steps(indices, batch_size, drop_last)
+        
+        def order():
+            for epoch in (range(epochs) if epochs is not None else itertools.count()):
+                epoch_indices = rng.permutation(indices) if shuffle else indices
+                for k in range(n):
+                    yield epoch_indices[k * batch_size : (k + 1) * batch_size]
+        
+        pool = ThreadPoolExecutor(max_workers = workers)
+        pending = collections.deque()
+        try:
+            for batch_indices in order():
+                pending.append(pool.submit(self.batch, batch_indices))
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Also when the consumer stops early.
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait = False)
+    
+    def tf_dataset(self, indices, batch_size = 64, shuffle = True, seed = None,
+                   drop_last = False, prefetch = 4, workers = 2):
+        '''
+        tf.data.Dataset of one epoch of batches, reshuffled on every pass
+        (see batches). TensorFlow is only imported here.
+        '''
+        import tensorflow as tf
+        
+        epoch = itertools.count()
+        def generator():
+            epoch_seed = None if seed is None else seed + next(epoch)
+            return self.batches(indices, batch_size, shuffle, 1, epoch_seed,
+                                drop_last, prefetch, workers)
+        
+        inputs, labels = self.batch(np.asarray(indices)[:1])
+        spec = lambda x: tf.TensorSpec((None,) + x.shape[1:], tf.as_dtype(x.dtype))
+        signature = (tuple(spec(x) for x in inputs), spec(labels))
+        
+        return tf.data.Dataset.from_generator(generator, output_signature = signature)
 
-def resize_image(image, new_dim = [750,750,750], crop = [512,512,512]):
+@profiled
+def backbone_features(images, backbone = 'EfficientNetB0', weights = 'imagenet',
+                      pooling = 'avg', batch_size = 32):
     '''
-    Resize the dose or ct file to a common size, after resampling and 
-    before applying registration shifts. Pads at end of the array
-    so the top left pixel remains aligned so shifts are applied correctly.
-
+    Pooled embeddings of a frozen keras.applications backbone, e.g. for a
+    stage 08 slice set. Images are read and converted a batch at a time,
+    so a memory mapped set is never loaded whole. TensorFlow is only
+    imported here.
+    
     Parameters
     ----------
-    image : numpy.ndarray
-        Input 3D array, typically a dose or ct file.
-    new_dim : TYPE, optional
-        Temporary image pad size. The default is [750,750,750].
-    crop : TYPE, optional
-        Final image cropped size. The default is [512,512,512].
+    images : numpy.ndarray
+        Images as (n, height, width, 3), 0-255.
+    backbone : string, optional
+        Name in tf.keras.applications. The default is 'EfficientNetB0'.
+    weights : string, optional
+        'imagenet' or a weights file. The default is 'imagenet'.
+    pooling : string, optional
+        'avg' or 'max' global pooling of the last feature map.
+        The default is 'avg'.
+    batch_size : int, optional
+        The default is 32.
 
     Returns
     -------
-    final_image : numpy.ndarray
-        Resized dose or ct file.
-
+    features : numpy.ndarray
+        Float32 embeddings as (n, features).
     '''
-    # Remade by Owen Feb 24th, 2022.   
-    dim_dif = new_dim - np.array(image.shape)
-    
-    # Pad step to get to new_dim size.
-    pad = ((0,dim_dif[0]),(0,dim_dif[1]),(0,dim_dif[2]))
-    temp_image = np.pad(image,pad_width = pad, mode = 'constant', constant_values = 0)
-
-    # Crop image down to cropped size.
-    final_image = temp_image[:crop[0],:crop[1],:crop[2]]
-    
-    return final_image
-
-def registration_shift(img,extra_shift,deformation):
-    '''     
-    Apply the translational shifts for all three axis. 
+    import tensorflow as tf
     
-    This will wrap around if the shift exceeds the size of the array.
-    No need to consider pixel_info as they have been resampled into 
-    1mm x 1mm x 1mm grids using resample method.   
+    model = getattr(tf.keras.applications, backbone)(
+        weights = weights, include_top = False, pooling = pooling,
+        input_shape = images.shape[1:])
+    model.trainable = False
     
-    Need the resize_image applied first. If not, shifts may wrap around.
+    features = np.empty((len(images), model.output_shape[-1]), dtype = np.float32)
+    for start in range(0, len(images), batch_size):
+        batch = np.asarray(images[start : start + batch_size], dtype = np.float32)
+        features[start : start + len(batch)] = model.predict_on_batch(batch)
     
-    Other change was to swap Z_shift and X_shift operations. I think this
-    works because I swapped the axis before registration, while
-    Fletcher did this operation afterwards.
+    return features
 
+def cached_backbone_features(cache, set_file, backbone = 'EfficientNetB0',
+                             weights = 'imagenet', pooling = 'avg',
+                             preprocessing = None, batch_size = 32):
+    '''
+    backbone_features of a slice set file, computed once and then taken
+    from cache (a VolumeCache). Entries are keyed by the backbone, its
+    weights and pooling, the content of the set file and preprocessing.
+    
     Parameters
     ----------
-    img : numpy.ndarray
-        Dose or CT file after being processed by resize_image.
-    extra_shift : numpy.ndarray
-        Shift from the alignment of dose and ct files, and aligning
-        the .ImagePositionPatient to reference.
-    deformation : numpy.ndarray
-        Apply the shifts from image registration.
+    cache : VolumeCache
+        Where the embeddings are stored.
+    set_file : string
+        .npy slice set, e.g. sagittal_set_150.npy from 08_Slice_to_TL.py.
+    preprocessing : dict, optional
+        Description of how the set was made (e.g. the stage 08 settings),
+        only used in the key. Change it to invalidate the entries. 
+        The default is None.
+    
+    Other parameters are as in backbone_features.
 
     Returns
     -------
-    numpy.ndarray
-        CT or dose file with the appropriate shifts applied.
-
+    features : numpy.ndarray
+        Float32 embeddings as (n, features).
     '''
-    X_shift =  int(np.round(deformation[0] + extra_shift[0]))
-    Y_shift =  int(np.round(deformation[1] + extra_shift[1]))
-    Z_shift =  int(np.round(deformation[2] + extra_shift[2]))
-    #print (f'Shifted by {X_shift} {Y_shift} {Z_shift}.')
-    
-    l3 = []
-    for k in range(len(img)):
-        l1 = []
-        for i in range(img[0].shape[0]):
-            items = deque(img[k][i])
-            items.rotate(Z_shift) # Swapped to Z from previous.
-            l1.append(items)
-        
-        temp = np.array(l1, dtype = np.float32)
-        l2 = []
-        for j in range(img[0].shape[1]):
-            test = np.transpose(temp)
-            items = deque(test[j])
-            items.rotate(Y_shift)
-            l2.append(items)
-        
-        temp2 = np.array(l2, dtype = np.float32)
-        l3.append(np.transpose(temp2))
+    if weights != 'imagenet':
+        weights_digest = source_digest([weights])
+    else:
+        weights_digest = weights
+    key = cache_key(backbone = backbone, weights = weights_digest, pooling = pooling,
+                    source = source_digest([set_file]),
+                    preprocessing = preprocessing or {})
     
-    items = deque(l3)
-    items.rotate(X_shift) # Swapped to X from previous.
-    return np.array(items, dtype = np.float32)
-
-def crop_image(image, crop = [(150,450),(135,435),(212,512)]):
+    cached = cache.get(key)
+    if cached is not None:
+        return cached['features']
     
-    for ii in range(len(crop)):
-        # print(f'Cropping {ii} axis.')
-        image = image.take(indices = range(*crop[ii]), axis = ii)
-        # The * is the splat operator, unravels the tuple.
-        
-    return image 
+    images = np.load(set_file, mmap_mode = 'r')
+    features = backbone_features(images, backbone, weights, pooling, batch_size)
+    cache.put(key, features = features)
     
+    return features
 
-def scale_image(image, scale_type = 'min_max'):
+def feature_head(feature_dims, num_class, pretreatment_dim = None):
+    '''
+    Classifier trained on cached backbone embeddings: one input per view,
+    plus the optional pre-treatment features, concatenated into a softmax
+    layer. Its inputs are SliceDataset(features, labels, pretreatment,
+    dtype = None) batches. TensorFlow is only imported here.
     
-    if scale_type == 'min_max':
-        img_min = image.min()
-        img_max = image.max()
-        
-        scaled_img = 255 * (image - img_min) / (img_max - img_min)
-        
-    return scaled_img
-
-def window_image(image, win_min = -400, win_max = 800):
-    low_mask = image < win_min
-    high_mask = image > win_max
+    This is not the head of the transfer learning notebooks: they flatten
+    the unpooled feature maps of each view (128000 / 140800 features per
+    view), while this head takes the globally pooled embeddings of
+    backbone_features (1280 - 1408 per view), so its results are not
+    directly comparable with the notebook models.
+    '''
+    import tensorflow as tf
     
-    image[low_mask] = win_min
-    image[high_mask] = win_max
+    inputs = [tf.keras.layers.Input(shape = (dim,)) for dim in feature_dims]
+    if pretreatment_dim is not None:
+        inputs.append(tf.keras.layers.Input(shape = (pretreatment_dim,)))
     
-    return image    
+    x = tf.keras.layers.Concatenate(axis = 1)(inputs) if len(inputs) > 1 else inputs[0]
+    out = tf.keras.layers.Dense(num_class, activation = 'softmax')(x)
+    
+    return tf.keras.Model(inputs = inputs, outputs = out)
 
 ###############################################################################
 #################### Kailyn's DICOM & DATA PROCESSING ############################
 ###############################################################################
 
 #def load_dcm(n,data_dir='AnonymizedDICOM'):
-def load_dcm(pt, strctSet, plan_name, data_dir):
+@profiled
+def load_dcm(pt, strctSet, plan_name, data_dir, catalogue = None):
     """Reads and loads a set of patient data. Includes RTSTRUCT, 
     RTPLAN, and RTDOSE DICOM files. Patient data is assumed to 
     have filenames generated by the output from ARIA in format of
     patient name + structure set/plan name. 
     
+    With a DicomCatalogue the files are instead found from the
+    catalogue by PatientID, plan label and referenced UIDs, and
+    filenames do not matter.
+    
     Adjusted by Owen Paetkau May 21st, 2021.
 
     Parameters
@@ -391,6 +2295,8 @@ def load_dcm(pt, strctSet, plan_name, data_dir):
         Plan name, required for identifying imported files.
     data_dir : string, optional
         Folder containing patient data.
+    catalogue : DicomCatalogue, optional
+        Catalogue to resolve the files from, data_dir is not used.
 
     Returns
     -------
@@ -402,6 +2308,17 @@ def load_dcm(pt, strctSet, plan_name, data_dir):
         Patient RTPLAN DICOM object.
     """
     
+    if catalogue is not None:
+        case = catalogue.case(pt, plan_name, strctSet)
+        print(case['structure'])
+        struct = pydicom.dcmread(case['structure'])
+        print(case['plan'])
+        plan = pydicom.dcmread(case['plan'])
+        for f in case['dose']:
+            print(f)
+        dose = [pydicom.dcmread(f) for f in case['dose']]
+        return struct,dose,plan
+    
     #READ IN FILES
     #Fetch structure DICOM and read.
     #_fname = 'RTSTRUCT_'+str(n).zfill(4)+'.dcm'
@@ -431,13 +2348,23 @@ def load_dcm(pt, strctSet, plan_name, data_dir):
 
     return struct,dose,plan
 
-def batch_anonymize(patdir,save_dir='AnonymizedDICOM'):
+@profiled
+def batch_anonymize(patdir,save_dir='AnonymizedDICOM',
+                    map_file='anonymization_map.json',workers=None):
     """Anonymizes all DICOM files within a folder.
     
     All subdirectories within the folder are anonymized.
     Each set of patient data (RTSTRUCT, RTDOSE, RTPLAN)
     must be in a separate folder for proper indexing.
 
+    Patient folders are anonymized in a process pool. Each folder
+    gets a number from the mapping table in map_file, which is saved
+    before any files are written, so numbering is stable across runs
+    and an interrupted run can be restarted: folders already marked
+    done are skipped and the rest are redone under the same numbers.
+    Pixel data is copied straight from the source file instead of
+    being read into memory (see _anonymize_file).
+
     Parameters
     ----------
     folder : string
@@ -445,6 +2372,13 @@ def batch_anonymize(patdir,save_dir='AnonymizedDICOM'):
     save_dir : string, optional
         The save directory for anonymized files, by
         default 'AnonymizedDICOM' in current directory.
+    map_file : string, optional
+        JSON mapping table of patient folder to number, by
+        default 'anonymization_map.json' in current directory.
+        It contains the original folder names, so keep it
+        out of save_dir.
+    workers : int, optional
+        Number of worker processes, by default every core.
 
     Returns
     -------
@@ -454,29 +2388,59 @@ def batch_anonymize(patdir,save_dir='AnonymizedDICOM'):
     total_files = 0
     print('-'*79)
     print('Starting file anonymizer...\n')
-    
-    try:
-        latest_file = sorted(os.listdir(save_dir))[-1]
-        n = int(latest_file[-8:-4])
-    except:
-        n = 0
         
     if not os.path.exists(save_dir):
         print('Specified save location not found. '
               'Creating new folder',save_dir,'in current directory.\n')
         os.makedirs(save_dir)
-        
-    for root, dirs, files in os.walk(patdir,topdown=False):
-        fname = []
-        for name in files:
-            if name.endswith('.dcm'):
-                fname.append(name)
+
+    mapping = load_anonymization_map(map_file)
+    if not mapping['folders']:
+        # Carry on the numbering of files anonymized before the table existed.
+        mapping['next'] = max(mapping['next'], _anonymized_count(save_dir) + 1)
+
+    # Folders are numbered in sorted order so a rerun over the same tree
+    # gives the same numbers, whatever order os.walk returns them in.
+    folders = {}
+    for root, dirs, files in os.walk(patdir):
+        fname = sorted(name for name in files if name.endswith('.dcm'))
         if fname:
-            n += 1
-            print(root)
-            _anonymize(root,fname,n,save_dir)
-            print('Anonymized.\n')
-            total_files += len(fname)
+            folders[os.path.relpath(root,patdir).replace(os.sep,'/')] = (root,fname)
+
+    for key in sorted(folders):
+        if key not in mapping['folders']:
+            mapping['folders'][key] = {'number': mapping['next'], 'status': 'new'}
+            mapping['next'] += 1
+    save_anonymization_map(mapping,map_file)
+
+    todo = [key for key in sorted(folders)
+            if mapping['folders'][key]['status'] != 'done']
+    print(len(folders)-len(todo),'folder(s) already anonymized,',
+          len(todo),'to do.\n')
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_anonymize,*folders[key],
+                               mapping['folders'][key]['number'],save_dir): key
+                   for key in todo}
+
+        for future in as_completed(futures):
+            key = futures[future]
+            record = mapping['folders'][key]
+            try:
+                names = future.result()
+            except Exception:
+                record['status'] = 'failed'
+                record['error'] = traceback.format_exc()
+                print(folders[key][0])
+                print('Failed, see',map_file,'\n')
+            else:
+                record['status'] = 'done'
+                record['files'] = len(names)
+                record.pop('error',None)
+                print(folders[key][0])
+                print('Anonymized as',str(record['number']).zfill(4),'\n')
+                total_files += len(names)
+            save_anonymization_map(mapping,map_file)
             
     if total_files > 0:
         # try:
@@ -490,6 +2454,32 @@ def batch_anonymize(patdir,save_dir='AnonymizedDICOM'):
     print('\nDone.')
     print('-'*79)
 
+def load_anonymization_map(map_file='anonymization_map.json'):
+    """Load the patient folder to number table used by batch_anonymize.
+
+    Parameters
+    ----------
+    map_file : string, optional
+        Path of the JSON mapping table.
+
+    Returns
+    -------
+    mapping : dict
+        'next' is the next free number and 'folders' maps each patient
+        folder (relative to patdir) to its 'number' and 'status'.
+    """
+    if os.path.exists(map_file):
+        with open(map_file) as f:
+            return json.load(f)
+    return {'next': 1, 'folders': {}}
+
+def save_anonymization_map(mapping,map_file='anonymization_map.json'):
+    # Write to a temporary file first so an interrupted run never leaves
+    # a half-written table behind.
+    tmp = map_file + '.tmp'
+    with open(tmp,'w') as f:
+        json.dump(mapping,f,indent=1,sort_keys=True)
+    os.replace(tmp,map_file)
     
 ###############################################################################
 ############################ DOSE GRID FUNCTIONS ##############################
@@ -595,7 +2585,7 @@ def dose_grid_coincidence(dose_list):
         #Check if they have spatial coincidence
         if (dose_list[0].PixelSpacing == item.PixelSpacing and
         dose_list[0].ImagePositionPatient == item.ImagePositionPatient and
-        dose_list[0].pixel_array.shape == item.pixel_array.shape and
+        dose_grid_shape(dose_list[0]) == dose_grid_shape(item) and
         dose_list[0].GridFrameOffsetVector == item.GridFrameOffsetVector):
             continue
         #If they don't, exit
@@ -648,7 +2638,8 @@ def extract_dose_grid(dose):
  
 def add_arcs(dose_list):
     """ Adds dose grids together, specified from a list
-    of Dose DICOM objects.
+    of Dose DICOM objects. Grids that are not coincident
+    are interpolated onto the grid of the first one.
 
     Parameters
     ----------
@@ -661,23 +2652,97 @@ def add_arcs(dose_list):
     combined_grid: array
         Combined dose grid object
         """
+    
+    combined_grid, _ = sum_dose(dose_list)
+ 
+    return combined_grid
+
+@profiled
+def sum_dose(dose_list, dtype = np.float32):
+    """ Streaming dose summation. Each RTDOSE is decoded,
+    scaled and added into one preallocated buffer, and its
+    pixels are released before the next one is read.
+    
+    Grids coincident with the first dose are added directly.
+    Other grids are linearly interpolated onto the first
+    grid (dose outside a grid counts as 0), one frame at
+    a time.
+
+    Parameters
+    ----------
+    dose_list : list
+        RTDOSE files, either as file paths or already
+        loaded pydicom objects.
+    dtype : numpy.dtype, optional
+        Accumulator dtype, by default np.float32.
+
+    Returns
+    -------
+    dose_sum : array
+        Summed dose grid (Gy), [Z,Y,X] on the first grid.
+    headers : list
+        RTDOSE objects, without pixel data when read from 
+        file paths.
+    """
+    if len(dose_list) == 0:
+        raise ValueError('No RTDOSE files to sum.')
+    
+    dose_sum = None
+    headers = []
+    for item in dose_list:
+        if isinstance(item, (str, os.PathLike)):
+            # Read once; the header keeps everything but the pixels.
+            header = pydicom.dcmread(item)
+            grid = header.pixel_array
+            del header.PixelData
+        else:
+            header = item
+            grid = item.pixel_array
+        
+        if dose_sum is None:
+            ref = header
+            dose_sum = np.zeros(grid.shape, dtype = dtype)
+        elif not dose_grid_parameters([ref, header]):
+            raise ValueError('RTDOSE files have different dose type, units, '
+                             'summation type or orientation.')
+        
+        scaling = np.dtype(dtype).type(header.DoseGridScaling)
+        if dose_grid_coincidence([ref, header]):
+            grid = grid.astype(dtype)
+            grid *= scaling
+            dose_sum += grid
+        else:
+            print("Arcs are not coincident, performing interpolated sum.")
+            _interpolated_add(dose_sum, ref, header, grid, scaling)
+        
+        del grid
+        headers.append(header)
+    
+    return dose_sum, headers
 
-    #If the dose grid is coincident
-    if dose_grid_coincidence(dose_list) and dose_grid_parameters(dose_list):
+def dose_grid_coords(dose):
+    """Get the Z, Y, X coordinates (mm) of the dose grid
+    planes, rows and columns, in patient coordinates.
     
-        #Get grid starting point
-        combined_grid = extract_dose_grid(dose_list[0])
+    Parameters
+    ----------
+    dose : RT DOSE DICOM
+        RT DOSE DICOM file imported using load_dcm function
+
+    Returns
+    -------
+    Z, Y, X coordinate arrays (mm)
         
-        #Add each new dose grid on
-        for item in dose_list[1:]:
-            new_grid = extract_dose_grid(item)
-            combined_grid += new_grid
+    """
+    X0,Y0,Z0 = np.array(dose.ImagePositionPatient, dtype = float)
+    #PixelSpacing is [space between rows, space between columns]
+    xres,yres = np.array(dose.PixelSpacing, dtype = float)
     
-    else:
-        #Perform an interpolated sum  
-        print("Arcs are not coincident/do not have same parameters")
- 
-    return combined_grid
+    X = np.arange(dose.Columns) * yres + X0
+    Y = np.arange(dose.Rows) * xres + Y0
+    Z = np.asarray(dose.GridFrameOffsetVector, dtype = float) + Z0
+    
+    return Z, Y, X
 
 ###############################################################################
 #################### COMPUTATIONAL & GEOMETRY FUNCTIONS #######################
@@ -790,6 +2855,7 @@ def argfind_nearest(array,value):
 ########################### STRUCTURE FUNCTIONS ###############################
 ###############################################################################
 
+@profiled
 def read_structure(struct, dose_list, plan, targets, oars):
     """Organizes patient data into Python dicts.
     
@@ -801,6 +2867,10 @@ def read_structure(struct, dose_list, plan, targets, oars):
     Various DVH metrics are also included, specifically
     D98, D90, D50, V100, V150, V200. Vxx are only 
     computed for clinical target volumes.
+    
+    The summed dose grid is built once per plan (see
+    dose_context). Call close_dose_context() when done
+    with a patient to release it.
 
     Parameters
     ----------
@@ -824,6 +2894,9 @@ def read_structure(struct, dose_list, plan, targets, oars):
     """
     structures = {}
     
+    #Summed dose grid and interpolator, shared by every structure
+    context = dose_context(dose_list)
+    
     approved_structures = targets + oars
     #Print all structures
     print("Contoured Structures:")
@@ -848,7 +2921,7 @@ def read_structure(struct, dose_list, plan, targets, oars):
             
             if not organ['name'] == 'MATCHPOINTS' and not organ['name'] == 'BODY':
                 #Get voxels that belong to organ
-                organ['voxels'] = organ_voxels(organ,grid_points(dose_list))
+                organ['voxels'] = organ_voxels(organ,context.points)
                 #Get dose grid
                 organ['dose'] = total_rad_calc(dose_list, organ['voxels'])
                 #Get base dose metrics
@@ -902,7 +2975,7 @@ def read_structure(struct, dose_list, plan, targets, oars):
                     
                     if not organ['name'] == 'BODY' and not organ['name'] == 'MATCHPOINTS':
                         #Get voxels that belong to organ
-                        organ['voxels'] = organ_voxels(organ,grid_points(dose_list))
+                        organ['voxels'] = organ_voxels(organ,context.points)
                         #Get dose grid
                         organ['dose'] = total_rad_calc(dose_list, organ['voxels'])
                         #Get base dose metrics
@@ -945,13 +3018,256 @@ def read_structure(struct, dose_list, plan, targets, oars):
                
     return structures    
 
-def organ_voxels(organ,points):
-    """Determines the coordinates of all voxels within
-    the target structure contour.
+@profiled
+def structure_metrics(struct, dose_list, plan, targets, oars, vxx=(95,100,105)):
+    """Non-interactive version of read_structure that
+    returns one row of dose metrics per structure instead
+    of nested dicts with voxel arrays.
+    
+    Every approved structure gets the same columns: volume,
+    mean/min/max dose, D98/D90/D50, D2cc/D0.1cc with their
+    EQD2 (alpha/beta = 10), and Vxx at each percentage of
+    the prescription in vxx (NaN if the plan has none).
+    Structures with fewer than 2 voxels on the dose grid
+    get a row of NaN metrics.
+
+    Parameters
+    ----------
+    struct : RTSTRUCT type
+        Patient RTSTRUCT DICOM object.
+    dose_list : list
+        Patient RTDOSE DICOM objects.
+    plan : RTPLAN type
+        Patient RTPLAN DICOM object.
+    targets: list 
+        Target volume names to be extracted.
+    oars: list 
+        Organ-at-risk names to be extracted.
+    vxx: tuple, optional
+        Percentages of the prescription dose for Vxx.
+
+    Returns
+    -------
+    rows : list
+        List of dicts, one per structure found.
+    """
+    context = dose_context(dose_list)
+    
+    try:
+        prescription = float(get_prescription(plan))
+    except (AttributeError, IndexError):
+        prescription = np.nan
+    
+    rows = []
+    for i,contour in enumerate(struct.ROIContourSequence):
+        name = struct.StructureSetROISequence[i].ROIName.upper().replace(' ','')
+        
+        if (name not in targets and name not in oars) or name in ('BODY','MATCHPOINTS'):
+            continue
+        if 'ContourSequence' not in contour:
+            continue
+        
+        organ = {'name': name}
+        organ['contours'] = list(map(_reshape_data,contour.ContourSequence))
+        organ['voxels'] = organ_voxels(organ,context.points)
+        
+        row = {'structure': name,
+               'type': 'target' if name in targets else 'oar'}
+        if len(organ['voxels']) < 2:
+            for metric in ['volume (cc)', 'mean dose', 'minimum dose', 'maximum dose',
+                           'D98', 'D90', 'D50', 'D2cc', 'D0.1cc', 'D2cc EQD2',
+                           'D0.1cc EQD2'] + [f'V{value}' for value in vxx]:
+                row[metric] = np.nan
+            rows.append(row)
+            continue
+        organ['dose'] = context.dose_at(organ['voxels'])
+        organ['volume (cc)'] = organ_volume(organ)
+        
+        row.update({'volume (cc)': organ['volume (cc)'],
+                    'mean dose': float(np.mean(organ['dose'])),
+                    'minimum dose': float(np.min(organ['dose'])),
+                    'maximum dose': float(np.max(organ['dose'])),
+                    'D98': Dxx(organ,98),
+                    'D90': Dxx(organ,90),
+                    'D50': Dxx(organ,50),
+                    'D2cc': Dxx_cc(organ,2),
+                    'D0.1cc': Dxx_cc(organ,0.1)})
+        row['D2cc EQD2'] = EQD2_10(row['D2cc'])
+        row['D0.1cc EQD2'] = EQD2_10(row['D0.1cc'])
+        for value in vxx:
+            if np.isnan(prescription):
+                row[f'V{value}'] = np.nan
+            else:
+                row[f'V{value}'] = volume_at_dose(organ['dose'], prescription * value/100)
+        
+        rows.append(row)
+    
+    return rows
+
+def organ_voxels(organ,points):
+    """Determines the coordinates of all voxels within
+    the target structure contour.
+    
+    Contour lines from RTSTRUCT provide outlines describing
+    a surface. This function translates that surface into
+    the 3D volume enclosed by it.
+    
+    Each axial slice is filled with rasterize_contours, so
+    holes and several contours on one slice are handled
+    with the even-odd rule instead of being added twice.
+
+    Parameters
+    ----------
+    organ : dict
+        Structure dict object from read_structure().
+    points : array_like
+        2D grid coordinates from grid_points()
+
+    Returns
+    -------
+    voxels : array_like
+        Array of N voxel coordinates in 3D (x,y,z), dim Nx3.
+    """
+    
+    X = np.unique(points[:,0])
+    Y = np.unique(points[:,1])
+    
+    voxels = []
+    for z, mask in rasterize_contours(organ['contours'], X, Y).items():
+        yy, xx = np.nonzero(mask)
+        voxels.append(np.column_stack([X[xx], Y[yy], np.full(len(xx), z)]))
+    
+    if not voxels:
+        return np.zeros((0, 3))
+    
+    return np.vstack(voxels)
+
+def rasterize_contours(contours, X, Y):
+    """Fills the contours of a structure on a 2D grid,
+    one mask per axial plane. 
+    
+    Uses a scanline fill restricted to the bounding box of
+    each contour. Crossings from every contour on a plane
+    are combined with the even-odd rule, so holes and
+    multiple islands come out correctly.
+
+    Parameters
+    ----------
+    contours : list
+        Contours from read_structure() (organ['contours']),
+        each a 3xN array of x, y, z points.
+    X : array_like
+        Ascending x coordinates of the grid columns (mm).
+    Y : array_like
+        Ascending y coordinates of the grid rows (mm).
+
+    Returns
+    -------
+    masks : dict
+        Boolean [Y,X] mask for each contour plane z, in the
+        order the planes first appear.
+    """
+    X = np.asarray(X, dtype = float)
+    Y = np.asarray(Y, dtype = float)
+    
+    # Crossing counts per plane, parity gives inside/outside.
+    counts = {}
+    for axialslice in contours:
+        x, y = np.asarray(axialslice[0], dtype = float), np.asarray(axialslice[1], dtype = float)
+        z = float(axialslice[2][0])
+        if z not in counts:
+            counts[z] = np.zeros((len(Y), len(X)), dtype = np.uint16)
+        
+        # Rows and columns inside the bounding box.
+        r0, r1 = np.searchsorted(Y, [y.min(), y.max()], side = 'left')
+        c0, c1 = np.searchsorted(X, [x.min(), x.max()], side = 'left')
+        if r1 <= r0 or c1 <= c0:
+            continue
+        
+        x1, y1 = np.roll(x, -1), np.roll(y, -1)
+        Xc = X[c0:c1]
+        for r in range(r0, r1):
+            yr = Y[r]
+            # Half-open rule so vertices on the scanline count once.
+            cross = ((y <= yr) & (yr < y1)) | ((y1 <= yr) & (yr < y))
+            if not cross.any():
+                continue
+            xa, ya, xb, yb = x[cross], y[cross], x1[cross], y1[cross]
+            xs = np.sort(xa + (yr - ya) * (xb - xa) / (yb - ya))
+            # Crossings to the left of each column.
+            counts[z][r, c0:c1] += np.searchsorted(xs, Xc, side = 'right').astype(np.uint16)
+    
+    return {z: (c % 2).astype(bool) for z, c in counts.items()}
+
+def organ_mask(organ, dose_list, Z = None, Y = None, X = None):
+    """Boolean 3D mask of a structure on the dose grid, or
+    on any other reference grid given by Z, Y, X.
+    
+    Each grid plane takes the mask of the nearest contour
+    plane, within half a contour spacing of the contoured
+    extent.
+
+    Parameters
+    ----------
+    organ : dict
+        Structure dict object from read_structure().
+    dose_list : list
+        RTDOSE objects defining the grid (if Z, Y, X not given).
+    Z, Y, X : array_like, optional
+        Ascending plane, row and column coordinates (mm).
+
+    Returns
+    -------
+    mask : array_like
+        Boolean mask, [Z,Y,X].
+    coords : tuple
+        (Z, Y, X) coordinate arrays of the grid.
+    """
+    if Z is None:
+        Z, Y, X = dose_grid_coords(dose_list[0])
     
-    Contour lines from RTSTRUCT provide outlines describing
-    a surface. This function translates that surface into
-    the 3D volume enclosed by it.
+    planes = rasterize_contours(organ['contours'], X, Y)
+    mask = np.zeros((len(Z), len(Y), len(X)), dtype = bool)
+    if not planes:
+        return mask, (Z, Y, X)
+    
+    zc = np.array(sorted(planes))
+    half = np.min(np.diff(zc)) / 2 if len(zc) > 1 else 0
+    for kk, z in enumerate(Z):
+        nearest = zc[argfind_nearest(zc, z)]
+        if np.abs(nearest - z) <= half + 1e-6:
+            mask[kk] = planes[nearest]
+    
+    return mask, (Z, Y, X)
+
+def mask_voxels(mask, coords):
+    """Voxel coordinates of a mask from organ_mask().
+
+    Parameters
+    ----------
+    mask : array_like
+        Boolean mask, [Z,Y,X].
+    coords : tuple
+        (Z, Y, X) coordinate arrays of the grid.
+
+    Returns
+    -------
+    voxels : array_like
+        Array of N voxel coordinates in 3D (x,y,z), dim Nx3.
+    """
+    Z, Y, X = coords
+    zz, yy, xx = np.nonzero(mask)
+    
+    return np.column_stack([X[xx], Y[yy], Z[zz]])
+
+def organ_voxel_weights(organ, points, supersample=4):
+    """Voxels of a structure with the fraction of each voxel
+    inside the contour, for partial-volume DVHs. Each slice
+    is rasterized on a grid supersample times finer in x
+    and y and averaged back onto the dose grid.
+    
+    Use as organ['voxels'], organ['weights'] before calling
+    total_rad_calc and the DVH functions.
 
     Parameters
     ----------
@@ -959,32 +3275,35 @@ def organ_voxels(organ,points):
         Structure dict object from read_structure().
     points : array_like
         2D grid coordinates from grid_points()
+    supersample : int, optional
+        Sub-voxels per voxel edge, by default 4.
 
     Returns
     -------
     voxels : array_like
         Array of N voxel coordinates in 3D (x,y,z), dim Nx3.
+    weights : array_like
+        Fraction (0-1] of each voxel inside the structure.
     """
+    X = np.unique(points[:,0])
+    Y = np.unique(points[:,1])
     
-    #Generate temporary dimension for np.vstack()
-    voxels = np.array(['x','y','z']) 
+    #Sub-voxel centres, ascending
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+    Xs = (X[:,None] + offsets * (X[1] - X[0])).ravel()
+    Ys = (Y[:,None] + offsets * (Y[1] - Y[0])).ravel()
     
-    #For each slice in a given organ contour
-    for axialslice in organ['contours']:
-        
-        polygon = np.column_stack([axialslice[0],axialslice[1]])
-        path = mpl.path.Path(polygon)
-        
-        #Generate a mask of points
-        mask = path.contains_points(points)
-        z_coord = np.ones(np.sum(mask))*axialslice[2][0]
-        xyz_coord = np.column_stack([points[mask],z_coord])
-        voxels = np.vstack([voxels,xyz_coord])
-        
-    voxels = np.delete(voxels,0,0) #removing temporary dimension ['x','y','z']
-    voxels = np.array(voxels,dtype=float).reshape([-1,3])
+    voxels, weights = [], []
+    for z, mask in rasterize_contours(organ['contours'], Xs, Ys).items():
+        fraction = mask.reshape(len(Y), supersample, len(X), supersample).mean(axis=(1,3))
+        yy, xx = np.nonzero(fraction)
+        voxels.append(np.column_stack([X[xx], Y[yy], np.full(len(xx), z)]))
+        weights.append(fraction[yy, xx])
     
-    return voxels
+    if not voxels:
+        return np.zeros((0, 3)), np.zeros(0)
+    
+    return np.vstack(voxels), np.concatenate(weights)
 
 def organ_volume(organ):
     """Computes the volume of a target structure.
@@ -1006,10 +3325,13 @@ def organ_volume(organ):
     volume = organ['voxels'].shape[0] * dx * dy * dz / 1000
     return volume
 
-def closest_OAR_voxels(OAR_name,target_name, structures):
+def closest_OAR_voxels(OAR_name,target_name, structures, n_voxels=1000):
     """ Identifies the voxels composing the nearest 1.5cc
     of an OAR to a specified target volume (using 1000
     voxels at 1.5mm^3 per voxel).
+    
+    Uses the cached KD-trees from structure_tree() instead
+    of dense distance matrices.
 
     Parameters
     ----------
@@ -1019,22 +3341,25 @@ def closest_OAR_voxels(OAR_name,target_name, structures):
         Specified organ-at-risk 
     target_name : string 
         Specified target volume
+    n_voxels : int, optional
+        Number of OAR voxels, by default 1000.
 
     Returns
     -------
-    voxels : ???
-        Voxels composing closest 1.5 cc to the target volume
+    nearest_voxels : array_like
+        Distance (mm) from each of the OAR voxels closest to
+        the target centroid to the nearest target voxel.
     """
     
     target = structures[target_name]
     OAR = structures[OAR_name]
     
     target_centroid = np.mean(target['voxels'], axis = 0)
-    centre_dist = spdist.cdist([target_centroid],OAR['voxels'])[0]
-    order = np.argsort(centre_dist)
-    voxels = OAR['voxels'][order][:1000]
+    k = min(n_voxels, len(OAR['voxels']))
+    _, order = structure_tree(OAR).query(target_centroid, k=k)
+    voxels = OAR['voxels'][np.atleast_1d(order)]
     
-    nearest_voxels = spdist.cdist(target['voxels'],voxels,'euclidean').min(axis=0)
+    nearest_voxels, _ = structure_tree(target).query(voxels)
 
     return nearest_voxels
 
@@ -1064,6 +3389,225 @@ def closest_OAR_proximity(OAR_name,target_name, structures):
     
     return proximity
 
+def structure_tree(organ):
+    """ KD-tree of a structure's voxels, built on first use
+    and cached in the structure dict (organ['kdtree']) so
+    any number of OAR/target pairs can be queried.
+
+    Parameters
+    ----------
+    organ : dict
+        Structure dict object from read_structure().
+
+    Returns
+    -------
+    tree : scipy.spatial.cKDTree
+        Spatial index of organ['voxels'].
+    """
+    if organ.get('kdtree') is None:
+        organ['kdtree'] = cKDTree(organ['voxels'])
+    
+    return organ['kdtree']
+
+def OAR_target_distances(OAR_name, target_name, structures):
+    """ Distance from every OAR voxel to the nearest
+    target voxel.
+
+    Parameters
+    ----------
+    structures : dict
+        Structures dict output by read_structure().
+    OAR_name : string
+        Specified organ-at-risk 
+    target_name : string 
+        Specified target volume
+
+    Returns
+    -------
+    distances : array_like
+        Distance (mm) per OAR voxel, same order as
+        structures[OAR_name]['voxels'].
+    """
+    distances, _ = structure_tree(structures[target_name]).query(
+        structures[OAR_name]['voxels'])
+    
+    return distances
+
+def nearest_OAR_volume(OAR_name, target_name, structures, volume=1.5):
+    """ The sub-volume of an OAR closest to the target,
+    e.g. the nearest 1.5cc, ranked by distance to the
+    nearest target voxel.
+
+    Parameters
+    ----------
+    structures : dict
+        Structures dict output by read_structure().
+    OAR_name : string
+        Specified organ-at-risk 
+    target_name : string 
+        Specified target volume
+    volume : float, optional
+        Sub-volume in cc, by default 1.5.
+
+    Returns
+    -------
+    voxels : array_like
+        Nx3 coordinates of the OAR voxels in the sub-volume.
+    distances : array_like
+        Distance (mm) of each of those voxels to the target.
+    """
+    OAR = structures[OAR_name]
+    distances = OAR_target_distances(OAR_name, target_name, structures)
+    
+    voxel_cc = OAR['volume (cc)'] / len(OAR['voxels'])
+    n = int(min(len(distances), max(1, round(volume / voxel_cc))))
+    nearest = np.argpartition(distances, n - 1)[:n]
+    nearest = nearest[np.argsort(distances[nearest])]
+    
+    return OAR['voxels'][nearest], distances[nearest]
+
+def OAR_distance_histogram(OAR_name, target_name, structures, bin_width=1.0):
+    """ Histogram of OAR volume by distance to the target.
+
+    Parameters
+    ----------
+    structures : dict
+        Structures dict output by read_structure().
+    OAR_name : string
+        Specified organ-at-risk 
+    target_name : string 
+        Specified target volume
+    bin_width : float, optional
+        Distance bin width in mm, by default 1.0.
+
+    Returns
+    -------
+    edges : array_like
+        Lower edge of each distance bin (mm).
+    volume : array_like
+        OAR volume (cc) in each bin.
+    """
+    OAR = structures[OAR_name]
+    distances = OAR_target_distances(OAR_name, target_name, structures)
+    
+    voxel_cc = OAR['volume (cc)'] / len(OAR['voxels'])
+    counts = np.bincount(np.floor(distances / bin_width).astype(int))
+    edges = np.arange(len(counts)) * bin_width
+    
+    return edges, counts * voxel_cc
+
+def target_distance_map(target_mask, coords):
+    """ Signed Euclidean distance (mm) from every grid voxel
+    to the target boundary: positive outside the target,
+    negative inside. Computed once per target with two
+    distance transforms.
+
+    Parameters
+    ----------
+    target_mask : array_like
+        Boolean target mask, [Z,Y,X], from organ_mask().
+    coords : tuple
+        (Z, Y, X) coordinate arrays of the grid.
+
+    Returns
+    -------
+    signed : array_like
+        Signed distance map (float32), [Z,Y,X].
+    """
+    spacing = _grid_spacing(coords)
+    
+    outside = ndimage.distance_transform_edt(~target_mask, sampling=spacing)
+    inside = ndimage.distance_transform_edt(target_mask, sampling=spacing)
+    
+    return (outside - inside).astype(np.float32)
+
+@profiled
+def geometry_metrics(masks, target_name, coords, margins=(0,5,10,15,20)):
+    """ Overlap, margin and surface-distance metrics between
+    a target and every other structure, from masks on one
+    grid. The target distance maps are built once and
+    reused for every OAR.
+    
+    For each OAR:
+        overlap (cc)       OAR volume inside the target.
+        V<x>mm (cc)        OAR volume within x mm of the
+                           target (overlap-volume histogram).
+        min/mean margin    Signed distance of the OAR voxels
+                           to the target boundary (mm),
+                           negative when inside the target.
+        hausdorff          Symmetric Hausdorff distance
+                           between the two surfaces (mm).
+        HD95               95th percentile version (mm).
+        mean surface dist  Symmetric mean surface distance.
+    
+    If the target mask is empty (e.g. the target is off
+    the grid), every metric but the OAR volume is NaN.
+
+    Parameters
+    ----------
+    masks : dict
+        Structure name -> boolean [Z,Y,X] mask from organ_mask().
+    target_name : string
+        Target structure in masks.
+    coords : tuple
+        (Z, Y, X) coordinate arrays of the grid.
+    margins : tuple, optional
+        Distances (mm) for the overlap-volume histogram.
+
+    Returns
+    -------
+    rows : list
+        List of dicts, one per OAR.
+    """
+    spacing = _grid_spacing(coords)
+    voxel_cc = np.prod(spacing) / 1000
+    
+    target = masks[target_name]
+    if target.any():
+        signed = target_distance_map(target, coords)
+        target_surface = _mask_surface(target)
+        to_target_surface = ndimage.distance_transform_edt(~target_surface, sampling=spacing)
+    
+    rows = []
+    for name, mask in masks.items():
+        if name == target_name or not mask.any():
+            continue
+        
+        if not target.any():
+            row = {'structure': name,
+                   'target': target_name,
+                   'volume (cc)': float(mask.sum() * voxel_cc)}
+            for metric in (['overlap (cc)', 'min margin', 'mean margin'] +
+                           [f'V{m}mm (cc)' for m in margins] +
+                           ['hausdorff', 'HD95', 'mean surface dist']):
+                row[metric] = np.nan
+            rows.append(row)
+            continue
+        
+        margin = signed[mask]
+        row = {'structure': name,
+               'target': target_name,
+               'volume (cc)': float(mask.sum() * voxel_cc),
+               'overlap (cc)': float(np.count_nonzero(margin <= 0) * voxel_cc),
+               'min margin': float(margin.min()),
+               'mean margin': float(margin.mean())}
+        for m in margins:
+            row[f'V{m}mm (cc)'] = float(np.count_nonzero(margin <= m) * voxel_cc)
+        
+        #Surface to surface, both directions
+        surface = _mask_surface(mask)
+        oar_to_target = to_target_surface[surface]
+        target_to_oar = ndimage.distance_transform_edt(~surface, sampling=spacing)[target_surface]
+        both = np.concatenate([oar_to_target, target_to_oar])
+        row['hausdorff'] = float(max(oar_to_target.max(), target_to_oar.max()))
+        row['HD95'] = float(max(np.percentile(oar_to_target, 95), 
+                                np.percentile(target_to_oar, 95)))
+        row['mean surface dist'] = float(both.mean())
+        
+        rows.append(row)
+    
+    return rows
+
 ###############################################################################
 ############################## PLAN FUNCTIONS #################################
 ###############################################################################
@@ -1086,6 +3630,95 @@ def get_prescription(plan):
 ############################## DOSE FUNCTIONS #################################
 ###############################################################################
 
+class DoseContext(object):
+    """Summed dose grid, grid coordinates and interpolator
+    for one plan, computed once and shared by read_structure
+    and total_rad_calc. Get one with dose_context(), which
+    memoizes on the dose files.
+    """
+    
+    def __init__(self, dose_list):
+        self.dose_list = dose_list
+        self.grid, _ = sum_dose(dose_list)
+        self.Z, self.Y, self.X = dose_grid_coords(dose_list[0])
+        
+        #[X,Y] coordinates of each pixel, same as grid_points()
+        xx,yy = np.meshgrid(self.X, self.Y)
+        self.points = np.column_stack([xx.ravel(), yy.ravel()])
+        
+        #RegularGridInterpolator wants ascending axes
+        axes = [self.Z, self.Y, self.X]
+        values = self.grid
+        for ii in range(3):
+            if len(axes[ii]) > 1 and axes[ii][1] < axes[ii][0]:
+                axes[ii] = axes[ii][::-1]
+                values = np.flip(values, axis=ii)
+        self.interpolator = interp.RegularGridInterpolator(tuple(axes), values)
+    
+    def dose_at(self, voxels):
+        """Dose (Gy) at one or more [x,y,z] points, see total_rad_calc."""
+        voxels = np.array(voxels, dtype=float)
+        if voxels.shape == (3,):
+            voxels = np.array([voxels])
+        
+        return self.interpolator(voxels[:, ::-1])
+    
+    def close(self):
+        """Release the dose grid and interpolator."""
+        self.grid = None
+        self.interpolator = None
+        self.points = None
+
+# Contexts of the most recent plans, oldest first.
+_dose_contexts = {}
+_dose_context_size = 2
+
+def dose_context(dose_list):
+    """Returns the DoseContext for a list of RTDOSE files,
+    building it only the first time the plan is seen.
+    
+    Only the last two plans are kept, so looping over
+    patients does not accumulate dose grids. Call
+    close_dose_context() to free memory explicitly.
+
+    Parameters
+    ----------
+    dose_list : list
+        List of dose DICOMs to add together
+
+    Returns
+    -------
+    context : DoseContext
+        Shared dose grid and interpolator for the plan.
+    """
+    key = _dose_key(dose_list)
+    
+    if key in _dose_contexts:
+        #Move to the end as the most recently used
+        context = _dose_contexts.pop(key)
+    else:
+        context = DoseContext(dose_list)
+    _dose_contexts[key] = context
+    
+    while len(_dose_contexts) > _dose_context_size:
+        oldest = next(iter(_dose_contexts))
+        _dose_contexts.pop(oldest).close()
+    
+    return context
+
+def close_dose_context(dose_list=None):
+    """Evicts the DoseContext of a plan, or of every plan
+    if dose_list is None, releasing its memory.
+    """
+    if dose_list is None:
+        keys = list(_dose_contexts)
+    else:
+        keys = [_dose_key(dose_list)]
+    
+    for key in keys:
+        if key in _dose_contexts:
+            _dose_contexts.pop(key).close()
+
 def total_rad_calc(dose_list,voxels):
     """Computes the total 3D dose distribution of 
     all control points in the fraction.
@@ -1093,6 +3726,10 @@ def total_rad_calc(dose_list,voxels):
     Voxels within the bounds of the 3D dose
     distribution found in patient RTDOSE are
     calculated using linear interpolation.
+    
+    The summed grid and interpolator are shared
+    through dose_context(), so repeated calls for
+    the same plan do not re-sum the arcs.
 
     Parameters
     ----------
@@ -1107,43 +3744,15 @@ def total_rad_calc(dose_list,voxels):
         Total dose (Gy) delivered to each respective
         3D point in voxels.
     """
-    voxels_copy = voxels.copy()
-    if voxels_copy.shape == (3,):
-        voxels_copy = np.array([voxels_copy])
-    voxels_copy[:,[0, 2]] = voxels_copy[:,[2, 0]]
-    
-    #FIND LOCATION OF EACH PIXEL
-    #Find the origin of the image in patient coordinates
-    X0,Y0,Z0 = dose_list[0].ImagePositionPatient
-    #Find the number of rows in the image
-    rows = dose_list[0].Rows
-    #Find the number of columns in the image
-    cols = dose_list[0].Columns
-    #Find the image resolution, given as [space between rows, space between columns]
-    xres,yres = dose_list[0].PixelSpacing
-    
-    #Arange(start,stop,step) returns an array of evenly spaced values
-    #Gives location of each pixel in patient coordinates
-    #Want yres, gives space between columns
-    X = np.arange(0,cols*yres,yres) + X0 
-    #Want xres, gives space between rows
-    Y = np.arange(0,rows*xres,xres) + Y0 
-    
-    
-    #GridFrameOffsetVector = array containing dose image plane offsets (mm) of the dose image frames in a multi-frame dose. Required if multi-frame pixel data are present and Frame Increment Pointer (0028,0009) points to Grid Frame Offset Vector (3004,000C). 
-    Z = np.asarray(dose_list[0].GridFrameOffsetVector) + Z0
-
-    combined_grid = add_arcs(dose_list)
-    
-    #DOSE CALCULATION FOR SLICE
-    #Dose grid was interpolated when extracted
-    dose_interp = interp.RegularGridInterpolator((Z, Y, X), combined_grid)
-    dose_Gy = dose_interp(voxels_copy)
+    dose_Gy = dose_context(dose_list).dose_at(voxels)
  
     return dose_Gy
 
 def DVH(organ,maxdose=70.0,res=999):
     """Computes the dose-volume histogram for a structure.
+    
+    Uses one sort of the voxel doses and a binary search
+    per dose level, instead of a full pass per level.
 
     Parameters
     ----------
@@ -1162,11 +3771,119 @@ def DVH(organ,maxdose=70.0,res=999):
         Percent volume recieving respective dose in doserange.
     """
     doserange = np.linspace(0,maxdose,res)
-    proportion = np.array([(organ['dose'] > dose).sum() for dose in doserange]
-                          ,dtype=float)
-    proportion *= 100.0 / len(organ['dose'])
+    dose = np.sort(np.ravel(organ['dose']))
+    weights = organ.get('weights')
+    
+    #Volume with dose strictly above each level
+    index = np.searchsorted(dose, doserange, side='right')
+    if weights is None:
+        proportion = (len(dose) - index).astype(float)
+        proportion *= 100.0 / len(dose)
+    else:
+        w = np.asarray(weights, dtype=float)[np.argsort(np.ravel(organ['dose']), kind='stable')]
+        above = np.concatenate([np.cumsum(w[::-1])[::-1], [0]])
+        proportion = above[index] * 100.0 / w.sum()
+    
+    return doserange,proportion
+
+def dose_volume_histogram(dose, weights=None, bin_width=0.01, maxdose=None,
+                          cumulative=True):
+    """Dose-volume histogram from voxel doses in a single
+    np.bincount pass.
+
+    Parameters
+    ----------
+    dose : array_like
+        Dose (Gy) of each voxel in the structure.
+    weights : array_like, optional
+        Volume (or fraction of a voxel) of each voxel, for
+        partial-volume voxels at the contour edge. By default
+        every voxel counts the same.
+    bin_width : float, optional
+        Dose bin width in Gy, by default 0.01.
+    maxdose : float, optional
+        Upper limit of the histogram, by default the maximum
+        dose in the structure.
+    cumulative : bool, optional
+        Cumulative DVH (volume receiving at least each dose)
+        if True, differential (volume in each bin) if False.
+
+    Returns
+    -------
+    doserange : array_like
+        Lower edge of each dose bin in Gy.
+    proportion : array_like
+        Percent volume for each bin.
+    """
+    dose = np.ravel(dose)
+    if maxdose is None:
+        maxdose = dose.max() if dose.size else 0
+    nbins = int(np.floor(maxdose / bin_width)) + 1
+    
+    index = np.clip(np.floor(dose / bin_width).astype(int), 0, nbins - 1)
+    hist = np.bincount(index, weights=weights, minlength=nbins).astype(float)
+    total = hist.sum()
+    if cumulative:
+        hist = np.cumsum(hist[::-1])[::-1]
+    
+    doserange = np.arange(nbins) * bin_width
+    proportion = hist * 100.0 / total if total > 0 else hist
     
     return doserange,proportion
+
+def dose_at_volume(dose, value, weights=None):
+    """Minimum dose received by the hottest value% of a
+    structure, linearly interpolated between voxels.
+
+    Parameters
+    ----------
+    dose : array_like
+        Dose (Gy) of each voxel in the structure.
+    value : float
+        Percentage volume of structure.
+    weights : array_like, optional
+        Volume of each voxel, by default equal.
+
+    Returns
+    -------
+    float
+        Dose in Gy.
+    """
+    dose = np.ravel(dose)
+    order = np.argsort(dose)[::-1]
+    if weights is None:
+        weights = np.ones(dose.size)
+    w = np.asarray(weights, dtype=float)[order]
+    
+    #Percent volume receiving at least each (descending) dose
+    volume = np.cumsum(w) * 100.0 / w.sum()
+    
+    return float(np.interp(value, volume, dose[order]))
+
+def volume_at_dose(dose, value, weights=None):
+    """Percent volume of a structure receiving at least
+    value Gy.
+
+    Parameters
+    ----------
+    dose : array_like
+        Dose (Gy) of each voxel in the structure.
+    value : float
+        Dose level in Gy.
+    weights : array_like, optional
+        Volume of each voxel, by default equal.
+
+    Returns
+    -------
+    float
+        Volume as a percentage of structure volume.
+    """
+    dose = np.ravel(dose)
+    if weights is None:
+        weights = np.ones(dose.size)
+    weights = np.asarray(weights, dtype=float)
+    
+    return float(weights[dose >= value].sum() * 100.0 / weights.sum())
     
 def Dxx(organ,value):
     """Computes the minimum dose delivered to a percentage
@@ -1184,6 +3901,9 @@ def Dxx(organ,value):
     Dxx : float
         Minimum dose in structure volume (in Gy).
     """
+    if 'dose' in organ:
+        return dose_at_volume(organ['dose'], value, organ.get('weights'))
+    
     doserange,proportion = organ['DVH']
     Dxx = doserange[argfind_nearest(proportion,value)]
 
@@ -1232,8 +3952,12 @@ def Vxx(organ,plan,value):
     
    
     prescription = get_prescription(plan)
-    doserange,proportion = organ['DVH']
     target = prescription * value/100
+    
+    if 'dose' in organ:
+        return volume_at_dose(organ['dose'], target, organ.get('weights'))
+    
+    doserange,proportion = organ['DVH']
     Vxx = proportion[argfind_nearest(doserange,target)]# * organ['volume (cc)']/100
 
     return Vxx
@@ -1507,36 +4231,206 @@ def _validate_attr_equality(obj_1, obj_2, attr):
         return False
     return True
     
-def _person_names_callback(dataset, data_element):
-    if data_element.VR == 'PN':
-        data_element.value = 'anonymous'
-
-def _curves_callback(dataset, data_element):
-    if data_element.tag.group & 0xFF00 == 0x5000:
-        del dataset[data_element.tag]
-
-def _anonymize(path,fname,n,save_dir):     
-    for i,name in enumerate(fname):
-        dataset = pydicom.dcmread(os.path.join(path,name))
-        dataset.PatientID = 'id'
-        dataset.walk(_person_names_callback)
-        dataset.walk(_curves_callback)
-
-        if 'OtherPatientIDs' in dataset:
-            delattr(dataset, 'OtherPatientIDs')
-        if 'OtherPatientIDsSequence' in dataset:
-            del dataset.OtherPatientIDsSequence
-        tag = 'PatientBirthDate'
-        if tag in dataset:
-            dataset.data_element(tag).value = '00000000'   
-        tag = 'PatientSex'
-        if tag in dataset:
-            dataset.data_element(tag).value = '0'
-        dataset.remove_private_tags()
-        
-        save_name = dataset.Modality+'_'+str(n).zfill(4)+'.dcm'
-        print(save_name)
-        dataset.save_as(os.path.join(save_dir,save_name))
+def _anonymize(path,fname,n,save_dir):
+    # Worker for batch_anonymize, returns the saved file names. Files are
+    # saved as Modality_NNNN.dcm, with a _KKKK suffix when the folder has
+    # more than one file of a modality (e.g. CT slices).
+    modalities = [pydicom.dcmread(os.path.join(path,name),stop_before_pixels=True,
+                                  specific_tags=['Modality']).Modality
+                  for name in fname]
+    counts = {m: modalities.count(m) for m in modalities}
+    seen = dict.fromkeys(counts,0)
+
+    save_names = []
+    for name,modality in zip(fname,modalities):
+        save_name = modality+'_'+str(n).zfill(4)
+        if counts[modality] > 1:
+            seen[modality] += 1
+            save_name += '_'+str(seen[modality]).zfill(4)
+        save_name += '.dcm'
+        _anonymize_file(os.path.join(path,name),os.path.join(save_dir,save_name))
+        save_names.append(save_name)
+    return save_names
+
+def _anonymize_file(src,dst):
+    # Anonymize one file. Elements larger than _defer_size are left on disk
+    # by dcmread; when that includes the pixel data (and nothing follows it)
+    # only the header is rewritten and the pixel data element is copied
+    # byte for byte from src, so the image is never held in memory.
+    # Written to a temporary file first, so dst is either complete or absent.
+    dataset = pydicom.dcmread(src,defer_size=_defer_size)
+    pixels = dataset.get_item(_pixel_data_tag,keep_deferred=True)
+    stream = (isinstance(pixels,pydicom.dataelem.RawDataElement)
+              and pixels.value is None
+              and max(dataset.keys()) == _pixel_data_tag
+              and dataset.file_meta.TransferSyntaxUID != pydicom.uid.DeflatedExplicitVRLittleEndian)
+    if stream:
+        # Tag + length (implicit VR), or tag + VR + reserved + length.
+        offset = pixels.value_tell - (8 if pixels.is_implicit_VR else 12)
+        del dataset[_pixel_data_tag]
+
+    dataset.PatientID = 'id'
+    _anonymize_dataset(dataset)
+    tag = 'PatientBirthDate'
+    if tag in dataset:
+        dataset.data_element(tag).value = '00000000'   
+    tag = 'PatientSex'
+    if tag in dataset:
+        dataset.data_element(tag).value = '0'
+
+    tmp = dst + '.tmp'
+    dataset.save_as(tmp)
+    if stream:
+        with open(src,'rb') as fsrc, open(tmp,'ab') as fdst:
+            fsrc.seek(offset)
+            shutil.copyfileobj(fsrc,fdst,_copy_size)
+    os.replace(tmp,dst)
+
+def _anonymize_dataset(dataset):
+    # One recursive pass doing what the person name, curves and
+    # remove_private_tags walks did: blank person names and drop
+    # private tags, curves (group 50xx) and other patient IDs.
+    for tag in list(dataset.keys()):
+        if (tag.is_private or tag.group & 0xFF00 == 0x5000
+                or tag in _other_patient_id_tags):
+            del dataset[tag]
+            continue
+        data_element = dataset[tag]
+        if data_element.VR == 'PN':
+            data_element.value = 'anonymous'
+        elif data_element.VR == 'SQ':
+            for item in data_element.value:
+                _anonymize_dataset(item)
+
+def _peak_rss():
+    # Peak resident set size in bytes since the last _reset_peak_rss.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        return None
+
+def _reset_peak_rss():
+    # Linux only, elsewhere the peak is for the whole process.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _io_counters():
+    # Bytes read and written by this process so far.
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError):
+        pass
+    try:
+        import psutil
+        io = psutil.Process().io_counters()
+        return io.read_bytes, io.write_bytes
+    except (ImportError, AttributeError):
+        return 0, 0
+
+_volume_magic = b'VOLC'
+
+class _StoreWriter(object):
+    # Returned by VolumeStore.writer.
+    
+    def __init__(self, store, modality, patient_id):
+        self.store = store
+        self.modality = modality
+        self.patient_id = patient_id
+        self.codec = store.codecs[modality]
+        self.start = 0
+        
+        self._file = None
+        if self.codec.compression:
+            self._file = VolumeWriter(store._file(modality, patient_id), 
+                                      store.shape, store.dtype, self.codec)
+    
+    def write(self, slab):
+        if self._file is not None:
+            self._file.write(slab)
+        else:
+            arr = self.store._array(self.modality, 'r+')
+            ii = self.store._lookup[str(self.patient_id)]
+            arr[ii, self.start:self.start + len(slab)] = self.codec.encode(slab)
+        self.start += len(slab)
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        else:
+            if self.start != self.store.shape[0]:
+                raise ValueError(f'Only {self.start} of {self.store.shape[0]} planes written.')
+            self.store._array(self.modality, 'r+').flush()
+        self.store._flag(self.modality, self.patient_id)
+
+# Largest pole of the B-spline prefilter for each order.
+_spline_poles = {2: 0.171573, 3: 0.267949, 4: 0.361341, 5: 0.430575}
+
+def _transform_plan(image_shape, image_thickness, pixel_spacing, extra_shift, deformation,
+                    crop, shape, mode):
+    # Zoom steps, per-axis segments and output shape for transform_image.
+    if crop is None:
+        crop = [(0, n) for n in shape]
+    
+    # Same zoom factors and output shape as resample.
+    zoom = np.array([float(pixel_spacing[0]), float(pixel_spacing[1]), float(image_thickness)])
+    resampled_shape = [int(round(n * z)) for n, z in zip(image_shape, zoom)]
+    
+    shift = np.round(np.asarray(deformation, dtype = float) + 
+                     np.asarray(extra_shift, dtype = float)).astype(int)
+    
+    # interpolation.zoom maps the corner voxels onto each other.
+    step = [(n_in - 1) / (n_out - 1) if n_out > 1 else 0 
+            for n_in, n_out in zip(image_shape, resampled_shape)]
+    
+    segments = [_transform_segments(c, s, n, n_res, mode) 
+                for c, s, n, n_res in zip(crop, shift, shape, resampled_shape)]
+    
+    return step, segments, [c[1] - c[0] for c in crop]
+
+def _zstd():
+    # Optional dependency, only needed for compression = 'zstd'.
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("VolumeCodec compression = 'zstd' needs the zstandard package.")
+    return zstandard
+
+def _blosc():
+    # Optional dependency, only needed for compression = 'blosc'.
+    try:
+        import blosc
+    except ImportError:
+        raise ImportError("VolumeCodec compression = 'blosc' needs the blosc package.")
+    return blosc
+
+_pixel_data_tag = pydicom.tag.Tag('PixelData')
+_other_patient_id_tags = (pydicom.tag.Tag('OtherPatientIDs'),
+                          pydicom.tag.Tag('OtherPatientIDsSequence'))
+_defer_size = '1 MB'
+_copy_size = 16 * 2**20
+
+def _anonymized_count(save_dir):
+    # Highest number in Modality_NNNN[_KKKK].dcm names in save_dir, 0 if none.
+    n = 0
+    for name in os.listdir(save_dir):
+        parts = name[:-4].split('_')
+        if name.endswith('.dcm') and len(parts) > 1 and parts[1].isdigit():
+            n = max(n,int(parts[1]))
+    return n
  
 def _metrics_cmap(val):
     #colourmap for metrics
@@ -1572,4 +4466,105 @@ def _key_walk(dict_,entry):
 
 def _reshape_data(loop):
    data = loop.ContourData
-   return np.reshape(np.array(data),(3, len(data) // 3),order='F')
\ No newline at end of file
+   return np.reshape(np.array(data),(3, len(data) // 3),order='F')
+
+def _interpolated_add(dose_sum, ref, dose, grid, scaling):
+    # Add grid (from dose) onto dose_sum (on the grid of ref), one 
+    # reference frame at a time to keep the query points small.
+    axes = list(dose_grid_coords(dose))
+    values = grid
+    # RegularGridInterpolator wants ascending axes.
+    for ii in range(3):
+        if len(axes[ii]) > 1 and axes[ii][1] < axes[ii][0]:
+            axes[ii] = axes[ii][::-1]
+            values = np.flip(values, axis = ii)
+    
+    dose_interp = interp.RegularGridInterpolator(tuple(axes), values, 
+                                                 bounds_error = False, fill_value = 0)
+    
+    Z, Y, X = dose_grid_coords(ref)
+    yy, xx = np.meshgrid(Y, X, indexing = 'ij')
+    points = np.column_stack([np.zeros(yy.size), yy.ravel(), xx.ravel()])
+    for kk, z in enumerate(Z):
+        points[:, 0] = z
+        frame = dose_interp(points).reshape(yy.shape)
+        dose_sum[kk] += frame.astype(dose_sum.dtype) * scaling
+
+def _dose_key(dose_list):
+    # Identify a plan's dose files by SOP instance, or object if missing.
+    return tuple(getattr(d, 'SOPInstanceUID', None) or id(d) for d in dose_list)
+
+def _grid_spacing(coords):
+    # Voxel size (mm) along each axis of a (Z, Y, X) grid.
+    return np.array([np.abs(c[1] - c[0]) if len(c) > 1 else 1.0 for c in coords])
+
+def _mask_surface(mask):
+    # Voxels of the mask with a face-neighbour outside it.
+    return mask & ~ndimage.binary_erosion(mask, border_value=0)
+
+def _transform_segments(crop, s, n, n_res, mode):
+    # Runs of the crop box whose source voxels are contiguous in the 
+    # resampled image, as (output start, source start, length) tuples.
+    j = np.arange(*crop)
+    src = j - s
+    if mode == 'wrap':
+        src = src % n
+    valid = (src >= 0) & (src < min(n, n_res))
+    
+    segments = []
+    start = None
+    for k in range(len(j) + 1):
+        if (start is not None and 
+                (k == len(j) or not valid[k] or src[k] != src[k - 1] + 1)):
+            segments.append((start, src[start], k - start))
+            start = None
+        if start is None and k < len(j) and valid[k]:
+            start = k
+    
+    return segments
+
+def _shift_blocks(n, s, mode):
+    # (source, destination) slice pairs for shifting an axis of length n by s.
+    # A source of None marks a destination that is zero-filled.
+    if mode == 'wrap':
+        s = s % n
+        if s == 0:
+            return [(slice(0, n), slice(0, n))]
+        return [(slice(0, n - s), slice(s, n)), (slice(n - s, n), slice(0, s))]
+    
+    s = int(np.clip(s, -n, n))
+    if s >= 0:
+        return [(slice(0, n - s), slice(s, n)), (None, slice(0, s))]
+    return [(slice(-s, n), slice(0, n + s)), (None, slice(n + s, n))]
+
+def _shift_axis_inplace(arr, s, axis, mode):
+    # Shift arr along one axis in place, buffering only the wrapped part.
+    n = arr.shape[axis]
+    if mode == 'wrap':
+        s = s % n
+    else:
+        s = int(np.clip(s, -n, n))
+    if s == 0:
+        return
+    
+    view = np.moveaxis(arr, axis, 0)
+    step = abs(s)
+    if s > 0:
+        edge = view[n - s:].copy() if mode == 'wrap' else None
+        # Move blocks from the end backwards so nothing is overwritten early.
+        for stop in range(n - s, 0, -step):
+            start = max(stop - step, 0)
+            view[start + s:stop + s] = view[start:stop]
+        if edge is None:
+            view[:s] = 0
+        else:
+            view[:s] = edge
+    else:
+        edge = view[:step].copy() if mode == 'wrap' else None
+        for start in range(step, n, step):
+            stop = min(start + step, n)
+            view[start - step:stop - step] = view[start:stop]
+        if edge is None:
+            view[n - step:] = 0
+        else:
+            view[n - step:] = edge
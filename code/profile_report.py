@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Summarise the profiling log written by the pipeline (profile_log in
+run_pipeline.py and 05_Dose_to_Image.py).
+
+Prints the hot spots across the cohort, ranked by self time (time spent in
+a function itself, not in the profiled functions it calls), and the time,
+peak memory and I/O per patient and stage. Both tables are also saved as
+CSV next to the log.
+
+"""
+
+import pandas as pd
+
+import os
+
+from dicomMethods import profile_summary
+
+
+profile_log = 'H:/HN_TransferLearning/2_output/profile.jsonl'
+
+top = 20
+
+
+if __name__ == "__main__":
+
+    functions, patients = profile_summary(profile_log)
+
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.float_format', '{:.3f}'.format)
+
+    print(f'Hot spots ({len(functions)} profiled names, times in seconds):')
+    print(functions.head(top))
+
+    print(f'\nPer patient ({len(patients)} rows):')
+    print(patients.describe().loc[['mean', 'min', 'max']])
+
+    slowest = patients.sort_values('wall', ascending = False).head(5)
+    print('\nSlowest patients:')
+    print(slowest)
+
+    base = os.path.splitext(profile_log)[0]
+    functions.to_csv(base + '_functions.csv')
+    patients.to_csv(base + '_patients.csv')
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Run the preprocessing pipeline (05_Dose_to_Image.py to 08_Slice_to_TL.py)
+for the whole cohort.
+
+The per-patient stages (05 and 06) run in a process pool, one patient per
+task. The pool is sized by the number of cores and by how many patients fit
+in the memory budget at once. Stage completion is kept in a JSON manifest,
+so a rerun picks up where the last one stopped. Failed patients are retried
+and never stop the other patients from running.
+
+Every run rechecks stage 05 for each patient against its cache key (see
+patient_key in 05_Dose_to_Image.py): patients whose DICOM files,
+registration row or parameters are unchanged are skipped, the rest are
+recomputed, or taken from the 05 cache when an earlier result matches.
+
+The cohort stages (07 and 08) combine every patient, so they only run once
+all patients have finished the per-patient stages, and rerun when any
+patient's key changed, rewriting the slices of those patients.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import importlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dicomMethods import profile, start_profiling
+
+
+manifest_file = 'H:/HN_TransferLearning/2_output/pipeline_manifest.json'
+reg_shift_file = 'H:/HN_TransferLearning/0_data/registration/RegistrationShifts.xlsx'
+
+# Sizing of the process pool.
+memory_budget_gb = 48
+patient_memory_gb = 2 # Peak per patient with single_pass slabs (inputs + memory_gb),
+                       # ~4 GB with whole volumes, ~12 GB without single_pass.
+max_workers = None # None to use every core.
+
+max_retries = 2
+
+# JSON-lines log of time, memory and I/O per patient, stage and function,
+# see profile_report.py. None to turn profiling off.
+profile_log = 'H:/HN_TransferLearning/2_output/profile.jsonl'
+
+# (stage name, script, function) run for each patient in order.
+patient_stages = [('05_dose_to_image', '05_Dose_to_Image', 'dose_to_image'),
+                  ('06_crop_images', '06_Crop_Images', 'crop_images')]
+
+# (stage name, script, function) run once for the cohort.
+cohort_stages = [('07_slice_images', '07_Slice_Images', 'slice_images'),
+                 ('08_slice_to_tl', '08_Slice_to_TL', 'slices_to_tl'),
+                 ('08_slice_stacks', '08_Slice_to_TL', 'slices_to_stacks')]
+
+# Cohort stages that take the patient list, and the patients to redo.
+patient_list_stages = ['07_slice_images', '08_slice_stacks']
+
+
+def pool_size(n_patients, memory_budget_gb = memory_budget_gb,
+              patient_memory_gb = patient_memory_gb, max_workers = max_workers):
+    '''
+    Number of worker processes, limited by cores, memory and patients.
+    '''
+    cores = os.cpu_count() or 1
+    if max_workers is not None:
+        cores = min(cores, max_workers)
+    by_memory = int(memory_budget_gb // patient_memory_gb)
+
+    return max(1, min(cores, by_memory, n_patients))
+
+
+def load_manifest(path = manifest_file):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'patients': {}, 'cohort': {}}
+
+
+def save_manifest(manifest, path = manifest_file):
+    # Write to a temporary file first so an interrupted run never leaves
+    # a half-written manifest behind.
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.replace(tmp, path)
+
+
+def stage_done(manifest, hn_id, stage):
+    record = manifest['patients'].get(hn_id, {}).get(stage, {})
+    return record.get('status') in ('done', 'unchanged') and not record.get('check')
+
+
+def patient_keys(manifest, patient_list):
+    return {hn_id: manifest['patients'].get(hn_id, {}).get('05_dose_to_image', {}).get('key')
+            for hn_id in patient_list}
+
+
+def run_patient(hn_id, stages, reg_shift, previous = None):
+    '''
+    Worker: run the remaining stages for one patient. Stops at the first
+    failing stage and returns a record for every stage attempted.
+    previous is the manifest record of the patient from the last run.
+    '''
+    previous = previous or {}
+    changed = False
+    results = {}
+    for stage, script, func in stages:
+        start = time.time()
+        result = {'status': 'done'}
+        try:
+            with profile('patient', patient = hn_id, stage = stage):
+                module = importlib.import_module(script)
+                if stage == '05_dose_to_image':
+                    files = module.source_files(hn_id)
+                    key = module.patient_key(hn_id, reg_shift, *files)
+                    result['key'] = key
+                    if (previous.get(stage, {}).get('key') == key
+                            and module.open_store().written('ct', hn_id)):
+                        result['status'] = 'unchanged'
+                    else:
+                        getattr(module, func)(hn_id, reg_shift, files = files, key = key)
+                        changed = True
+                elif not changed and previous.get(stage, {}).get('status') in ('done', 'unchanged'):
+                    # Input from 05 is the same as last time.
+                    result['status'] = 'unchanged'
+                else:
+                    getattr(module, func)(hn_id)
+        except Exception:
+            results[stage] = {'status': 'failed',
+                              'seconds': time.time() - start,
+                              'error': traceback.format_exc()}
+            break
+        result['seconds'] = time.time() - start
+        results[stage] = result
+
+    return hn_id, results
+
+
+def run_patients(patient_list, reg_shift, manifest, stages):
+    '''
+    Run the per-patient stages in a process pool, retrying failed patients.
+    Returns the patients that still have stages left to do.
+    '''
+    for attempt in range(max_retries + 1):
+        todo = {hn_id: [s for s in stages if not stage_done(manifest, hn_id, s[0])]
+                for hn_id in patient_list}
+        todo = {hn_id: s for hn_id, s in todo.items() if s}
+        if not todo:
+            break
+
+        workers = pool_size(len(todo))
+        print(f'Attempt {attempt + 1}: {len(todo)} patient(s) on {workers} worker(s).')
+
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            futures = {pool.submit(run_patient, hn_id, s,
+                                   reg_shift[reg_shift.Patient == hn_id],
+                                   manifest['patients'].get(hn_id)): hn_id
+                       for hn_id, s in todo.items()}
+
+            for future in as_completed(futures):
+                hn_id = futures[future]
+                try:
+                    _, results = future.result()
+                except Exception:
+                    # The worker itself died (e.g. out of memory).
+                    results = {todo[hn_id][0][0]: {'status': 'failed',
+                                                   'error': traceback.format_exc()}}
+
+                record = manifest['patients'].setdefault(hn_id, {})
+                for stage, result in results.items():
+                    result['attempts'] = record.get(stage, {}).get('attempts', 0) + 1
+                    if result['status'] == 'failed' and 'key' in record.get(stage, {}):
+                        # Keep the key of the last good run to compare against.
+                        result['key'] = record[stage]['key']
+                    record[stage] = result
+                save_manifest(manifest)
+
+                failed = [s for s, r in results.items() if r['status'] == 'failed']
+                if failed:
+                    print(f'...{hn_id} failed at {failed[0]}.')
+                else:
+                    print(f'...{hn_id} finished.')
+
+    return [hn_id for hn_id in patient_list
+            if not all(stage_done(manifest, hn_id, s[0]) for s in stages)]
+
+
+if __name__ == "__main__":
+
+    reg_shift = pd.read_excel(reg_shift_file)
+    patient_list = [str(p) for p in np.unique(reg_shift.Patient)]
+
+    manifest = load_manifest()
+    if profile_log:
+        start_profiling(profile_log)
+
+    # Recheck every patient, unchanged ones are skipped (see run_patient).
+    for record in manifest['patients'].values():
+        for result in record.values():
+            result['check'] = True
+
+    # The crop stage is folded into 05 when it runs in single pass mode.
+    stages = patient_stages
+    if importlib.import_module('05_Dose_to_Image').single_pass:
+        stages = patient_stages[:1]
+
+    # Volume stores have to exist before the workers write into them.
+    for stage, script, func in stages:
+        importlib.import_module(script).create_store(patient_list)
+
+    start = time.time()
+    remaining = run_patients(patient_list, reg_shift, manifest, stages)
+    print(f'Per-patient stages finished in {(time.time() - start) / 60:.1f} minutes.')
+
+    if remaining:
+        print(f'{len(remaining)} patient(s) failed after {max_retries + 1} attempts, '
+              f'see {manifest_file}:')
+        print(remaining)
+        print('Skipping cohort stages until every patient is processed.')
+
+    else:
+        keys = patient_keys(manifest, patient_list)
+        for stage, script, func in cohort_stages:
+            # Redo the cohort stages if the cohort or any patient's output
+            # changed since they ran.
+            record = manifest['cohort'].get(stage, {})
+            if (record.get('status') == 'done' and record.get('patients') == patient_list
+                    and record.get('keys') == keys):
+                print(f'{stage} has already been processed.')
+                continue
+
+            print(f'Running {stage}...')
+            stage_start = time.time()
+            module = importlib.import_module(script)
+            with profile('cohort', stage = stage):
+                if stage in patient_list_stages:
+                    # Patients whose 05 output changed since the last
+                    # run are rewritten, the rest are kept (or resumed).
+                    old_keys = record.get('keys')
+                    redo = None if old_keys is None else [
+                        hn_id for hn_id in patient_list if old_keys.get(hn_id) != keys[hn_id]]
+                    getattr(module, func)(patient_list, redo = redo)
+                else:
+                    getattr(module, func)()
+
+            manifest['cohort'][stage] = {'status': 'done', 'patients': patient_list,
+                                         'keys': keys,
+                                         'seconds': time.time() - stage_start}
+            save_manifest(manifest)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Score new patients with a trained CT/dose classifier (.h5), straight from
+their DICOM CT and RTDOSE files.
+
+Each patient goes through the same chain as the training data:
+  05) load_ct + load_dose, transform_image (resample to 1 mm, resize,
+      registration shift and crop in one pass), window_image, and the
+      storage codecs of the volume store;
+  07) the sagittal/coronal/axial slices of views;
+  08) combine_channels to uint8 CT, dose and CT+dose channels.
+
+Patients are preprocessed in a process pool and scored as soon as they are
+ready, in micro-batches of up to max_batch: a batch is sent when it is
+full, or when max_wait seconds have passed without another patient
+finishing. The model and the pool are loaded once (Scorer), and with
+poll_seconds the script keeps running and scores patients as they are
+added to queue_file.
+
+Every row of output_file has the class probabilities and the latency of
+each stage, and a summary of the stage latencies is printed per run.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from dicomMethods import *
+
+
+model_file = 'H:/HN_TransferLearning/2_output/models/ct_classifier_en_b0_it.h5'
+
+# One row per patient: patient, ct (CT folder), dose (RTDOSE folder) and
+# optionally X, Y, Z registration shifts (0 when missing) and the
+# pretreatment_columns.
+queue_file = 'H:/HN_TransferLearning/0_data/plan_queue.csv'
+output_file = 'H:/HN_TransferLearning/2_output/scores.csv'
+
+# Preprocessing, the same as 05_Dose_to_Image.py and 08_Slice_to_TL.py.
+baseline = np.array([-300, -236, -583])
+shape = [512, 512, 512]
+crop_size = [(150,450),(135,435),(212,512)]
+codecs = pipeline_codecs
+out_dtype = np.uint8
+
+# Model inputs in order: orientation, axis and slice of each view, then
+# the pretreatment_columns of queue_file (None if the model has none).
+views = [('sagittal', 0, 150), ('coronal', 1, 120), ('axial', 2, 130)]
+pretreatment_columns = None
+
+max_batch = 8
+max_wait = 2.0 # Seconds a partial batch waits for another patient.
+workers = 2 # Preprocessing processes.
+
+poll_seconds = None # Rescan queue_file this often, None to run once.
+
+
+def preprocess(ct_files, dose_files, deformation):
+    '''
+    Model images of one patient, one [1, W, H, 3] array per view, and the
+    seconds spent in each stage.
+    '''
+    timings = {}
+    def lap(stage, start):
+        timings[stage] = time.perf_counter() - start
+        return time.perf_counter()
+
+    start = time.perf_counter()
+    ct_img, ct = load_ct(ct_files)
+    start = lap('load_ct', start)
+    dose_arr, dose = load_dose(dose_files)
+    start = lap('load_dose', start)
+
+    ct_img = np.swapaxes(ct_img, 0, -1)
+    dose_arr = np.swapaxes(dose_arr, 0, -1)
+    dose_thick = dose[0].GridFrameOffsetVector[1] - dose[0].GridFrameOffsetVector[0]
+    ct_shift, dose_shift = alignment_shifts(ct, dose, baseline)
+
+    ct_img = transform_image(ct_img, ct[0].SliceThickness, ct[0].PixelSpacing,
+                             ct_shift, deformation, crop = crop_size, shape = shape)
+    dose_img = transform_image(dose_arr, dose_thick, dose[0].PixelSpacing,
+                               dose_shift, deformation, crop = crop_size, shape = shape)
+    start = lap('transform', start)
+
+    # Windowed, then through the codecs as if read back from the store.
+    images = {}
+    for modality, img in (('ct', ct_img), ('dose', dose_img)):
+        codec = codecs[modality]
+        images[modality] = codec.decode(codec.encode(window_image(img)))
+    start = lap('window', start)
+
+    inputs = []
+    for name, axis, index in views:
+        ct_slice = np.take(images['ct'], [index], axis = axis)
+        dose_slice = np.take(images['dose'], [index], axis = axis)
+        shape_2d = [n for ii, n in enumerate(ct_slice.shape) if ii != axis]
+        inputs.append(combine_channels(ct_slice.reshape([1] + shape_2d),
+                                       dose_slice.reshape([1] + shape_2d), out_dtype))
+    lap('slice_channels', start)
+
+    return inputs, timings
+
+
+def patient_inputs(row):
+    # (ct files, dose files, deformation) of a queue_file row.
+    ct_files = [os.path.join(row['ct'], f) for f in os.listdir(row['ct'])]
+    dose_files = [os.path.join(row['dose'], f) for f in os.listdir(row['dose'])
+                  if f.startswith('RD.')]
+    # Empty cells are read as NaN, which is truthy, so `or 0` does not work.
+    deformation = np.array([0.0 if pd.isna(row.get(c)) else float(row[c])
+                            for c in ('X', 'Y', 'Z')])
+    if not np.all(np.isfinite(deformation)):
+        raise ValueError(f'Registration shift is not finite: {deformation}.')
+
+    return ct_files, dose_files, deformation
+
+
+class Scorer(object):
+    '''
+    Warm scoring state: the preprocessing pool and the model, loaded once
+    and reused for every call of score.
+    '''
+
+    def __init__(self, model_file = model_file, workers = workers, model = None):
+        # The pool is started before TensorFlow is imported, so forked
+        # workers do not inherit its threads.
+        self.pool = ProcessPoolExecutor(max_workers = workers)
+
+        if model is None:
+            import tensorflow as tf
+            model = tf.keras.models.load_model(model_file, compile = False)
+        self.model = model
+
+    def predict(self, samples):
+        '''
+        Class probabilities of a list of samples (lists of model inputs).
+        Batches are padded to max_batch with the last sample, so the model
+        always sees one batch shape and is not retraced.
+        '''
+        padded = samples + [samples[-1]] * (max_batch - len(samples))
+        inputs = [np.concatenate(x) for x in zip(*padded)]
+
+        return np.asarray(self.model.predict_on_batch(inputs))[:len(samples)]
+
+    def score(self, queue):
+        '''
+        Preprocess and score every row of queue (a DataFrame like
+        queue_file). Returns one row per patient with the probabilities,
+        predicted class, stage latencies, batch size and any error.
+        
+        ready is the time from submission until the patient was
+        preprocessed (including waiting for a worker), latency until it
+        was scored.
+        '''
+        self.submitted = time.perf_counter()
+        rows, futures = [], {}
+        for _, row in queue.iterrows():
+            row = row.to_dict()
+            try:
+                futures[self.pool.submit(preprocess, *patient_inputs(row))] = row
+            except Exception:
+                rows.append(self._failed(row))
+
+        batch = []
+        pending = set(futures)
+        while pending or batch:
+            done, pending = wait(pending, timeout = max_wait if batch else None,
+                                 return_when = FIRST_COMPLETED)
+
+            for future in done:
+                row = futures[future]
+                try:
+                    inputs, timings = future.result()
+                except Exception:
+                    rows.append(self._failed(row))
+                    continue
+
+                if pretreatment_columns:
+                    inputs.append(np.array([[row[c] for c in pretreatment_columns]],
+                                           dtype = np.float32))
+                result = dict(patient = row['patient'], **timings,
+                              ready = time.perf_counter() - self.submitted)
+                batch.append((result, inputs))
+
+            # Full, nothing else finished within max_wait, or the last ones.
+            if len(batch) >= max_batch or (batch and (not done or not pending)):
+                rows += self._score_batch(batch[:max_batch])
+                batch = batch[max_batch:]
+
+        return pd.DataFrame(rows)
+
+    def _score_batch(self, batch):
+        start = time.perf_counter()
+        probs = self.predict([inputs for result, inputs in batch])
+        elapsed = time.perf_counter() - start
+
+        results = []
+        for (result, inputs), p in zip(batch, probs):
+            result.update({f'p{k}': v for k, v in enumerate(p)})
+            result.update(predicted = int(np.argmax(p)), predict = elapsed,
+                          batch_size = len(batch),
+                          latency = time.perf_counter() - self.submitted)
+            print(f'...{result["patient"]} scored: class {result["predicted"]}.')
+            results.append(result)
+
+        return results
+
+    def _failed(self, row):
+        error = traceback.format_exc(limit = 1).strip().splitlines()[-1]
+        print(f'...{row["patient"]} failed: {error}')
+        return {'patient': row['patient'], 'error': error}
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def latency_summary(scores):
+    '''
+    Mean, median and 95th percentile of every stage, in seconds.
+    '''
+    stages = ['load_ct', 'load_dose', 'transform', 'window', 'slice_channels',
+              'ready', 'predict', 'latency']
+    stages = [s for s in stages if s in scores]
+
+    return scores[stages].describe(percentiles = [0.5, 0.95]).loc[['mean', '50%', '95%', 'max']]
+
+
+if __name__ == "__main__":
+
+    scorer = Scorer()
+
+    while True:
+        queue = pd.read_csv(queue_file, dtype = {'patient': str})
+        if os.path.exists(output_file):
+            done = set(pd.read_csv(output_file, dtype = {'patient': str}).patient)
+            queue = queue[~queue.patient.isin(done)]
+
+        if len(queue):
+            print(f'Scoring {len(queue)} patient(s)...')
+            start = time.time()
+            scores = scorer.score(queue)
+            print(f'Finished in {time.time() - start:.1f} seconds.')
+
+            # Failed patients are not written, so they are retried.
+            if 'error' in scores:
+                scores = scores[scores.error.isna()].drop(columns = 'error')
+            if len(scores):
+                print(latency_summary(scores))
+                scores.to_csv(output_file, mode = 'a', index = False,
+                              header = not os.path.exists(output_file))
+            else:
+                print('No patient was scored.')
+
+        if poll_seconds is None:
+            break
+        time.sleep(poll_seconds)
+
+    scorer.close()